@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+'''
+Benchmark of the gateway discovery via batman-adv.
+
+tests/batctl-gwl.txt is served for every segment, either by a stand-in
+batctl script (with a small startup delay like the real binary) or as
+debugfs gateways file. Compares the former serial batctl calls with the
+concurrent discovery and with reading debugfs.
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BASE)
+
+from gwLoadBalancer import GwLoadBalancer
+
+FIXTURE = os.path.join(BASE, "tests", "batctl-gwl.txt")
+
+
+def make_batctl(tmpdir, delay):
+    batctl = os.path.join(tmpdir, "batctl")
+    with open(batctl, "w") as fp:
+        fp.write("#!/bin/sh\nsleep %s\ncat %s\n" % (delay, FIXTURE))
+    os.chmod(batctl, 0o755)
+    return batctl
+
+
+def make_debugfs(tmpdir, segments):
+    debugfs = os.path.join(tmpdir, "batman_adv")
+    with open(FIXTURE) as fp:
+        data = fp.read()
+    for i in range(1, segments + 1):
+        os.makedirs(os.path.join(debugfs, "bat%02i" % (i)))
+        with open(os.path.join(debugfs, "bat%02i" % (i), "gateways"), "w") as fp:
+            fp.write("[B.A.T.M.A.N. adv 2019.0, MainIF/MAC: bb%02i/02:00:35:%02i:05:03]\n" % (i, i))
+            fp.write("      Router            ( TQ) Next Hop          [outgoingIf]  Bandwidth\n")
+            fp.write(data)
+    return debugfs
+
+
+def run_serial(lb):
+    # discovery as it was implemented before, one batctl after another
+    output = ""
+    for i in range(1, lb.segments + 1):
+        cmd = "%s -m bat%s gwl -H -n" % (lb.batctl, ("%i" % (i)).zfill(2))
+        output += subprocess.check_output(cmd.split(" ")).decode("utf-8")
+    lb.parse_batctl_output(output)
+
+
+def measure(segments, func, batctl, debugfs):
+    lb = GwLoadBalancer()
+    lb.localhost = "lb01"
+    lb.segments = segments
+    lb.batctl = batctl
+    lb.batmanDebugfs = debugfs
+    start = time.time()
+    func(lb)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark for the gateway discovery via batctl")
+    parser.add_argument("-s", "--segments", type=int, nargs="+", default=[32, 64, 128], help="number of segments")
+    parser.add_argument("-d", "--delay", type=float, default=0.01, help="startup delay of the batctl stand-in")
+    args = parser.parse_args()
+
+    print("%8s %12s %12s %12s" % ("segments", "serial [s]", "conc. [s]", "debugfs [s]"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        batctl = make_batctl(tmpdir, args.delay)
+        for segments in args.segments:
+            debugfs = make_debugfs(os.path.join(tmpdir, str(segments)), segments)
+            serial = measure(segments, run_serial, batctl, "/nonexistent")
+            concurrent = measure(segments, GwLoadBalancer.get_available_gw_from_batctl, batctl, "/nonexistent")
+            direct = measure(segments, GwLoadBalancer.get_available_gw_from_batctl, batctl, debugfs)
+            print("%8i %12.3f %12.3f %12.4f" % (segments, serial, concurrent, direct))
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+'''
+Benchmark of the fastd peer key lookup.
+
+Creates a key folder with many fastd key files and compares the former
+substring scan over all files with a lookup in FastdKeyIndex, for a key
+that is present (hit) and one that is not (miss).
+'''
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+
+BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BASE)
+spec = importlib.util.spec_from_file_location("fastdverify", os.path.join(BASE, "fastd-verify.py"))
+fastdverify = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fastdverify)
+
+
+def gen_keys(folder, count, seed):
+    rnd = random.Random(seed)
+    keys = []
+    for i in range(count):
+        key = "%064x" % (rnd.getrandbits(256))
+        keys.append(key)
+        with open(os.path.join(folder, "ffs-%06i" % (i)), "w") as fp:
+            fp.write("# node ffs-%06i\nkey \"%s\";\n" % (i, key))
+    return keys
+
+
+def legacy_is_valid_key(FilePath, FastdKey):
+    # the lookup as it was implemented before FastdKeyIndex
+    for FileName in os.listdir(FilePath):
+        with open(os.path.join(FilePath, FileName), encoding='utf-8') as KeyFile:
+            KeyData = KeyFile.read()
+        if FastdKey in KeyData:
+            return True
+    return False
+
+
+def measure(func, repeat):
+    start = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark for the fastd key lookup")
+    parser.add_argument("-n", "--keys", type=int, nargs="+", default=[1000, 10000], help="number of key files")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="lookups per measurement of the scan")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%8s %12s %12s %12s %12s %12s" % ("keys", "build [s]", "scan hit", "scan miss", "index hit", "index miss"))
+    for count in args.keys:
+        with tempfile.TemporaryDirectory() as folder:
+            keys = gen_keys(folder, count, args.seed)
+            hit = keys[len(keys) // 2]
+            miss = "f" * 64
+            start = time.time()
+            index = fastdverify.FastdKeyIndex(folder)
+            build = time.time() - start
+
+            def lookup(key):
+                index.Refresh()
+                return key in index
+
+            scanHit = measure(lambda: legacy_is_valid_key(folder, hit), args.repeat)
+            scanMiss = measure(lambda: legacy_is_valid_key(folder, miss), args.repeat)
+            indexHit = measure(lambda: lookup(hit), 10000)
+            indexMiss = measure(lambda: lookup(miss), 10000)
+            print("%8i %12.4f %10.2fms %10.2fms %10.2fus %10.2fus" % (count, build, scanHit * 1e3, scanMiss * 1e3,
+                                                                      indexHit * 1e6, indexMiss * 1e6))
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+'''
+Benchmark of GwLoadBalancer.get_all_status against a local stand-in server.
+
+Serves N fake gateways with random latency, some of them failing (503) or
+hanging longer than the fetch timeout, and compares fetching them one after
+another with the concurrent collection.
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+
+from gwLoadBalancer import GwLoadBalancer
+from gwstatusserver import GwStatusServer, gen_gwstatus
+
+
+def gen_gateways(count, latency, failures, hanging, seed):
+    rnd = random.Random(seed)
+    gateways = {}
+    for i in range(count):
+        gw = "gw%02in%02i" % (i // 10, i % 10)
+        gateway = {"doc": gen_gwstatus(segments=32), "delay": rnd.uniform(0, latency)}
+        r = rnd.random()
+        if r < failures:
+            gateway["code"] = 503
+        elif r < failures + hanging:
+            gateway["delay"] = 2
+        gateways[gw] = gateway
+    return gateways
+
+
+def run_serial(lb):
+    for gw in lb.allGws.keys():
+        lb.allGws[gw] = lb.get_gw_status(gw)
+
+
+def run_concurrent(lb):
+    lb.get_all_status()
+
+
+def measure(server, gateways, func):
+    lb = GwLoadBalancer()
+    lb.get_gw_status_url = server.url
+    lb.allGws = {gw: {} for gw in gateways}
+    start = time.time()
+    func(lb)
+    duration = time.time() - start
+    ok = len([gw for gw in lb.allGws if lb.allGws[gw] != {}])
+    return (duration, ok)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark for get_all_status")
+    parser.add_argument("-n", "--gateways", type=int, nargs="+", default=[10, 50, 100], help="number of gateways")
+    parser.add_argument("-l", "--latency", type=float, default=0.1, help="max injected latency in seconds")
+    parser.add_argument("-f", "--failures", type=float, default=0.1, help="fraction of gateways returning 503")
+    parser.add_argument("--hanging", type=float, default=0.05, help="fraction of gateways exceeding the timeout")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print("%8s %12s %12s %8s" % ("gws", "serial [s]", "conc. [s]", "ok"))
+    for count in args.gateways:
+        gateways = gen_gateways(count, args.latency, args.failures, args.hanging, args.seed)
+        with GwStatusServer(gateways) as server:
+            (serial, ok) = measure(server, gateways, run_serial)
+            (concurrent, ok_concurrent) = measure(server, gateways, run_concurrent)
+        print("%8i %12.3f %12.3f %4i/%-4i" % (count, serial, concurrent, ok_concurrent, ok))
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+'''
+Benchmark of the selection of the DNS changes in get_result.
+
+Compares the per segment methods (get_best_gw_for_segment sorting a segment
+for the add and again for the remove question) with the one pass plan of
+StatusMatrix, including building the matrix from the status dict, and the
+global strategy plan_global.
+'''
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gwLoadBalancer import GwLoadBalancer  # noqa: E402
+from gwStatusMatrix import StatusMatrix  # noqa: E402
+
+
+def gen_status(segments, gateways, seed):
+    rnd = random.Random(seed)
+    gws = ["gw%02in%02i" % (i // 10, i % 10) for i in range(gateways)]
+    status = {}
+    for s in range(1, segments + 1):
+        status[str(s)] = {gw: {"preference": rnd.randrange(-20, 101), "dnsactive": rnd.choice([0, 1])} for gw in gws}
+    return status
+
+
+def legacy_plan(lb):
+    return {segment: (lb.get_best_gw_for_segment(segment),
+                      lb.get_gws_that_have_to_be_added_to_dns(segment),
+                      lb.get_gws_that_have_to_removed_from_dns(segment)) for segment in lb.status}
+
+
+def measure(func, repeat):
+    start = time.time()
+    for i in range(repeat):
+        result = func()
+    return ((time.time() - start) / repeat, result)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark for the selection of the DNS changes")
+    parser.add_argument("-s", "--segments", type=int, default=1000, help="number of segments")
+    parser.add_argument("-g", "--gateways", type=int, default=100, help="number of gateways")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    lb = GwLoadBalancer()
+    lb.status = gen_status(args.segments, args.gateways, args.seed)
+    (legacy, expected) = measure(lambda: legacy_plan(lb), args.repeat)
+    (matrix, result) = measure(lambda: StatusMatrix(lb.status).plan(lb.desiredGwPerSegment), args.repeat)
+    assert expected == result
+    (globalPlan, result) = measure(lambda: StatusMatrix(lb.status).plan_global(lb.desiredGwPerSegment), args.repeat)
+    print("%i segments x %i gateways" % (args.segments, args.gateways))
+    print("per segment methods:      %8.1f ms" % (legacy * 1e3))
+    print("StatusMatrix.plan:        %8.1f ms" % (matrix * 1e3))
+    print("StatusMatrix.plan_global: %8.1f ms" % (globalPlan * 1e3))
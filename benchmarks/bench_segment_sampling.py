@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+'''
+Benchmark of the per segment traffic sampling of genGwStatus.
+
+Writes a /proc/net/dev like file with one batman and one fastd interface
+per segment and measures a full sampling round: one pass over the
+counters, a ring buffer sample and a peak per segment and the per
+segment preferences.
+'''
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import genGwStatus  # noqa: E402
+from gwTraffic import TrafficRing  # noqa: E402
+
+
+def gen_net_dev(path, segments, rnd, counters):
+    lines = ["Inter-|   Receive                                                |  Transmit",
+             " face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed"]
+    counters["eth0"] = counters.get("eth0", 0) + rnd.randrange(10 ** 9)
+    lines.append("%8s: 0 0 0 0 0 0 0 0 %i 0 0 0 0 0 0 0" % ("eth0", counters["eth0"]))
+    for s in range(1, segments + 1):
+        for iface in ("bat%02i" % (s), "vpn%02ibb" % (s)):
+            counters[iface] = counters.get(iface, 0) + rnd.randrange(10 ** 8)
+            lines.append("%8s: 0 0 0 0 0 0 0 0 %i 0 0 0 0 0 0 0" % (iface, counters[iface]))
+    with open(path, "w") as fp:
+        fp.write("\n".join(lines) + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark for the per segment traffic sampling")
+    parser.add_argument("-s", "--segments", type=int, nargs="+", default=[32, 64, 128, 256], help="number of segments")
+    parser.add_argument("-r", "--repeat", type=int, default=200, help="sampling rounds per measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    print("%8s %14s %14s" % ("segments", "round [ms]", "max rate [Hz]"))
+    with tempfile.TemporaryDirectory() as folder:
+        netdev = os.path.join(folder, "dev")
+        for segments in args.segments:
+            ring = TrafficRing(os.path.join(folder, "traffic.ring"), series=segments + 1)
+            counters = {}
+            now = time.time()
+            elapsed = 0
+            for i in range(args.repeat):
+                gen_net_dev(netdev, segments, rnd, counters)
+                now += 5
+                start = time.time()
+                peaks = genGwStatus.sampleTraffic(ring, now, "eth0", segments, "bat%02i", netdev)
+                genGwStatus.getSegmentPreferences(10000, peaks, segments)
+                elapsed += time.time() - start
+            ring.close()
+            round_ = elapsed / args.repeat
+            print("%8i %14.3f %14.0f" % (segments, round_ * 1e3, 1 / round_))
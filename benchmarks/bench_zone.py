@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+'''
+Benchmark of the zone lookups done while validating the gateway status.
+
+validate_gw_status asks for the active gateways of every segment of every
+gateway. This compares the former regex scans of the zone text with the
+indexed GwZone on synthetic zones of growing size.
+'''
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from gwZone import GwZone
+
+
+def gen_zone(gateways, segments, padding):
+    lines = []
+    for i in range(gateways):
+        gw = "gw%02in%02i" % (i // 10, i % 10)
+        lines.append("%s.gw.freifunk-stuttgart.de. 300 IN A\t10.%i.0.%i" % (gw, i // 10, i % 10))
+        lines.append("%s.gw.freifunk-stuttgart.de. 300 IN AAAA\t2001:db8::%i:%i" % (gw, i // 10, i % 10))
+    for s in range(1, segments + 1):
+        for i in range(0, gateways, 3):
+            lines.append("gw%02is%02i.gw.freifunk-stuttgart.de. 300 IN A\t10.%i.0.%i" % (i // 10, s, i // 10, i % 10))
+    for i in range(padding):
+        lines.append("node%i.gw.freifunk-stuttgart.de. 300 IN TXT\t\"padding\"" % (i))
+    return "\n".join(lines)
+
+
+# the lookups as they were implemented before GwZone
+def legacy_ip_to_gw_lookup(zoneData):
+    reverseDnsEntries = {}
+    p1 = re.compile(r'(gw0[0-9]n0[0-9])\.gw\.freifunk-stuttgart\.de\. [0-9]+ IN A*\t(.*)')
+    for line in zoneData.split("\n"):
+        m = p1.match(line)
+        if m != None:
+            reverseDnsEntries[m.group(2)] = m.group(1)
+    return reverseDnsEntries
+
+
+def legacy_active_gw_per_segment(zoneData, reverseDnsEntries, segment):
+    gws = []
+    p = re.compile(r'(gw0[0-9])s([0-9]{2})\.gw\.freifunk-stuttgart\.de\. [0-9]+ IN A*\t(.*)')
+    for line in zoneData.split("\n"):
+        m = p.match(line)
+        if m != None:
+            s = str(int(m.group(2)))
+            if s == segment and s != "99":
+                gw = reverseDnsEntries[m.group(3)]
+                if gw not in gws:
+                    gws.append(gw)
+    return gws
+
+
+def run_legacy(zoneData, gateways, segments):
+    reverseDnsEntries = legacy_ip_to_gw_lookup(zoneData)
+    for gw in range(gateways):
+        for s in range(1, segments + 1):
+            legacy_active_gw_per_segment(zoneData, reverseDnsEntries, str(s))
+
+
+def run_indexed(zoneData, gateways, segments):
+    zone = GwZone.from_text(zoneData)
+    for gw in range(gateways):
+        for s in range(1, segments + 1):
+            zone.get_active_gws(str(s))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark for zone lookups")
+    parser.add_argument("-g", "--gateways", type=int, default=20, help="number of gateways")
+    parser.add_argument("-s", "--segments", type=int, default=32, help="number of segments")
+    parser.add_argument("-p", "--padding", type=int, nargs="+", default=[0, 1000, 5000, 10000],
+                        help="number of additional records in the zone")
+    args = parser.parse_args()
+
+    print("%8s %12s %12s" % ("records", "regex [s]", "index [s]"))
+    for padding in args.padding:
+        zoneData = gen_zone(args.gateways, args.segments, padding)
+        start = time.time()
+        run_legacy(zoneData, args.gateways, args.segments)
+        legacy = time.time() - start
+        start = time.time()
+        run_indexed(zoneData, args.gateways, args.segments)
+        indexed = time.time() - start
+        print("%8i %12.4f %12.4f" % (zoneData.count("\n") + 1, legacy, indexed))
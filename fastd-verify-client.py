@@ -0,0 +1,42 @@
+#!/usr/bin/python3 -IS
+'''
+Minimal fastd verify hook asking the resident verifier (fastd-verify.py --listen).
+The verifier answers immediately, the peer is accepted only if it is admitted.
+
+usage: fastd-verify-client.py SOCKET -k KEYFOLDER -g GWSTATUS
+
+If the verifier is not reachable, fastd-verify.py is run with the remaining
+arguments instead.
+'''
+
+import os
+import socket
+import sys
+
+
+def Ask(SocketPath, Interface, PeerKey):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as Sock:
+        Sock.settimeout(5.0)
+        Sock.connect(SocketPath)
+        Sock.sendall(('%s %s\n' % (Interface, PeerKey)).encode('ascii'))
+        Reply = b''
+        while not Reply.endswith(b'\n'):
+            Chunk = Sock.recv(64)
+            if not Chunk:
+                break
+            Reply += Chunk
+    return Reply.decode('ascii').split()
+
+
+if __name__ == '__main__':
+    if 'INTERFACE' not in os.environ or 'PEER_KEY' not in os.environ or len(sys.argv) < 2:
+        sys.exit(1)
+    try:
+        Reply = Ask(sys.argv[1], os.environ['INTERFACE'], os.environ['PEER_KEY'])
+    except OSError:
+        Fallback = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fastd-verify.py')
+        os.execv(sys.executable, [sys.executable, Fallback] + sys.argv[2:])
+    # a deferred peer is refused for now and retries its handshake later
+    if Reply == ['OK']:
+        sys.exit(0)
+    sys.exit(1)
@@ -5,11 +5,15 @@ Created on Apr 29, 2021
 '''
 
 import os
+import re
+import fcntl
 import time
 import argparse
 import logging
 import logging.handlers
 import json
+import socketserver
+import threading
 
 my_logger = logging.getLogger('fastd.verify')
 my_logger.setLevel(logging.DEBUG)
@@ -19,25 +23,118 @@ my_logger.addHandler(log_handler)
 DEFAULT_PREFERENCE = 50
 MAX_DELAY = 8.0
 OVERLOAD_DELAY = 9.0
+RESCAN_INTERVAL = 60.0
+ADMISSION_BURST = 2.0
+TABLE_MAX_AGE = 900.0
+ADMISSION_STATE = '/run/fastd-verify.admission'
 
+ADMIT = 'OK'
+DEFER = 'DEFER'
+REJECT = 'NO'
 
-def IsValidKey(FilePath, FastdKey):
-    for FileName in os.listdir(FilePath):
+KEY_PATTERN = re.compile(r'^\s*key\s+"([0-9a-fA-F]{64})"\s*;', re.MULTILINE)
+
+
+class FastdKeyIndex:
+    '''Set of the peer keys in a fastd key folder, updated per file by mtime.'''
+
+    def __init__(self, KeyFolder):
+        self.KeyFolder = KeyFolder
+        self.Files = {}    # FileName -> ((mtime, size), keys of the file)
+        self.Keys = set()
+        self.FolderMtime = None
+        self.LastScan = 0.0
+        self.Refresh()
+
+    def IsDue(self):
+        # only a stat of the folder, requests check this without taking a lock
         try:
-            with open(os.path.join(FilePath, FileName), encoding = 'utf-8') as KeyFile:
-                KeyData  = KeyFile.read()
-        except:
-            my_logger.error('fastd-verify: ** Error while reading KeyFile %s/%s' % (FilePath, FileName))
-        else:
-            if FastdKey in KeyData:
-#                my_logger.debug('fastd-verify: FastdKey %s found in KeyFile %s/%s' % (FastdKey, FilePath, FileName))
-                return True
+            FolderMtime = os.stat(self.KeyFolder).st_mtime_ns
+        except OSError:
+            return True
+        return FolderMtime != self.FolderMtime or time.time() - self.LastScan >= RESCAN_INTERVAL
+
+    def Refresh(self):
+        # new and removed files change the folder mtime, edited files are found by the periodic rescan.
+        # The key set is rebuilt aside and swapped in, concurrent lookups see either the old or the new one
+        try:
+            FolderMtime = os.stat(self.KeyFolder).st_mtime_ns
+        except OSError:
+            my_logger.error('fastd-verify: ** Error while reading KeyFolder %s' % (self.KeyFolder))
+            return
+        if FolderMtime == self.FolderMtime and time.time() - self.LastScan < RESCAN_INTERVAL:
+            return
+        self.FolderMtime = FolderMtime
+        self.LastScan = time.time()
+        Files = {}
+        for FileName in os.listdir(self.KeyFolder):
+            try:
+                Stat = os.stat(os.path.join(self.KeyFolder, FileName))
+            except OSError:
+                continue
+            Version = (Stat.st_mtime_ns, Stat.st_size)
+            if FileName in self.Files and self.Files[FileName][0] == Version:
+                Files[FileName] = self.Files[FileName]
+                continue
+            try:
+                with open(os.path.join(self.KeyFolder, FileName), encoding = 'utf-8') as KeyFile:
+                    KeyData = KeyFile.read()
+            except:
+                my_logger.error('fastd-verify: ** Error while reading KeyFile %s/%s' % (self.KeyFolder, FileName))
+                continue
+            Files[FileName] = (Version, frozenset(Key.lower() for Key in KEY_PATTERN.findall(KeyData)))
+        Keys = set()
+        for (Version, FileKeys) in Files.values():
+            Keys.update(FileKeys)
+        (self.Files, self.Keys) = (Files, Keys)
+
+    def __contains__(self, FastdKey):
+        return FastdKey.lower() in self.Keys
+
+    def __len__(self):
+        return len(self.Keys)
+
+
+def IsValidKey(FilePath, FastdKey):
+    if FastdKey in FastdKeyIndex(FilePath):
+        return True
 
     my_logger.debug('fastd-verify: ** Key %s not found in %s' % (FastdKey, FilePath))
     return False
 
 
-def GetGwPreference(StatusFile, Segment):
+def GetTablePreference(Table, Segment, Now=None):
+    # None if the table has no recent entry for the segment
+    Entry = Table.get(Segment)
+    if Entry is None:
+        return None
+    if Now is None:
+        Now = time.time()
+    (Preference, Timestamp) = Entry
+    if Now - Timestamp > TABLE_MAX_AGE:
+        return None
+    return Preference
+
+
+def OpenPreferenceTable(TableFile):
+    # imported only with a table, the hook also works when installed without gwPreferenceTable.py
+    from gwPreferenceTable import PreferenceTable
+    return PreferenceTable(TableFile)
+
+
+def GetGwPreference(StatusFile, Segment, TableFile=None):
+    if TableFile is not None:
+        try:
+            Table = OpenPreferenceTable(TableFile)
+            try:
+                Preference = GetTablePreference(Table, Segment)
+            finally:
+                Table.close()
+            if Preference is not None:
+                return Preference
+        except (ImportError, OSError, ValueError):
+            my_logger.error('fastd-verify: ** Error while reading preference table %s' % (TableFile))
+
     try:
         with open(StatusFile) as JsonFile:
             StatusDict = json.load(JsonFile)
@@ -49,29 +146,239 @@ def GetGwPreference(StatusFile, Segment):
     return Preference
 
 
+def GetDelay(Preference):
+    if Preference < 5:
+        return OVERLOAD_DELAY
+    elif Preference <= 10:
+        return MAX_DELAY
+    elif Preference <= 30:    # 10 .. 30
+        return (1.00 - (Preference-10)/20.0 * 0.75) * MAX_DELAY    # (10|8.0) .. (30|2.0)
+    elif Preference <= 50:    # 30 .. 50
+        return (0.25 - (Preference-30)/20.0 * 0.25) * MAX_DELAY    # (30|2.0) .. (50|0.0)
+    return 0.0
+
+
+def GetAdmissionRate(Preference):
+    # admissions per second and segment, the inverse of the delay curve; None means unlimited
+    Delay = GetDelay(Preference)
+    if Delay <= 0.0:
+        return None
+    return 1.0 / Delay
+
+
+class AdmissionController:
+    '''Token bucket per segment, refilled at the rate given by the segment's preference.'''
+
+    def __init__(self, Burst=ADMISSION_BURST):
+        self.Burst = Burst
+        self.Buckets = {}     # Segment -> [tokens, last refill]
+        self.Admitted = {}
+        self.Deferred = {}
+        self.Lock = threading.Lock()
+
+    def Admit(self, Segment, Preference, Now=None):
+        if Now is None:
+            Now = time.monotonic()
+        Rate = GetAdmissionRate(Preference)
+        with self.Lock:
+            Bucket = self.Buckets.setdefault(Segment, [self.Burst, Now])
+            if Rate is None:
+                Bucket[0] = self.Burst
+            else:
+                Bucket[0] = min(self.Burst, Bucket[0] + (Now - Bucket[1]) * Rate)
+            Bucket[1] = Now
+            if Bucket[0] >= 1.0:
+                Bucket[0] -= 1.0
+                self.Admitted[Segment] = self.Admitted.get(Segment, 0) + 1
+                return ADMIT
+            self.Deferred[Segment] = self.Deferred.get(Segment, 0) + 1
+            return DEFER
+
+    def GetStats(self):
+        with self.Lock:
+            return {'admitted': dict(self.Admitted), 'deferred': dict(self.Deferred)}
+
+
+def OneShotAdmit(StateFile, Segment, Preference, Now=None):
+    # the hook is started for every connection attempt, the token buckets are kept in StateFile between the runs
+    if GetAdmissionRate(Preference) is None:
+        return ADMIT
+    if Now is None:
+        Now = time.time()
+    Admission = AdmissionController()
+    try:
+        with open(StateFile, 'a+') as StateData:
+            fcntl.flock(StateData, fcntl.LOCK_EX)
+            StateData.seek(0)
+            try:
+                Admission.Buckets = {int(Key): Bucket for (Key, Bucket) in json.load(StateData).items()}
+            except (ValueError, AttributeError):
+                pass
+            Verdict = Admission.Admit(Segment, Preference, Now)
+            StateData.seek(0)
+            StateData.truncate()
+            json.dump(Admission.Buckets, StateData)
+    except OSError:
+        my_logger.error('fastd-verify: ** Error while updating admission state %s' % (StateFile))
+        return ADMIT
+    return Verdict
+
+
+class FastdVerifier:
+    '''Keeps key files and gateway preferences in memory, re-reading them only when they changed.'''
+
+    def __init__(self, KeyFolder, StatusFile, TableFile=None):
+        self.KeyFolder = KeyFolder
+        self.StatusFile = StatusFile
+        self.TableFile = TableFile
+        self.Table = None
+        self.KeyIndex = None
+        self.StatusMtime = None
+        self.Preferences = {}
+        self.Rejected = 0
+        self.Admission = AdmissionController()
+        self.Lock = threading.Lock()    # held only while a refresh is due
+        self.StatsLock = threading.Lock()
+
+    def IsRefreshDue(self):
+        # only stat calls, without the lock; most requests find nothing changed and return right away
+        if self.KeyIndex is None or self.KeyIndex.IsDue():
+            return True
+        try:
+            Mtime = os.stat(self.StatusFile).st_mtime_ns
+        except OSError:
+            Mtime = None
+        if Mtime != self.StatusMtime:
+            return True
+        return self.TableFile is not None and (self.Table is None or self.Table.is_replaced())
+
+    def Refresh(self):
+        if not self.IsRefreshDue():
+            return
+        with self.Lock:
+            # checked again, a concurrent request may have refreshed while this one waited for the lock
+            if not self.IsRefreshDue():
+                return
+            if self.KeyIndex is None:
+                self.KeyIndex = FastdKeyIndex(self.KeyFolder)
+            else:
+                self.KeyIndex.Refresh()
+            try:
+                Mtime = os.stat(self.StatusFile).st_mtime_ns
+            except OSError:
+                Mtime = None
+            if Mtime != self.StatusMtime:
+                self.Preferences = self.ReadPreferences()
+                self.StatusMtime = Mtime
+            if self.TableFile is not None and (self.Table is None or self.Table.is_replaced()):
+                self.OpenTable()
+
+    def OpenTable(self):
+        # the previous table is not closed, a concurrent request may still read it
+        self.Table = None
+        try:
+            self.Table = OpenPreferenceTable(self.TableFile)
+        except (ImportError, OSError, ValueError):
+            my_logger.error('fastd-verify: ** Error while opening preference table %s' % (self.TableFile))
+
+    def ReadPreferences(self):
+        try:
+            with open(self.StatusFile) as JsonFile:
+                StatusDict = json.load(JsonFile)
+            return {int(Segment): int(Data['preference']) for (Segment, Data) in StatusDict['segments'].items()}
+        except:
+            my_logger.error('fastd-verify: ** Error while reading GW StatusFile %s' % (self.StatusFile))
+            return {}
+
+    def IsValidKey(self, FastdKey):
+        if FastdKey in self.KeyIndex:
+            return True
+        my_logger.debug('fastd-verify: ** Key %s not found in %s' % (FastdKey, self.KeyFolder))
+        return False
+
+    def GetGwPreference(self, Segment):
+        # the table is read on every request, gwstatus.json only when it changed
+        if self.Table is not None:
+            Preference = GetTablePreference(self.Table, Segment)
+            if Preference is not None:
+                return Preference
+        return self.Preferences.get(Segment, DEFAULT_PREFERENCE)
+
+    def Verify(self, Interface, FastdKey):
+        # answers immediately: ADMIT, DEFER (the peer has to try again later) or REJECT (unknown key)
+        self.Refresh()
+        if not self.IsValidKey(FastdKey):
+            with self.StatsLock:
+                self.Rejected += 1
+            return REJECT
+        Segment = int(Interface[3:])
+        Preference = self.GetGwPreference(Segment)
+        Verdict = self.Admission.Admit(Segment, Preference)
+        if Verdict == DEFER:
+            my_logger.debug('fastd-verify: %s / %s / %d deferred.' % (Interface, FastdKey, Preference))
+        return Verdict
+
+    def GetStats(self):
+        Stats = self.Admission.GetStats()
+        with self.StatsLock:
+            Stats['rejected'] = self.Rejected
+        return Stats
+
+
+class VerifyRequestHandler(socketserver.StreamRequestHandler):
+    # request: "<interface> <peer key>\n", reply: "OK\n", "DEFER\n" or "NO\n"
+    # request: "STATS\n", reply: the admission counters as one line of JSON
+    def handle(self):
+        try:
+            Request = self.rfile.readline().decode('ascii').split()
+            if Request == ['STATS']:
+                self.wfile.write((json.dumps(self.server.Verifier.GetStats()) + '\n').encode('ascii'))
+                return
+            (Interface, FastdKey) = Request
+            Verdict = self.server.Verifier.Verify(Interface, FastdKey.lower())
+        except Exception as e:
+            my_logger.error('fastd-verify: ** Error while handling request: %s' % (e))
+            Verdict = REJECT
+        self.wfile.write(('%s\n' % (Verdict)).encode('ascii'))
+
+
+class VerifyServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def Serve(SocketPath, KeyFolder, StatusFile, TableFile=None):
+    if os.path.exists(SocketPath):
+        os.remove(SocketPath)
+    Server = VerifyServer(SocketPath, VerifyRequestHandler)
+    Server.Verifier = FastdVerifier(KeyFolder, StatusFile, TableFile)
+    Server.Verifier.Refresh()
+    os.chmod(SocketPath, 0o660)
+    my_logger.info('fastd-verify: listening on %s' % (SocketPath))
+    Server.serve_forever()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Verification of Fastd Connection Requests',
                                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('-k', '--keyfolder', dest='keyfolder', action='store', required=True, help='path to keyfiles')
     parser.add_argument('-g', '--gwstatus', dest='gwstatus', action='store', required=True, help='path to gwstatus.json')
+    parser.add_argument('-t', '--table', dest='table', action='store', required=False,
+                        help='path to the preference table of genGwStatus.py, gwstatus.json is the fallback')
+    parser.add_argument('-a', '--admission-state', dest='state', action='store', default=ADMISSION_STATE,
+                        help='file keeping the admissions of the one-shot hook between its runs')
+    parser.add_argument('-l', '--listen', dest='listen', action='store', required=False,
+                        help='run as resident verifier on this unix socket (see fastd-verify-client.py)')
     args = parser.parse_args()
 
-    if 'INTERFACE' not in os.environ or 'PEER_KEY' not in os.environ:
+    if args.listen is not None:
+        Serve(args.listen, args.keyfolder, args.gwstatus, args.table)
+    elif 'INTERFACE' not in os.environ or 'PEER_KEY' not in os.environ:
         my_logger.error('fastd-verify: ** Error - Environment Variables not set')
     else:
         if IsValidKey(args.keyfolder, os.environ['PEER_KEY'].lower()):
-            Preference = GetGwPreference(args.gwstatus, int(os.environ['INTERFACE'][3:]))
-            my_logger.debug('fastd-verify: %s / %s / %d will be delayed...' % (os.environ['INTERFACE'], os.environ['PEER_KEY'], Preference))
-
-            if Preference < 5:
-                time.sleep(OVERLOAD_DELAY)
-            elif Preference <= 10:
-                time.sleep(MAX_DELAY)
-            elif Preference <= 30:    # 10 .. 30
-                time.sleep((1.00 - (Preference-10)/20.0 * 0.75) * MAX_DELAY)    # (10|8.0) .. (30|2.0)
-            elif Preference <= 50:    # 30 .. 50
-                time.sleep((0.25 - (Preference-30)/20.0 * 0.25) * MAX_DELAY)    # (30|2.0) .. (50|0.0)
-
-            my_logger.debug('fastd-verify: %s / %s / %d ok.' % (os.environ['INTERFACE'], os.environ['PEER_KEY'], Preference))
-            exit(0)
-exit(1)
+            Preference = GetGwPreference(args.gwstatus, int(os.environ['INTERFACE'][3:]), args.table)
+            if OneShotAdmit(args.state, int(os.environ['INTERFACE'][3:]), Preference) == ADMIT:
+                my_logger.debug('fastd-verify: %s / %s / %d ok.' % (os.environ['INTERFACE'], os.environ['PEER_KEY'], Preference))
+                exit(0)
+            my_logger.debug('fastd-verify: %s / %s / %d deferred.' % (os.environ['INTERFACE'], os.environ['PEER_KEY'], Preference))
+    exit(1)
@@ -11,10 +11,13 @@ import calendar
 import json
 import subprocess
 import logging
-import dns.zone
-import dns.query
 import socket
+import gzip
+import tempfile
 
+from gwTraffic import readNetDev, countClients, TrafficRing
+from gwPreferenceTable import PreferenceTable
+from gwTrace import get_tracer
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
 
@@ -115,12 +118,57 @@ def getPeak():
     logging.debug("Found peak '{}'...".format(peak_mbits))
     return peak_mbits
 
-def getPreference(bwlimit):
-    preference = int((bwlimit-getPeak()) / (bwlimit/100.))
+
+def sampleTraffic(ring, now, uplink, segmentCount, segmentIface, netdev='/proc/net/dev'):
+    # one pass over the kernel counters, series 0 is the uplink, series s the interface of segment s;
+    # a series is left out until it has been sampled for five minutes
+    logging.debug("Sampling {}...".format(netdev))
+    counters = readNetDev(netdev)
+    if uplink not in counters:
+        raise CLIError("interface %s not found in %s" % (uplink, netdev))
+    ring.sample(0, now, counters[uplink][1])
+    peaks = {0: ring.getPeak(0, now)}
+    for s in range(1, segmentCount+1):
+        name = segmentIface % (s)
+        if name in counters:
+            ring.sample(s, now, counters[name][1])
+            peaks[s] = ring.getPeak(s, now)
+    peaks = {s: peak for (s, peak) in peaks.items() if peak is not None}
+
+    logging.debug("Found peaks '{}'...".format(peaks))
+    return peaks
+
+
+def getSegmentPreferences(bwlimit, peaks, segmentCount, clients=None):
+    # a segment's weight is its share of the segment traffic and of the clients. A segment carrying more than
+    # the average weight gets the preference the gateway would have if all segments were loaded like it,
+    # the others keep the preference of the gateway
+    preference = getPreference(bwlimit, peaks[0])
+    uplinkLoad = 100. * peaks[0] / bwlimit
+    present = [s for s in range(1, segmentCount+1) if s in peaks]
+    shares = []
+    for counts in (peaks, clients or {}):
+        total = sum(counts.get(s, 0) for s in present)
+        if total > 0:
+            shares.append({s: counts.get(s, 0) / total for s in present})
+    preferences = {}
+    for s in range(1, segmentCount+1):
+        if s in present and len(shares) > 0:
+            relative = len(present) * sum(share[s] for share in shares) / len(shares)
+            preferences[s] = min(100, int(round(preference - uplinkLoad * max(0, relative - 1))))
+        else:
+            preferences[s] = min(100, preference)
+    return preferences
+
+
+def getPreference(bwlimit, peak_mbits=None):
+    if peak_mbits is None:
+        peak_mbits = getPeak()
+    preference = int((bwlimit-peak_mbits) / (bwlimit/100.))
     return preference
 
 
-def genData(segmentCount, preference=0):
+def genData(segmentCount, preference=0, segmentPreferences=None, load=None):
     data = {}
     data['version'] = '1'
     data['timestamp'] = int(time.time())
@@ -128,15 +176,82 @@ def genData(segmentCount, preference=0):
     segments = {}
     for s in range(1,segmentCount+1):
         segments[s] = {}
-        segments[s]['preference'] = preference
+        if segmentPreferences is not None:
+            segments[s]['preference'] = segmentPreferences[s]
+        else:
+            segments[s]['preference'] = preference
+        if load is not None and s in load:
+            segments[s]['load'] = load[s]
 
     data['segments'] = segments
     return data
 
 
+class PreferenceSmoother:
+    '''EWMA of the preference per segment, a new value is only published if it moved by at least hysteresis.'''
+    def __init__(self, alpha=0.3, hysteresis=2):
+        self.alpha = alpha
+        self.hysteresis = hysteresis
+        self.smoothed = {}
+        self.published = {}
+
+    def update(self, preferences):
+        for (s, preference) in preferences.items():
+            if s not in self.smoothed:
+                self.smoothed[s] = preference
+                self.published[s] = preference
+                continue
+            self.smoothed[s] = self.alpha * preference + (1 - self.alpha) * self.smoothed[s]
+            value = int(round(self.smoothed[s]))
+            if abs(value - self.published[s]) >= self.hysteresis:
+                self.published[s] = value
+        return dict(self.published)
+
+
+def genStatus(ring, bwlimit, uplink, segmentCount, segmentIface, backend='kernel'):
+    # returns (preference per segment, load per segment), (None, None) while the uplink has no peak yet
+    if backend == 'vnstat':
+        preference = getPreference(bwlimit)
+        return ({s: preference for s in range(1, segmentCount+1)}, None)
+
+    peaks = sampleTraffic(ring, time.time(), uplink, segmentCount, segmentIface)
+    if 0 not in peaks:
+        return (None, None)
+    load = {}
+    clients = {}
+    for s in range(1, segmentCount+1):
+        if s in peaks:
+            load[s] = {'tx': round(peaks[s], 3)}
+            count = countClients(segmentIface % (s))
+            if count is not None:
+                load[s]['clients'] = clients[s] = count
+    return (getSegmentPreferences(bwlimit, peaks, segmentCount, clients), load)
+
+
+def writeAtomic(output, content):
+    # readers either see the old or the new file, never a partial one
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)), prefix='.gwstatus')
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, output)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 def genJson(data,output):
-    with open(output,'w') as fp:
-        json.dump(data,fp ,indent=4,separators=(',', ': '))
+    content = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    writeAtomic(output, content)
+    # precompressed sidecar for gzip_static and similar
+    writeAtomic(output + '.gz', gzip.compress(content, mtime=data['timestamp']))
+
+
+def publish(data, output, table=None):
+    genJson(data, output)
+    if table is not None:
+        table.update({s: segment['preference'] for (s, segment) in data['segments'].items()}, data['timestamp'])
 
 
 #def main(argv=None): # IGNORE:C0111
@@ -147,7 +262,17 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--output', dest='output', action='store', required=True, help='output filename')
     parser.add_argument('-b', '--bwlimit', type=int, required=True, help='bwlimit in mbit/s')
     parser.add_argument('-s', '--segments', type=int, required=True, help='number of segments to handle')
-    parser.add_argument('-i', '--iface', type=str, required=True, help='interface for vnstat')
+    parser.add_argument('-i', '--iface', type=str, required=True, help='uplink interface to measure')
+    parser.add_argument('--segment-iface', type=str, default='bat%02i', help='interface name of a segment (default: bat%%02i)')
+    parser.add_argument('--backend', choices=['kernel', 'vnstat'], default='kernel', help='traffic source, kernel counters or vnstat (default: kernel)')
+    parser.add_argument('--ring', type=str, default='/var/tmp/gwstatus-traffic.ring', help='ring buffer file of the kernel backend')
+    parser.add_argument('--table', type=str, help='also publish the preferences in this memory mapped table for local readers')
+    parser.add_argument('--daemon', action='store_true', help='keep running and update the output every interval')
+    parser.add_argument('--interval', type=float, default=10, help='sampling interval of the daemon in seconds (default: 10)')
+    parser.add_argument('--alpha', type=float, default=0.3, help='EWMA weight of a new sample in daemon mode (default: 0.3)')
+    parser.add_argument('--hysteresis', type=int, default=2, help='minimum change of a published preference in daemon mode (default: 2)')
+    parser.add_argument('--profile', type=str, help='write a trace of the sampling and publishing to this file (Chrome trace format)')
+    parser.add_argument('--profile-cprofile', type=str, help='with --profile, also write cProfile statistics to this file')
     parser.add_argument('-d', '--debug', action='store_true', help='print debug/logging information')
 
     # Process arguments
@@ -158,6 +283,46 @@ if __name__ == '__main__':
     segmentCount = args.segments
     iface = args.iface
 
-    preference = getPreference(bwlimit)
-    data = genData(segmentCount, preference=preference)
-    genJson(data,args.output)
+    ring = None
+    if args.backend == 'kernel':
+        ring = TrafficRing(args.ring, series=segmentCount+1)
+    tracer = get_tracer(args.profile, args.profile_cprofile)
+    tracer.start()
+    table = None
+    if args.table is not None:
+        table = PreferenceTable(args.table, segments=segmentCount)
+    try:
+        if not args.daemon:
+            with tracer.span('sample'):
+                (preferences, load) = genStatus(ring, bwlimit, iface, segmentCount, args.segment_iface, args.backend)
+            if preferences is None:
+                # a fresh ring buffer: the previous document stays until there is a peak
+                logging.info("Not enough traffic samples in {} yet, {} is not updated".format(args.ring, args.output))
+                sys.exit(0)
+            with tracer.span('publish'):
+                publish(genData(segmentCount, segmentPreferences=preferences, load=load), args.output, table)
+            tracer.write()
+            sys.exit(0)
+
+        smoother = PreferenceSmoother(alpha=args.alpha, hysteresis=args.hysteresis)
+        nextRun = time.time()
+        while True:
+            try:
+                with tracer.span('sample'):
+                    (preferences, load) = genStatus(ring, bwlimit, iface, segmentCount, args.segment_iface, args.backend)
+                if preferences is None:
+                    logging.info("Not enough traffic samples in {} yet, {} is not updated".format(args.ring, args.output))
+                else:
+                    preferences = smoother.update(preferences)
+                    with tracer.span('publish'):
+                        publish(genData(segmentCount, segmentPreferences=preferences, load=load), args.output, table)
+                tracer.write()
+            except (OSError, CLIError, subprocess.CalledProcessError) as e:
+                logging.error("Could not update {}: {}".format(args.output, e))
+            nextRun += args.interval
+            time.sleep(max(0, nextRun - time.time()))
+    finally:
+        if ring is not None:
+            ring.close()
+        if table is not None:
+            table.close()
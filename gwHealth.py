@@ -0,0 +1,142 @@
+'''
+Per gateway circuit breaker for the gwstatus collection.
+
+After failureThreshold consecutive failures the circuit of a gateway opens
+and it is skipped without a request. Every retryInterval seconds an open
+gateway is probed with a request to its status URL, only a 2xx answer closes
+the circuit again. The state can be kept in a file between one-shot runs.
+The state is shared with the probe thread of daemon mode, every access holds
+the lock.
+'''
+
+import os
+import json
+import time
+import logging
+import http.client
+import tempfile
+import threading
+from urllib.parse import urlsplit
+
+
+class GwHealth:
+    def __init__(self, path=None, failureThreshold=3, retryInterval=60, probeTimeout=0.5):
+        self.path = path
+        self.failureThreshold = failureThreshold
+        self.retryInterval = retryInterval
+        self.probeTimeout = probeTimeout
+        self.state = {}  # gw -> {"failures": n, "openSince": timestamp or None, "lastProbe": timestamp}
+        self.stats = {"skipped": 0, "probed": 0, "recovered": 0, "opened": 0}
+        self.lock = threading.Lock()
+        self.probeThread = None
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                self.state = json.load(fp)
+        except FileNotFoundError:
+            self.state = {}
+        except Exception as e:
+            logging.warning("Could not load health state %s: %s" % (self.path, e))
+            self.state = {}
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps(self.state, separators=(',', ':'))
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix=".gwhealth")
+        with os.fdopen(fd, "w") as fp:
+            fp.write(data)
+        os.replace(tmp, self.path)
+
+    def reset_stats(self):
+        self.stats = {key: 0 for key in self.stats}
+
+    def is_open(self, gw):
+        with self.lock:
+            entry = self.state.get(gw)
+            return entry is not None and entry["openSince"] is not None
+
+    def get_open(self):
+        with self.lock:
+            return sorted(gw for (gw, entry) in self.state.items() if entry["openSince"] is not None)
+
+    def skip(self, gw):
+        # returns True if the gateway has to be skipped because its circuit is open
+        with self.lock:
+            entry = self.state.get(gw)
+            if entry is None or entry["openSince"] is None:
+                return False
+            openSince = entry["openSince"]
+            self.stats["skipped"] += 1
+        logging.info("Skipping %s, its circuit is open since %s" % (gw, time.ctime(openSince)))
+        return True
+
+    def record_success(self, gw):
+        with self.lock:
+            entry = self.state.pop(gw, None)
+            if entry is not None and entry["openSince"] is not None:
+                self.stats["recovered"] += 1
+                logging.warning("Closing circuit of %s, it is reachable again" % (gw))
+
+    def record_failure(self, gw):
+        now = time.time()
+        with self.lock:
+            entry = self.state.setdefault(gw, {"failures": 0, "openSince": None, "lastProbe": now})
+            entry["failures"] += 1
+            if entry["openSince"] is None and entry["failures"] >= self.failureThreshold:
+                entry["openSince"] = now
+                entry["lastProbe"] = now
+                self.stats["opened"] += 1
+                logging.warning("Opening circuit of %s after %i failures" % (gw, entry["failures"]))
+
+    def due_probes(self, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return sorted(gw for (gw, entry) in self.state.items()
+                          if entry["openSince"] is not None and now - entry["lastProbe"] >= self.retryInterval)
+
+    def start_probe(self, gw):
+        # the caller fetches the gateway itself and reports the result with record_success or record_failure
+        with self.lock:
+            if gw in self.state:
+                self.state[gw]["lastProbe"] = time.time()
+            self.stats["probed"] += 1
+
+    def probe(self, gw, url):
+        # a gateway that accepts connections but answers with an error is not back
+        self.start_probe(gw)
+        parts = urlsplit(url)
+        connection = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        conn = connection(parts.hostname, parts.port, timeout=self.probeTimeout)
+        try:
+            conn.request("GET", parts.path or "/")
+            status = conn.getresponse().status
+        except (OSError, http.client.HTTPException) as e:
+            logging.info("Probe of %s failed: %s" % (gw, e))
+            return False
+        finally:
+            conn.close()
+        if not 200 <= status < 300:
+            logging.info("Probe of %s failed with HTTP status %i" % (gw, status))
+            return False
+        self.record_success(gw)
+        return True
+
+    def start_background_probe(self, get_url, interval=None):
+        # daemon mode: probe open circuits from a thread instead of during the collection
+        if interval is None:
+            interval = self.retryInterval
+
+        def loop():
+            while True:
+                for gw in self.due_probes():
+                    self.probe(gw, get_url(gw))
+                time.sleep(interval)
+
+        self.probeThread = threading.Thread(target=loop, name="gwhealth-probe", daemon=True)
+        self.probeThread.start()
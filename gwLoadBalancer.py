@@ -15,33 +15,90 @@ import sys
 import time
 import argparse
 import logging
+import hmac
+import hashlib
+import tempfile
+import functools
+import dns.rcode
+from gwZone import GwZone, read_tsig_key
+from gwStatusCache import GwStatusCache
+from gwHealth import GwHealth
+from gwStability import GwStability
+from gwStatusMatrix import to_preference
+from gwPool import run_parallel
+from gwMetrics import BalancerResult, GwRunStats, start_metrics_server
+from gwTrace import NULL_TRACER, get_tracer
+from gwRecorder import GwRecorder
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.ERROR)
 
 
 class GwLoadBalancer:
+    batctlLinePattern = re.compile(" *02:[0-9]{2}:[0-9]{2}:[0-9]{2}:[0-9]([0-9]):[0-9]([0-9]).*")
+
     def __init__(self):
         self.use_backbone = True
         self.status = {}
         self.desiredGwPerSegment = 2
+        self.strategy = "segment"  # or "global", see StatusMatrix.plan_global
+        self.maxSegmentsPerGw = None
+        self.changeCost = 5  # preference points one DNS change has to gain with the global strategy
+        self.stability = GwStability()
+        self.result = BalancerResult()
+        self.runStats = GwRunStats()
+        self.textfile = None
+        self.metricsPort = None
+        self.tracer = NULL_TRACER
+        self.recorder = None
+        self.clock = time.time  # replaced by the replay to judge recorded documents at their time
         self.allGws = {}
         self.localhost = socket.gethostname()
         self.target = self.localhost
         self.segments = 32
+        self.batctl = "/usr/sbin/batctl"
+        self.batmanDebugfs = "/sys/kernel/debug/batman_adv"
+        self.maxParallelBatctl = 32
         self.maxAgeInSeconds = 60 * 15  # 15 minutes
+        self.fetchTimeout = 1
+        self.fetchDeadline = 5  # overall deadline for get_all_status
+        self.maxParallelFetches = 16
+        self.session = None
+        self.statusCache = GwStatusCache(maxAge=self.maxAgeInSeconds)
+        self.health = GwHealth()
+        self.interval = 30  # seconds between cycles in daemon mode
+        self.discoveryInterval = 600
+        self.lastDiscovery = None
+        self.dnsServer = "dns2.lihas.de"
+        self.dnsPort = 53
+        self.dnsZone = "gw.freifunk-stuttgart.de"
+        self.zoneCache = None
+        self.updateServer = None  # defaults to dnsServer
+        self.tsigKey = {}
+        self.updateRetries = 3
+        self.updateBackoff = 1.0
+        self.zone = GwZone(self.dnsZone)
+        self.clusterStatusFile = None  # aggregator: publish the validated status here
+        self.clusterStatusUrl = None  # consumer: take the status from the aggregator
+        self.clusterStatusMaxAge = 120
+        self.clusterKey = None
+
+    @property
+    def zoneData(self):
+        return self.zone.to_text()
+
+    @zoneData.setter
+    def zoneData(self, text):
+        self.zone = GwZone.from_text(text, self.dnsZone)
 
     def dns_zone_transfer(self):
-        cmd = "/usr/bin/dig -t axfr gw.freifunk-stuttgart.de @dns2.lihas.de"
-        self.zoneData = subprocess.check_output(cmd.split(" ")).decode("utf-8")
+        previous = self.zone if self.zone.serial is not None else None
+        self.zone = GwZone.sync(self.dnsServer, self.dnsZone, port=self.dnsPort, cacheFile=self.zoneCache,
+                                previous=previous)
 
     def get_available_gw_from_dns(self):
-        gw = self.allGws
-        p = re.compile('(gw0[0-9]n0[0-9])\.gw\.freifunk-stuttgart\.de')
-        for line in self.zoneData.split("\n"):
-            m = p.match(line)
-            if m != None:
-                gw[m.group(1)] = {}
-        self.allGws = gw
+        for gw in self.zone.get_gws():
+            self.allGws[gw] = {}
 
     def get_ip_from_gw_and_num(self, gw, num):
         return "10.191.255.%i%i" % (gw, num)
@@ -61,8 +118,7 @@ class GwLoadBalancer:
         return self.get_ip_from_gw_and_num(gw, num)
 
     def getGwNumFromBatctlLine(self, line):
-        p = re.compile(" *02:[0-9]{2}:[0-9]{2}:[0-9]{2}:[0-9]([0-9]):[0-9]([0-9]).*")
-        match = p.match(line)
+        match = self.batctlLinePattern.match(line)
         gw = int(match.group(1))
         num = int(match.group(2))
         return (gw, num)
@@ -74,23 +130,35 @@ class GwLoadBalancer:
     def parse_batctl_output(self, data):
         # example:
         #  02:00:38:01:07:01 (255) 02:00:35:01:07:01 [      bb01]: 64.0/64.0 MBit
-        for line in data.strip().split("\n"):
+        # the debugfs gateways file adds a header line and marks the selected gateway with "=>"
+        for line in data.split("\n"):
+            line = line.replace("=>", "  ", 1)
+            if self.batctlLinePattern.match(line) is None:
+                continue
             (gw, num) = self.getGwNumFromBatctlLine(line)
             gw = self.get_gw_from_gw_and_num(gw, num)
             self.allGws[gw] = {}
 
+    def get_batctl_gwl(self, segment):
+        seg = ("%i" % (segment)).zfill(2)
+        debugfs = os.path.join(self.batmanDebugfs, "bat%s" % (seg), "gateways")
+        if os.path.isfile(debugfs):
+            with open(debugfs, "r") as fp:
+                return fp.read()
+        if os.path.isfile(self.batctl):
+            cmd = "%s -m bat%s gwl -H -n" % (self.batctl, seg)
+            return subprocess.check_output(cmd.split(" ")).decode("utf-8")
+        with open("tests/batctl-gwl.txt", "r") as fp:
+            return fp.read()
+
     def get_available_gw_from_batctl(self):
-        output = ""
-        for i in range(1, self.segments + 1):
-            seg = ("%i" % (i)).zfill(2)
-            BATCTL = "/usr/sbin/batctl"
-            if os.path.isfile(BATCTL):
-                cmd = "%s -m bat%s gwl -H -n" % (BATCTL, seg)
-                output += subprocess.check_output(cmd.split(" ")).decode("utf-8")
-            else:
-                with open("tests/batctl-gwl.txt", "r") as fp:
-                    output += fp.read()
-        self.parse_batctl_output(output)
+        # all segments are queried at once, the output is parsed per segment in segment order
+        task = self.get_batctl_gwl
+        if self.tracer.enabled:
+            task = lambda segment: self.tracer.call("batctl bat%02i" % (segment), self.get_batctl_gwl, segment)
+        with ThreadPoolExecutor(max_workers=min(self.maxParallelBatctl, self.segments)) as executor:
+            for output in executor.map(task, range(1, self.segments + 1)):
+                self.parse_batctl_output(output)
         self.add_self_to_gws()
 
     def add_self_to_gws(self):
@@ -104,33 +172,55 @@ class GwLoadBalancer:
             fqdn = "%s.gw.freifunk-stuttgart.de" % (gw)
         return 'http://%s/data/gwstatus.json' % (fqdn)
 
+    def get_session(self):
+        # one pooled session, so keep-alive connections to the gateways are reused
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=128, pool_maxsize=self.maxParallelFetches)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+        return self.session
+
     def get_gw_status(self, gw):
         url = self.get_gw_status_url(gw)
         try:
-            r = requests.get(url, timeout=1)
-        except Exception as e:
+            (r, data) = self.statusCache.get(self.get_session(), url, timeout=self.fetchTimeout)
+        except requests.RequestException as e:
+            self.health.record_failure(gw)
+            return {}
+        except ValueError as e:
+            # a malformed document fails this gateway only
+            logging.warning(e)
+            logging.warning("Error while loading json from %s" % (gw))
+            self.health.record_failure(gw)
             return {}
-        if r.status_code == 404 or r.status_code == 503:
+        if data is not None and not isinstance(data, dict):
+            logging.warning("GW %s returns a document that is no object" % (gw))
+            self.health.record_failure(gw)
+            return {}
+        if r.status_code >= 400:
+            # reachable but not serving its status, e.g. 503 while it is overloaded
             logging.info("Could not get Data for %s" % (gw))
+            self.health.record_failure(gw)
             return {}
-        text = r.text
-        if len(text) == 0:
-            logging.warning("GW %s returns empty document" % (gw))
+        self.health.record_success(gw)
+        if data is None:
+            logging.warning("GW %s returns empty document with code %i" % (gw, r.status_code))
             return {}
-        try:
-            data = json.loads(text)
-        except Exception as e:
-            logging.warning(e)
-            logging.warning("Error while loading json from %s with code %i" % (gw, r.status_code))
-            raise
         return data
 
     def validate_gw_status(self, gw, status):
-        local_timestamp = time.time()
+        if not self.is_well_formed(status):
+            logging.warning("Rejecting gwstatus from %s as it is malformed!" % (gw))
+            self.runStats.reject(gw, "malformed")
+            return False
+        local_timestamp = self.clock()
         result = True
+        stale = False
         if (local_timestamp - status["timestamp"]) > self.maxAgeInSeconds:
             logging.warning("Rejecting gwstatus from %s as it is too old!" % (gw))
             result = False
+            stale = True
         for (segment, data) in status["segments"].items():
             dnsactive = data["dnsactive"]
             active = self.get_active_gw_per_segment_from_dns(segment=segment)
@@ -141,11 +231,122 @@ class GwLoadBalancer:
             if dnsactive == 0 and gw in active:
                 logging.warning("DNS status for %s in segment %s: Reports dnsactive==0 but is active!" % (gw, segment))
                 result = False
+        if stale:
+            self.runStats.reject(gw, "stale")
+        elif not result:
+            self.runStats.reject(gw, "inconsistent")
         return result
 
+    def is_well_formed(self, status):
+        # the segment data has to fit the arrays of StatusMatrix, a single bad value would fail the whole cycle
+        if not isinstance(status.get("segments"), dict):
+            return False
+        for data in status["segments"].values():
+            if not isinstance(data, dict) or to_preference(data.get("preference")) is None:
+                return False
+            if data.get("dnsactive") not in (0, 1) or isinstance(data.get("dnsactive"), float):
+                return False
+        return True
+
+    def probe_gw_status(self, gw):
+        # the fetch itself is the probe, only a document closes the circuit
+        self.health.start_probe(gw)
+        return self.get_gw_status(gw)
+
     def get_all_status(self):
+        self.health.reset_stats()
+        tasks = {}
+        dueProbes = self.health.due_probes() if self.health.probeThread is None else []
         for gw in self.allGws.keys():
-            self.allGws[gw] = self.get_gw_status(gw)
+            if not self.health.is_open(gw):
+                tasks[gw] = self.get_gw_status
+            elif gw in dueProbes:
+                tasks[gw] = self.probe_gw_status
+            else:
+                self.health.skip(gw)
+                self.allGws[gw] = {}
+        if len(tasks) > 0:
+            self.get_session()
+            if self.tracer.enabled:
+                calls = {gw: functools.partial(self.tracer.call, "fetch %s" % (gw), task, gw) for (gw, task) in tasks.items()}
+            else:
+                calls = {gw: functools.partial(task, gw) for (gw, task) in tasks.items()}
+            (done, failed, notDone) = run_parallel(calls, self.maxParallelFetches, self.fetchDeadline, "gwfetch")
+            self.allGws.update(done)
+            for (gw, e) in failed.items():
+                logging.warning("Fetching status of %s failed: %s" % (gw, e))
+                self.health.record_failure(gw)
+                self.allGws[gw] = {}
+            for gw in notDone:
+                logging.warning("Fetching status of %s did not finish within %is" % (gw, self.fetchDeadline))
+                self.health.record_failure(gw)
+                self.allGws[gw] = {}
+        stats = self.health.stats
+        if stats["skipped"] + stats["probed"] > 0:
+            logging.info("Circuit breaker: %i skipped, %i probed, %i recovered, %i opened" %
+                         (stats["skipped"], stats["probed"], stats["recovered"], stats["opened"]))
+        self.statusCache.save()
+        self.health.save()
+
+    def sign_cluster_status(self, doc):
+        data = json.dumps({k: v for (k, v) in doc.items() if k != "signature"}, sort_keys=True, separators=(',', ':'))
+        return hmac.new(self.clusterKey, data.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def gen_cluster_status(self):
+        doc = {
+            "version": "1",
+            "timestamp": int(time.time()),
+            "serial": self.zone.serial,
+            "status": self.status,
+        }
+        if self.clusterKey is not None:
+            doc["signature"] = self.sign_cluster_status(doc)
+        return doc
+
+    def publish_cluster_status(self, output):
+        # written to a temporary file and renamed, so the web server never serves a partial document
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)), prefix=".clusterstatus")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(self.gen_cluster_status(), fp, separators=(',', ':'))
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, output)
+
+    def validate_cluster_status(self, doc):
+        # the document replaces the status of all gateways, it is only trusted when signed
+        if self.clusterKey is None:
+            logging.warning("Rejecting cluster status, no cluster key to verify it")
+            return False
+        if not hmac.compare_digest(str(doc.get("signature", "")), self.sign_cluster_status(doc)):
+            logging.warning("Rejecting cluster status with wrong signature")
+            return False
+        if time.time() - doc["timestamp"] > self.clusterStatusMaxAge:
+            logging.warning("Cluster status is stale, polling the gateways")
+            return False
+        if doc["serial"] != self.zone.serial:
+            logging.info("Cluster status is based on zone serial %s instead of %s, polling the gateways" %
+                         (doc["serial"], self.zone.serial))
+            return False
+        return True
+
+    def get_cluster_status(self):
+        if self.clusterStatusUrl is None:
+            return False
+        try:
+            (r, doc) = self.statusCache.get(self.get_session(), self.clusterStatusUrl, timeout=self.fetchTimeout)
+            r.raise_for_status()
+            if doc is None:
+                raise ValueError("empty document")
+        except Exception as e:
+            logging.warning("Could not get cluster status from %s: %s" % (self.clusterStatusUrl, e))
+            return False
+        try:
+            if not self.validate_cluster_status(doc):
+                return False
+        except (KeyError, TypeError) as e:
+            logging.warning("Rejecting malformed cluster status: %s" % (e))
+            return False
+        self.status = doc["status"]
+        return True
 
     def get_status(self):
         for (gw, gwstatus) in self.allGws.items():
@@ -154,10 +355,14 @@ class GwLoadBalancer:
             if not self.validate_gw_status(gw, gwstatus):
                 gwstatus = {}
                 continue
-            for segment in gwstatus["segments"]:
+            for (segment, data) in gwstatus["segments"].items():
                 if segment not in self.status:
                     self.status[segment] = {}
-                self.status[segment][gw] = gwstatus["segments"][segment]
+                preference = to_preference(data["preference"])
+                if preference != data["preference"] or type(data["preference"]) is not int:
+                    # e.g. 50.5 or beyond the 32 bit range
+                    data = dict(data, preference=preference)
+                self.status[segment][gw] = data
 
     def get_all_gws_in_segment(self, segment):
         segmentstatus = self.status[segment]
@@ -187,67 +392,57 @@ class GwLoadBalancer:
         return sorted(gwsThatHaveNotToBeInDns)
 
     def get_result(self):
-        result = ""
+        self.result = BalancerResult()
         self.commands_all = []
         self.commands_local = []
+        self.changes_all = []
+        self.changes_local = []
         if self.target != None:
             target = self.target
         else:
             target = self.localhost
+        if self.strategy == "global":
+            plan = self.stability.plan(self.status, lambda matrix: matrix.plan_global(
+                self.desiredGwPerSegment, self.maxSegmentsPerGw, self.changeCost), self.clock())
+        else:
+            plan = self.stability.plan(self.status, lambda matrix: matrix.plan(self.desiredGwPerSegment), self.clock())
+        self.runStats.record_stability(self.stability.stats)
+        if self.stability.is_enabled():
+            logging.info("Hysteresis avoided %(flipsAvoided)i DNS changes, %(held)i removals held back" % (
+                self.stability.stats))
+            self.stability.save()
         for segment in self.status:
-            gwsThatHaveToBeAddedToDns = self.get_gws_that_have_to_be_added_to_dns(segment)
-            getGwsThatHaveToRemovedFromDns = self.get_gws_that_have_to_removed_from_dns(segment)
+            (best, gwsThatHaveToBeAddedToDns, getGwsThatHaveToRemovedFromDns) = plan[segment]
+            if len(best) < min(self.desiredGwPerSegment, len(self.status[segment])):
+                # only the limit of segments per gateway leaves a segment short
+                logging.warning("Segment %s gets only %i of %i gateways" % (
+                    segment, len(best), self.desiredGwPerSegment))
+                self.runStats.current["short"] += 1
             if len(gwsThatHaveToBeAddedToDns) > 0:
-                result += "GWs that have to be added in Segement %s to dns: %s\n" % (
-                    segment, " ".join(gwsThatHaveToBeAddedToDns))
+                self.result.add(segment, gwsThatHaveToBeAddedToDns)
                 for gw in gwsThatHaveToBeAddedToDns:
-                    command = self.gen_nsupdate(gw, segment, "add")
-                    self.commands_all += command
-                    if gw == self.target:
-                        self.commands_local += command
+                    self.add_changes(gw, segment, "add")
             if len(getGwsThatHaveToRemovedFromDns) > 0 and len(gwsThatHaveToBeAddedToDns) == 0:
-                result += "GWs that have to be removed in Segement %s from dns: %s\n" % (
-                    segment, " ".join(getGwsThatHaveToRemovedFromDns))
+                self.result.remove(segment, getGwsThatHaveToRemovedFromDns)
                 for gw in getGwsThatHaveToRemovedFromDns:
-                    command = self.gen_nsupdate(gw, segment, "delete")
-                    self.commands_all += command
-                    if gw == self.target:
-                        self.commands_local += command
-
-            if len(result) == 0:
-                result = "All is fine!"
-        return result
+                    self.add_changes(gw, segment, "delete")
+        return self.result.report()
+
+    def add_changes(self, gw, segment, cmd):
+        changes = self.gen_changes(gw, segment, cmd)
+        command = self.format_nsupdate(changes)
+        self.changes_all += changes
+        self.commands_all += command
+        self.runStats.record_changes(segment, cmd, len(changes))
+        if gw == self.target:
+            self.changes_local += changes
+            self.commands_local += command
 
     def get_ip_to_gw_lookup(self):
-        self.reverseDnsEntries = {}
-        p1 = re.compile('(gw0[0-9]n0[0-9])\.gw\.freifunk-stuttgart\.de\. [0-9]+ IN A*\t(.*)')
-        for line in self.zoneData.split("\n"):
-            m = p1.match(line)
-            if m != None:
-                hostname = m.group(1)
-                ip = m.group(2)
-                self.reverseDnsEntries[ip] = hostname
+        self.reverseDnsEntries = dict(self.zone.ipToHost)
 
     def get_active_gw_per_segment_from_dns(self, segment):
-        gws = []
-        zone = self.zoneData
-        segments = {}
-        p = re.compile('(gw0[0-9])s([0-9]{2})\.gw\.freifunk-stuttgart\.de\. [0-9]+ IN A*\t(.*)')
-        for line in zone.split("\n"):
-            m = p.match(line)
-            if m != None:
-                s = str(int(m.group(2)))
-                gwCluster = m.group(1)
-                ip = m.group(3)
-                if s == segment and s != "99":
-                    try:
-                        gw = self.reverseDnsEntries[ip]
-                    except Exception as e:
-                        logging.error("NO entry for GWCluster %s and IP %s" % (gwCluster, ip))
-                        raise
-                    if gw not in gws:
-                        gws.append(gw)
-        return gws
+        return self.zone.get_active_gws(segment)
 
     def validate_status(self):
         result = True
@@ -256,48 +451,138 @@ class GwLoadBalancer:
             activeGwDns = set(self.get_active_gw_per_segment_from_dns(segment=segment))
             if activeGw != activeGwDns:
                 logging.warning("Segment %s setup is not as expected: %s vs. %s" % (segment, activeGw, activeGwDns))
+                self.runStats.current["mismatched"] += 1
             if not activeGw.issubset(activeGwDns):
                 result = False
+                self.runStats.current["inconsistent"] += 1
                 logging.error("Segment %s setup is wrong: %s vs. %s" % (segment, activeGw, activeGwDns))
         return result
 
     def get_record_for_gw(self, gw, record):
-        p = re.compile('(gw0[0-9]n0[0-9])\.gw\.freifunk-stuttgart\.de\. [0-9]+ IN %s\t(.*)' % (record))
-        for line in self.zoneData.split("\n"):
-            m = p.match(line)
-            if m != None:
-                hostname = m.group(1)
-                ip = m.group(2)
-                if hostname == gw:
-                    return ip
-        return None
+        return self.zone.get_record(gw, record)
 
-    def gen_nsupdate(self, gw, segment, cmd):
-        lines = []
+    def gen_changes(self, gw, segment, cmd):
+        changes = []
         for record_type in ("A", "AAAA"):
             ip = self.get_record_for_gw(gw, record_type)
             if ip != None:
                 s = "%ss%s" % (gw[0:4], segment.zfill(2))
-                line = "update %s %s.gw.freifunk-stuttgart.de. 300 %s %s" % (cmd, s, record_type, ip)
-                lines.append(line)
-        return lines
-
-    def run(self):
-        self.dns_zone_transfer()
-        self.get_ip_to_gw_lookup()
-        localhost = socket.gethostname()
-        if localhost.startswith("gw"):
+                changes.append((cmd, s, 300, record_type, ip))
+        return changes
+
+    def format_nsupdate(self, changes):
+        return ["update %s %s.%s. %i %s %s" % (cmd, name, self.dnsZone, ttl, record_type, ip)
+                for (cmd, name, ttl, record_type, ip) in changes]
+
+    def gen_nsupdate(self, gw, segment, cmd):
+        return self.format_nsupdate(self.gen_changes(gw, segment, cmd))
+
+    def send_update(self):
+        if len(self.changes_local) == 0:
+            logging.info("No DNS update to send")
+            return dns.rcode.NOERROR
+        server = self.updateServer if self.updateServer is not None else self.dnsServer
+        rcode = self.zone.update(server, self.changes_local, port=self.dnsPort, retries=self.updateRetries,
+                                 backoff=self.updateBackoff, **self.tsigKey)
+        if rcode == dns.rcode.NOERROR:
+            logging.info("DNS update with %i changes applied" % (len(self.changes_local)))
+        elif rcode in (dns.rcode.YXRRSET, dns.rcode.NXRRSET):
+            logging.warning("DNS update rejected by prerequisites, the zone was changed concurrently: %s" %
+                            (dns.rcode.to_text(rcode)))
+        else:
+            logging.error("DNS update failed: %s" % (dns.rcode.to_text(rcode)))
+        return rcode
+
+    def discover_gws(self):
+        self.allGws = {}
+        if self.localhost.startswith("gw"):
             self.get_available_gw_from_batctl()
         else:
             self.use_backbone = False
             self.get_available_gw_from_dns()
-        self.get_all_status()
-        self.get_status()
-        if not self.validate_status():
-            logging.error("Status is not consitent, bye!")
-            sys.exit(1)
-        report = self.get_result()
+        self.lastDiscovery = time.time()
+
+    def run_cycle(self):
+        # one balancing pass, the zone, gateway list and http session are kept for the next one
+        with self.runStats.phase("zone"):
+            self.dns_zone_transfer()
+            self.get_ip_to_gw_lookup()
+        with self.runStats.phase("discovery"):
+            if self.lastDiscovery is None or time.time() - self.lastDiscovery >= self.discoveryInterval:
+                self.discover_gws()
+            else:
+                self.allGws = {gw: {} for gw in self.allGws}
+        self.status = {}
+        with self.runStats.phase("fetch"):
+            fromCluster = self.get_cluster_status()
+            if not fromCluster:
+                self.get_all_status()
+                self.runStats.count_gateways(self.allGws, self.health.stats)
+                if self.recorder is not None:
+                    self.recorder.record(self.zone, self.allGws)
+        with self.runStats.phase("validate"):
+            if not fromCluster:
+                self.get_status()
+            if not self.validate_status():
+                return False
+        if self.clusterStatusFile is not None and not fromCluster:
+            self.publish_cluster_status(self.clusterStatusFile)
+        with self.runStats.phase("plan"):
+            report = self.get_result()
         logging.info(report)
+        return True
+
+    def set_tracer(self, tracer):
+        self.tracer = tracer
+        self.runStats.tracer = tracer
+
+    def finish_cycle(self, result):
+        self.runStats.finish_cycle(result)
+        self.tracer.write()
+        if self.textfile is not None:
+            try:
+                self.runStats.write_textfile(self.textfile)
+            except OSError as e:
+                logging.error("Could not write metrics to %s: %s" % (self.textfile, e))
+
+    def run(self, output=None, update=False):
+        # one-shot mode, returns the exit code
+        if not self.run_cycle():
+            logging.error("Status is not consitent, bye!")
+            self.finish_cycle("inconsistent")
+            return 1
+        if not self.publish(output, update):
+            self.finish_cycle("update_failed")
+            return 2
+        self.finish_cycle("ok")
+        return 0
+
+    def publish(self, output=None, update=False):
+        with self.runStats.phase("publish"):
+            if output != None:
+                self.save_result(output)
+            if update:
+                return self.send_update() == dns.rcode.NOERROR
+            return True
+
+    def run_daemon(self, output=None, update=False):
+        self.health.start_background_probe(self.get_gw_status_url)
+        if self.metricsPort is not None:
+            start_metrics_server(self.runStats, self.metricsPort)
+        while True:
+            start = time.time()
+            try:
+                if not self.run_cycle():
+                    logging.error("Status is not consistent, skipping this cycle")
+                    self.finish_cycle("inconsistent")
+                elif not self.publish(output, update):
+                    self.finish_cycle("update_failed")
+                else:
+                    self.finish_cycle("ok")
+            except Exception as e:
+                logging.exception("Balancing cycle failed: %s" % (e))
+                self.finish_cycle("error")
+            time.sleep(max(0, self.interval - (time.time() - start)))
 
     def save_result(self, output):
         with open(output, "w") as fp:
@@ -316,13 +601,98 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--output", dest="output", action="store", required=False, help="output filename")
     parser.add_argument("-t", "--target", dest="target", action="store", required=False, help="generate output for")
     parser.add_argument("-v", "--verbose", action="store_true", help="print warning/info information")
+    parser.add_argument("--dns-server", dest="dnsServer", action="store", required=False,
+                        help="DNS server to transfer the zone from")
+    parser.add_argument("--dns-zone", dest="dnsZone", action="store", required=False, help="zone of the gateways")
+    parser.add_argument("-u", "--update", action="store_true", help="send the changes as DNS update")
+    parser.add_argument("--update-server", dest="updateServer", action="store", required=False,
+                        help="DNS server to send the update to, defaults to --dns-server")
+    parser.add_argument("-k", "--tsig-key", dest="tsigKey", action="store", required=False,
+                        help="TSIG key file for the DNS update (as for nsupdate -k)")
+    parser.add_argument("--strategy", choices=["segment", "global"], required=False,
+                        help="choose the best gateways per segment (default) or for all segments together")
+    parser.add_argument("--max-segments-per-gw", dest="maxSegmentsPerGw", type=int, required=False,
+                        help="hard limit of segments a gateway is chosen for by the global strategy, "
+                             "segments may be left short")
+    parser.add_argument("--change-cost", dest="changeCost", type=int, required=False,
+                        help="preference points a DNS change has to gain with the global strategy (default: 5)")
+    parser.add_argument("--margin", type=int, required=False,
+                        help="preference bonus of gateways already in DNS before they are replaced (default: 0)")
+    parser.add_argument("--min-dwell", dest="minDwell", type=int, required=False,
+                        help="seconds a gateway stays in DNS at least before it is removed (default: 0)")
+    parser.add_argument("--stability-state", dest="stabilityState", action="store", required=False,
+                        help="file keeping the time gateways entered DNS between runs")
+    parser.add_argument("--metrics-port", dest="metricsPort", type=int, required=False,
+                        help="daemon mode: serve Prometheus metrics of the balancing cycles on this port")
+    parser.add_argument("--textfile", action="store", required=False,
+                        help="write the metrics of the run to this file for the node exporter textfile collector")
+    parser.add_argument("--profile", action="store", required=False,
+                        help="write a trace of the phases and per gateway calls to this file (Chrome trace format)")
+    parser.add_argument("--profile-cprofile", dest="profileCprofile", action="store", required=False,
+                        help="with --profile, also write cProfile statistics of the main thread to this file")
+    parser.add_argument("--record", action="store", required=False,
+                        help="append the zone, gateways and status documents of every cycle to this file for gwReplay.py")
+    parser.add_argument("-d", "--daemon", action="store_true", help="keep running and balance every --interval seconds")
+    parser.add_argument("--interval", type=int, required=False, help="seconds between balancing cycles in daemon mode")
+    parser.add_argument("--discovery-interval", dest="discoveryInterval", type=int, required=False,
+                        help="seconds between gateway discoveries in daemon mode")
+    parser.add_argument("--publish-cluster-status", dest="clusterStatusFile", action="store", required=False,
+                        help="aggregator: write the validated status of all gateways to this file")
+    parser.add_argument("--cluster-status-url", dest="clusterStatusUrl", action="store", required=False,
+                        help="use the status published by an aggregator, poll the gateways only if it is stale "
+                             "(needs --cluster-key)")
+    parser.add_argument("--cluster-key", dest="clusterKey", action="store", required=False,
+                        help="file with the shared secret to sign and verify the cluster status")
+    parser.add_argument("--status-cache", dest="statusCache", action="store", required=False,
+                        help="file to keep the fetched gwstatus documents in for conditional requests")
+    parser.add_argument("--health-state", dest="healthState", action="store", required=False,
+                        help="file to keep the circuit breaker state of the gateways in between runs")
+    parser.add_argument("--zone-cache", dest="zoneCache", action="store", required=False,
+                        help="file to keep the zone in between runs, updated by SOA serial and IXFR")
     args = parser.parse_args()
+    if args.clusterStatusUrl != None and args.clusterKey == None:
+        parser.error("--cluster-status-url needs --cluster-key, an unsigned cluster status is not trusted")
 
     lb = GwLoadBalancer()
     if args.verbose:
-        logging.basicConfig(level=logging.INFO)
+        # replaces the ERROR level configured on import
+        logging.basicConfig(level=logging.INFO, force=True)
     if args.target != None:
         lb.target = args.target
-    lb.run()
-    if args.output != None:
-        lb.save_result(args.output)
+    if args.dnsServer != None:
+        lb.dnsServer = args.dnsServer
+    if args.dnsZone != None:
+        lb.dnsZone = args.dnsZone
+    lb.zoneCache = args.zoneCache
+    if args.healthState != None:
+        lb.health = GwHealth(args.healthState)
+    if args.statusCache != None:
+        lb.statusCache = GwStatusCache(args.statusCache, lb.maxAgeInSeconds)
+    lb.updateServer = args.updateServer
+    if args.tsigKey != None:
+        lb.tsigKey = read_tsig_key(args.tsigKey)
+    lb.clusterStatusFile = args.clusterStatusFile
+    lb.clusterStatusUrl = args.clusterStatusUrl
+    if args.clusterKey != None:
+        with open(args.clusterKey, "rb") as fp:
+            lb.clusterKey = fp.read().strip()
+    lb.stability = GwStability(args.stabilityState, margin=args.margin or 0, minDwell=args.minDwell or 0)
+    if args.strategy != None:
+        lb.strategy = args.strategy
+    lb.maxSegmentsPerGw = args.maxSegmentsPerGw
+    if args.changeCost is not None:
+        lb.changeCost = args.changeCost
+    if args.interval != None:
+        lb.interval = args.interval
+    if args.discoveryInterval != None:
+        lb.discoveryInterval = args.discoveryInterval
+    lb.metricsPort = args.metricsPort
+    if args.record != None:
+        lb.recorder = GwRecorder(args.record)
+    lb.set_tracer(get_tracer(args.profile, args.profileCprofile))
+    lb.tracer.start()
+    lb.textfile = args.textfile
+    if args.daemon:
+        lb.run_daemon(args.output, args.update)
+    else:
+        sys.exit(lb.run(args.output, args.update))
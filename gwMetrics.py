@@ -0,0 +1,202 @@
+'''
+Result and run statistics of the load balancer.
+
+BalancerResult holds the decisions of get_result per segment, the report
+text is generated from it. GwRunStats collects the duration of the phases
+of a balancing cycle and the counts of changed records, rejected gateways
+and inconsistent segments. They are exposed as Prometheus metrics in daemon
+mode (if prometheus_client is installed) or written as textfile for the
+node exporter in cron mode.
+'''
+
+import os
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from gwTrace import NULL_TRACER
+
+try:
+    import prometheus_client
+    from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+except ImportError:
+    prometheus_client = None
+
+
+class BalancerResult:
+    def __init__(self):
+        self.added = {}    # segment -> gws that have to be added to dns
+        self.removed = {}  # segment -> gws that have to be removed from dns
+        self.segments = []  # segments with changes, in the order of the decisions
+
+    def add(self, segment, gws):
+        self.added[segment] = gws
+        if segment not in self.segments:
+            self.segments.append(segment)
+
+    def remove(self, segment, gws):
+        self.removed[segment] = gws
+        if segment not in self.segments:
+            self.segments.append(segment)
+
+    def report(self):
+        result = ""
+        for segment in self.segments:
+            if segment in self.added:
+                result += "GWs that have to be added in Segement %s to dns: %s\n" % (
+                    segment, " ".join(self.added[segment]))
+            if segment in self.removed:
+                result += "GWs that have to be removed in Segement %s from dns: %s\n" % (
+                    segment, " ".join(self.removed[segment]))
+        if len(result) == 0:
+            result = "All is fine!"
+        return result
+
+
+class GwRunStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = self.new_cycle()
+        self.last = None
+        self.cycles = {}   # result -> count
+        self.records = {}  # action -> count
+        self.tracer = NULL_TRACER
+
+    def new_cycle(self):
+        return {"phases": {}, "records": {}, "rejected": {}, "gateways": {}, "breaker": {}, "inconsistent": 0,
+                "mismatched": 0, "short": 0, "stability": {"flipsAvoided": 0, "held": 0}}
+
+    def start_cycle(self):
+        self.current = self.new_cycle()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            with self.tracer.span(name):
+                yield
+        finally:
+            self.current["phases"][name] = self.current["phases"].get(name, 0) + time.monotonic() - start
+
+    def record_changes(self, segment, action, count):
+        key = (segment, action)
+        self.current["records"][key] = self.current["records"].get(key, 0) + count
+
+    def record_stability(self, stats):
+        # GwStability.stats of the plan: DNS changes avoided by margin and dwell time, removals held back by dwell time
+        self.current["stability"] = dict(stats)
+
+    def reject(self, gw, reason):
+        self.current["rejected"][reason] = self.current["rejected"].get(reason, 0) + 1
+
+    def count_gateways(self, allGws, health=None):
+        # health: GwHealth.stats of the fetch, the gateways skipped, probed, recovered and opened by the circuit breaker
+        fetched = len([gw for (gw, status) in allGws.items() if status != {}])
+        self.current["gateways"] = {"fetched": fetched, "failed": len(allGws) - fetched}
+        if health is not None:
+            self.current["breaker"] = dict(health)
+
+    def finish_cycle(self, result):
+        with self.lock:
+            self.current["result"] = result
+            self.current["timestamp"] = time.time()
+            self.last = self.current
+            self.cycles[result] = self.cycles.get(result, 0) + 1
+            for ((segment, action), count) in self.current["records"].items():
+                self.records[action] = self.records.get(action, 0) + count
+        self.current = self.new_cycle()
+
+    def get_samples(self):
+        # [(name, type, help, [(labels, value)])] of the last finished cycle and the totals
+        with self.lock:
+            last = self.last
+            samples = [
+                ("gw_loadbalancer_cycles", "counter", "Balancing cycles by result.",
+                 [({"result": result}, count) for (result, count) in sorted(self.cycles.items())]),
+                ("gw_loadbalancer_records_changed", "counter", "DNS records added or deleted.",
+                 [({"action": action}, count) for (action, count) in sorted(self.records.items())]),
+            ]
+        if last is None:
+            return samples
+        samples += [
+            ("gw_loadbalancer_last_run_timestamp_seconds", "gauge", "Time the last balancing cycle finished.",
+             [({}, last["timestamp"])]),
+            ("gw_loadbalancer_last_run_success", "gauge", "1 if the last balancing cycle was consistent.",
+             [({}, 1 if last["result"] == "ok" else 0)]),
+            ("gw_loadbalancer_phase_duration_seconds", "gauge", "Duration of the phases of the last cycle.",
+             [({"phase": phase}, duration) for (phase, duration) in sorted(last["phases"].items())]),
+            ("gw_loadbalancer_segment_records_changed", "gauge", "DNS records added or deleted per segment in the last cycle.",
+             [({"segment": segment, "action": action}, count)
+              for ((segment, action), count) in sorted(last["records"].items())]),
+            ("gw_loadbalancer_gateways_rejected", "gauge", "Gateway status documents rejected in the last cycle.",
+             [({"reason": reason}, count) for (reason, count) in sorted(last["rejected"].items())]),
+            ("gw_loadbalancer_gateways", "gauge", "Gateways by the result of fetching their status in the last cycle.",
+             [({"state": state}, count) for (state, count) in sorted(last["gateways"].items())]),
+            ("gw_loadbalancer_circuit_breaker_gateways", "gauge",
+             "Gateways skipped, probed, recovered and opened by the circuit breaker in the last cycle.",
+             [({"event": event}, count) for (event, count) in sorted(last["breaker"].items())]),
+            ("gw_loadbalancer_dns_changes_avoided", "gauge",
+             "DNS changes avoided by the hysteresis margin and the minimum dwell time in the last cycle.",
+             [({}, last["stability"]["flipsAvoided"])]),
+            ("gw_loadbalancer_dns_removals_held", "gauge",
+             "Gateways kept in DNS for the minimum dwell time in the last cycle.",
+             [({}, last["stability"]["held"])]),
+            ("gw_loadbalancer_segments_inconsistent", "gauge",
+             "Segments with gateways reporting dnsactive without being in DNS in the last cycle.",
+             [({}, last["inconsistent"])]),
+            ("gw_loadbalancer_segments_mismatched", "gauge",
+             "Segments where the reported dnsactive does not match DNS in the last cycle.",
+             [({}, last["mismatched"])]),
+            ("gw_loadbalancer_segments_short", "gauge",
+             "Segments left with fewer gateways than desired by the limit of segments per gateway in the last cycle.",
+             [({}, last["short"])]),
+        ]
+        return samples
+
+    def format_textfile(self, counters=False):
+        # node exporter textfile format; counters of a one-shot run only count that run, they are left out
+        lines = []
+        for (name, kind, description, values) in self.get_samples():
+            if kind == "counter" and not counters:
+                continue
+            if kind == "counter":
+                name += "_total"
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (labels, value) in values:
+                label = ",".join('%s="%s"' % (k, v) for (k, v) in sorted(labels.items()))
+                lines.append("%s%s %s" % (name, "{%s}" % (label) if label else "", repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".gwloadbalancer")
+        with os.fdopen(fd, "w") as fp:
+            fp.write(self.format_textfile())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+
+class GwRunStatsCollector:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def collect(self):
+        for (name, kind, description, values) in self.stats.get_samples():
+            labels = sorted(values[0][0]) if len(values) > 0 else []
+            if kind == "counter":
+                family = CounterMetricFamily(name, description, labels=labels)
+            else:
+                family = GaugeMetricFamily(name, description, labels=labels)
+            for (sampleLabels, value) in values:
+                family.add_metric([str(sampleLabels[label]) for label in labels], value)
+            yield family
+
+
+def start_metrics_server(stats, port, addr=""):
+    if prometheus_client is None:
+        raise RuntimeError("prometheus_client is not installed, metrics are not available")
+    registry = prometheus_client.CollectorRegistry()
+    registry.register(GwRunStatsCollector(stats))
+    prometheus_client.start_http_server(port, addr, registry)
+    return registry
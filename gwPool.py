@@ -0,0 +1,56 @@
+'''
+Parallel calls with an overall deadline, on daemon threads.
+
+A ThreadPoolExecutor joins its worker threads at interpreter exit, so a
+gateway that hangs past the deadline would still delay the end of a one-shot
+run. run_parallel() abandons the calls that did not finish in time instead:
+their threads are daemon threads, they take no further tasks and their late
+results are dropped.
+'''
+
+import queue
+import threading
+import time
+
+
+def run_parallel(tasks, maxWorkers, deadline, name="gwpool"):
+    # tasks: key -> callable without arguments
+    # returns ({key: result}, {key: exception}, [keys not finished within deadline seconds])
+    pending = queue.SimpleQueue()
+    for item in tasks.items():
+        pending.put(item)
+    results = {}
+    errors = {}
+    abandoned = threading.Event()
+    finished = threading.Condition()
+
+    def worker():
+        while not abandoned.is_set():
+            try:
+                (key, task) = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                (value, error) = (task(), None)
+            except Exception as e:
+                (value, error) = (None, e)
+            with finished:
+                if error is None:
+                    results[key] = value
+                else:
+                    errors[key] = error
+                finished.notify_all()
+
+    for i in range(min(maxWorkers, len(tasks))):
+        threading.Thread(target=worker, name="%s-%i" % (name, i), daemon=True).start()
+    end = time.monotonic() + deadline
+    with finished:
+        while len(results) + len(errors) < len(tasks):
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                break
+            finished.wait(remaining)
+        abandoned.set()
+        (done, failed) = (dict(results), dict(errors))
+    notDone = [key for key in tasks if key not in done and key not in failed]
+    return (done, failed, notDone)
@@ -0,0 +1,88 @@
+'''
+Memory mapped preference table for local consumers of the gateway status.
+
+genGwStatus writes the preference of every segment into a fixed layout file
+indexed by segment number, fastd-verify reads a segment's entry with a single
+mmap read instead of parsing gwstatus.json. Every entry carries a sequence
+counter (seqlock): the writer makes it odd before and even after changing the
+entry, a reader retries if it was odd or changed during its read.
+gwstatus.json stays the format for the network.
+'''
+
+import os
+import mmap
+import struct
+
+MAGIC = b'GWPT'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')    # magic, version, segments, reserved
+ENTRY = struct.Struct('<Iid')       # sequence, preference, timestamp
+SEQUENCE = struct.Struct('<I')
+RETRIES = 100
+
+
+class PreferenceTable:
+    def __init__(self, path, segments=None):
+        # segments is only given by the writer, it creates or resizes the table
+        self.path = path
+        self.writable = segments is not None
+        if self.writable:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        else:
+            fd = os.open(path, os.O_RDONLY)
+        try:
+            stat = os.fstat(fd)
+            self.inode = stat.st_ino
+            if self.writable:
+                size = HEADER.size + (segments + 1) * ENTRY.size
+                if stat.st_size < size:
+                    os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, size)
+                (magic, version, count, reserved) = HEADER.unpack_from(self.mm, 0)
+                if magic != MAGIC or version != VERSION:
+                    self.mm[:] = bytes(size)
+                HEADER.pack_into(self.mm, 0, MAGIC, VERSION, segments, 0)
+                self.segments = segments
+            else:
+                self.mm = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+                (magic, version, count, reserved) = HEADER.unpack_from(self.mm, 0)
+                if magic != MAGIC or version != VERSION:
+                    self.mm.close()
+                    raise ValueError("%s is no preference table" % (path))
+                self.segments = min(count, (len(self.mm) - HEADER.size) // ENTRY.size - 1)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.mm.close()
+
+    def is_replaced(self):
+        # readers reopen the table if it was recreated or grown
+        try:
+            stat = os.stat(self.path)
+            return stat.st_ino != self.inode or stat.st_size != len(self.mm)
+        except OSError:
+            return True
+
+    def set(self, segment, preference, timestamp):
+        pos = HEADER.size + segment * ENTRY.size
+        (sequence,) = SEQUENCE.unpack_from(self.mm, pos)
+        SEQUENCE.pack_into(self.mm, pos, (sequence + 1) & 0xffffffff)
+        ENTRY.pack_into(self.mm, pos, (sequence + 1) & 0xffffffff, preference, timestamp)
+        SEQUENCE.pack_into(self.mm, pos, (sequence + 2) & 0xffffffff)
+
+    def update(self, preferences, timestamp):
+        for (segment, preference) in preferences.items():
+            if 0 <= segment <= self.segments:
+                self.set(segment, preference, timestamp)
+
+    def get(self, segment):
+        # returns (preference, timestamp) or None if the segment has no entry
+        if segment < 0 or segment > self.segments:
+            return None
+        pos = HEADER.size + segment * ENTRY.size
+        for attempt in range(RETRIES):
+            (sequence, preference, timestamp) = ENTRY.unpack_from(self.mm, pos)
+            if sequence % 2 == 0 and SEQUENCE.unpack_from(self.mm, pos)[0] == sequence:
+                return None if timestamp == 0 else (preference, timestamp)
+        return None
@@ -0,0 +1,39 @@
+'''
+Recorder of the inputs of balancing cycles, for gwReplay.py.
+
+Every cycle is appended as one JSON line in its own gzip member: the time,
+the discovered gateways and their fetched gwstatus documents. The zone is
+only written when its serial changed since the last cycle in the file.
+Appending gzip members keeps the file valid even if the recorder is killed
+between two cycles.
+'''
+
+import gzip
+import json
+import time
+
+
+class GwRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.lastSerial = None
+
+    def record(self, zone, allGws, timestamp=None):
+        entry = {"timestamp": time.time() if timestamp is None else timestamp,
+                 "gws": sorted(allGws),
+                 "docs": {gw: doc for (gw, doc) in allGws.items() if doc != {}}}
+        if zone.serial is None or zone.serial != self.lastSerial:
+            entry["zone"] = {"origin": zone.origin, "serial": zone.serial, "records": zone.records}
+            self.lastSerial = zone.serial
+        self.append(entry)
+
+    def append(self, entry):
+        with gzip.open(self.path, "ab") as fp:
+            fp.write(json.dumps(entry, separators=(',', ':')).encode("utf-8") + b"\n")
+
+
+def read_records(path):
+    with gzip.open(path, "rb") as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
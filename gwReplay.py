@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+'''
+Offline replay of balancing cycles for comparing strategies and their settings.
+
+The cycles are read from a file written with gwLoadBalancer.py --record or
+generated synthetically. Every cycle runs get_status, validate_status and
+get_result of an in-process GwLoadBalancer, without any network access. The
+DNS segment records are simulated: they start like the first recorded zone
+and then only follow the changes decided in the replay, the dnsactive of the
+recorded documents is rewritten to match them. Reported are the DNS churn
+(records added or deleted), the load imbalance (coefficient of variation of
+the number of segments in DNS per gateway), the segments left with fewer
+gateways than desired or none at all, and the decision latency.
+'''
+
+import argparse
+import itertools
+import logging
+import random
+import statistics
+import time
+
+from gwLoadBalancer import GwLoadBalancer
+from gwRecorder import GwRecorder, read_records
+from gwStability import GwStability
+from gwZone import GwZone
+
+
+class SimulatedZone:
+    def __init__(self):
+        self.origin = None
+        self.hostRecords = []
+        self.segmentRecords = None  # [(name, ttl, rdtype, value)], taken from the first recorded zone
+
+    def load(self, data):
+        self.origin = data["origin"]
+        records = [tuple(record) for record in data["records"]]
+        self.hostRecords = [record for record in records if not GwZone.clusterPattern.match(record[0])]
+        if self.segmentRecords is None:
+            self.segmentRecords = [record for record in records if GwZone.clusterPattern.match(record[0])]
+
+    def build(self):
+        zone = GwZone(self.origin)
+        zone.records = self.hostRecords + self.segmentRecords
+        zone.build_index()
+        if len(zone.unresolved) > 0:
+            # a gateway left the zone, its segment records would stop the real balancer
+            zone.records = [r for r in zone.records if not GwZone.clusterPattern.match(r[0]) or r[3] in zone.ipToHost]
+            zone.build_index()
+        return zone
+
+    def apply(self, changes):
+        for (cmd, name, ttl, rdtype, value) in changes:
+            record = (name, ttl, rdtype, value)
+            if cmd == "add" and record not in self.segmentRecords:
+                self.segmentRecords.append(record)
+            elif cmd == "delete":
+                self.segmentRecords = [r for r in self.segmentRecords if (r[0], r[2], r[3]) != (name, rdtype, value)]
+
+
+def get_docs(record, zone):
+    # the recorded documents, with dnsactive as the simulated zone has it
+    allGws = {}
+    for gw in record["gws"]:
+        doc = record["docs"].get(gw)
+        if doc is None:
+            allGws[gw] = {}
+            continue
+        segments = {}
+        for (segment, data) in doc["segments"].items():
+            segments[segment] = dict(data, dnsactive=1 if gw in zone.activeGws.get(segment, []) else 0)
+        allGws[gw] = dict(doc, segments=segments)
+    return allGws
+
+
+def get_imbalance(zone, gws):
+    # coefficient of variation of the segments in DNS per gateway with a document
+    if len(gws) == 0:
+        return 0.0
+    count = {gw: 0 for gw in gws}
+    for active in zone.activeGws.values():
+        for gw in active:
+            if gw in count:
+                count[gw] += 1
+    mean = statistics.mean(count.values())
+    if mean == 0:
+        return 0.0
+    return statistics.pstdev(count.values()) / mean
+
+
+def count_short_segments(zone, status, desiredGwPerSegment):
+    # segments with fewer gateways in DNS than they could have, and those with none, of the gateways with a document
+    (short, empty) = (0, 0)
+    for (segment, segmentstatus) in status.items():
+        active = len([gw for gw in zone.activeGws.get(segment, []) if gw in segmentstatus])
+        if active < min(desiredGwPerSegment, len(segmentstatus)):
+            short += 1
+            if active == 0:
+                empty += 1
+    return (short, empty)
+
+
+def simulate(records, strategy="segment", desiredGwPerSegment=2, margin=0, minDwell=0, maxSegmentsPerGw=None):
+    lb = GwLoadBalancer()
+    lb.strategy = strategy
+    lb.desiredGwPerSegment = desiredGwPerSegment
+    lb.maxSegmentsPerGw = maxSegmentsPerGw
+    lb.stability = GwStability(margin=margin, minDwell=minDwell)
+    simulated = SimulatedZone()
+    result = {"cycles": 0, "inconsistent": 0, "changes": 0, "flipsAvoided": 0, "held": 0, "shortSegments": 0,
+              "emptySegments": 0}
+    imbalance = []
+    latency = []
+    for record in records:
+        if "zone" in record:
+            simulated.load(record["zone"])
+        if simulated.segmentRecords is None:
+            continue
+        lb.zone = simulated.build()
+        lb.get_ip_to_gw_lookup()
+        lb.allGws = get_docs(record, lb.zone)
+        lb.clock = lambda: record["timestamp"]
+        lb.status = {}
+        lb.runStats.start_cycle()
+        result["cycles"] += 1
+
+        start = time.perf_counter()
+        lb.get_status()
+        consistent = lb.validate_status()
+        if consistent:
+            lb.get_result()
+        latency.append(time.perf_counter() - start)
+
+        if not consistent:
+            result["inconsistent"] += 1
+            continue
+        result["changes"] += len(lb.changes_all)
+        result["flipsAvoided"] += lb.stability.stats["flipsAvoided"]
+        result["held"] += lb.stability.stats["held"]
+        simulated.apply(lb.changes_all)
+        zone = simulated.build()
+        imbalance.append(get_imbalance(zone, [gw for (gw, doc) in lb.allGws.items() if doc != {}]))
+        (short, empty) = count_short_segments(zone, lb.status, desiredGwPerSegment)
+        result["shortSegments"] += short
+        result["emptySegments"] += empty
+
+    result["imbalance"] = statistics.mean(imbalance) if imbalance else 0.0
+    if latency:
+        latency.sort()
+        result["latency"] = {"mean": statistics.mean(latency), "p95": latency[int(0.95 * (len(latency) - 1))],
+                             "max": latency[-1]}
+    else:
+        result["latency"] = {"mean": 0.0, "p95": 0.0, "max": 0.0}
+    return result
+
+
+def gen_synthetic(cycles, gateways=8, segments=32, desiredGwPerSegment=2, interval=30, seed=1,
+                  origin="gw.freifunk-stuttgart.de"):
+    # preferences like genGwStatus derives them: the uplink load of every gateway and the traffic share of its
+    # segments follow random walks, a load above the bandwidth limit gives a negative preference; gateways fail
+    # now and then for a few cycles. Gateway names and segment numbers are limited by the patterns of GwZone
+    if not 0 < gateways <= 81 or not 0 < segments < 99:
+        raise ValueError("at most 81 gateways and 98 segments can be simulated")
+    rnd = random.Random(seed)
+    gws = ["gw%02in%02i" % (i % 9 + 1, i // 9 + 1) for i in range(gateways)]
+    records = []
+    for (i, gw) in enumerate(gws):
+        records.append((gw, 300, "A", "10.190.%i.%i" % (i // 9 + 1, i % 9 + 1)))
+        records.append((gw, 300, "AAAA", "fd21:b4dc:4b00::%x:%x" % (i // 9 + 1, i % 9 + 1)))
+    hostRecords = list(records)
+    for s in range(1, segments + 1):
+        for j in range(min(desiredGwPerSegment, gateways)):
+            for (gw, ttl, rdtype, value) in hostRecords[((s + j) % gateways) * 2:((s + j) % gateways) * 2 + 2]:
+                records.append(("%ss%02i" % (gw[0:4], s), 300, rdtype, value))
+    load = {gw: rnd.uniform(0.2, 0.9) for gw in gws}  # uplink peak as share of the bandwidth limit
+    share = {(gw, s): 1.0 for gw in gws for s in range(1, segments + 1)}  # segment traffic relative to the mean
+    down = {gw: 0 for gw in gws}
+    timestamp = 1600000000
+    for cycle in range(cycles):
+        docs = {}
+        for gw in gws:
+            if down[gw] > 0:
+                down[gw] -= 1
+                continue
+            if rnd.random() < 0.002:
+                down[gw] = rnd.randint(1, 20)
+                continue
+            load[gw] = max(0.0, min(1.3, load[gw] + rnd.gauss(0, 0.02)))
+            for s in range(1, segments + 1):
+                share[(gw, s)] = max(0.0, min(3.0, share[(gw, s)] + rnd.gauss(0, 0.05)))
+            mean = sum(share[(gw, s)] for s in range(1, segments + 1)) / segments
+            preference = 100 * (1 - load[gw])
+            doc = {"version": "1", "timestamp": timestamp, "segments": {}}
+            for s in range(1, segments + 1):
+                # see genGwStatus.getSegmentPreferences, by traffic only
+                excess = 100 * load[gw] * max(0.0, share[(gw, s)] / mean - 1) if mean > 0 else 0.0
+                doc["segments"][str(s)] = {"preference": min(100, int(round(preference - excess))), "dnsactive": 0}
+            docs[gw] = doc
+        record = {"timestamp": timestamp, "gws": gws, "docs": docs}
+        if cycle == 0:
+            record["zone"] = {"origin": origin, "serial": 1, "records": records}
+        yield record
+        timestamp += interval
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline replay of balancing cycles")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-r", "--record", action="store", help="file written by gwLoadBalancer.py --record")
+    source.add_argument("-n", "--synthetic", type=int, help="number of synthetic cycles")
+    parser.add_argument("-g", "--gateways", type=int, default=8, help="gateways of the synthetic cycles")
+    parser.add_argument("-s", "--segments", type=int, default=32, help="segments of the synthetic cycles")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", action="store", help="write the synthetic cycles to this file for later replays")
+    parser.add_argument("--strategy", nargs="+", choices=["segment", "global"], default=["segment", "global"])
+    parser.add_argument("--margin", type=int, nargs="+", default=[0])
+    parser.add_argument("--min-dwell", dest="minDwell", type=int, default=0)
+    parser.add_argument("--max-segments-per-gw", dest="maxSegmentsPerGw", type=int)
+    parser.add_argument("--desired", type=int, default=2, help="gateways per segment")
+    parser.add_argument("--log-level", dest="logLevel", default="ERROR")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.logLevel)
+
+    if args.record is not None:
+        def load():
+            return read_records(args.record)
+    else:
+        synthetic = list(gen_synthetic(args.synthetic, args.gateways, args.segments, args.desired, seed=args.seed))
+        if args.save is not None:
+            recorder = GwRecorder(args.save)
+            for record in synthetic:
+                recorder.append(record)
+
+        def load():
+            return synthetic
+
+    print("%-8s %6s %7s %12s %9s %14s %9s %6s %6s %9s %9s %9s" % (
+        "strategy", "margin", "cycles", "inconsistent", "changes", "changes/cycle", "imbalance", "short", "empty",
+        "mean ms", "p95 ms", "max ms"))
+    for (strategy, margin) in itertools.product(args.strategy, args.margin):
+        result = simulate(load(), strategy, args.desired, margin, args.minDwell, args.maxSegmentsPerGw)
+        print("%-8s %6i %7i %12i %9i %14.2f %9.3f %6i %6i %9.2f %9.2f %9.2f" % (
+            strategy, margin, result["cycles"], result["inconsistent"], result["changes"],
+            result["changes"] / max(1, result["cycles"]), result["imbalance"], result["shortSegments"],
+            result["emptySegments"], result["latency"]["mean"] * 1e3,
+            result["latency"]["p95"] * 1e3, result["latency"]["max"] * 1e3))
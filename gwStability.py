@@ -0,0 +1,89 @@
+'''
+Hysteresis and minimum dwell time for the DNS decisions of the load balancer.
+
+A gateway in DNS gets a bonus of margin on its preference when the best
+gateways are chosen, so two gateways with about the same preference do not
+swap places on every run. A gateway that entered DNS less than minDwell
+seconds ago is not removed. The time a gateway entered DNS can be kept in a
+file between one-shot runs. With both values at 0 the plan is not changed.
+'''
+
+import os
+import json
+import time
+import logging
+import tempfile
+
+from gwStatusMatrix import StatusMatrix
+
+
+class GwStability:
+    def __init__(self, path=None, margin=0, minDwell=0):
+        self.path = path
+        self.margin = margin
+        self.minDwell = minDwell
+        self.state = {}  # segment -> gw -> timestamp it entered DNS (0 if before the state began), None if not in DNS
+        self.stats = {"flipsAvoided": 0, "held": 0}
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                self.state = json.load(fp)
+        except FileNotFoundError:
+            self.state = {}
+        except Exception as e:
+            logging.warning("Could not load stability state %s: %s" % (self.path, e))
+            self.state = {}
+
+    def save(self):
+        if self.path is None:
+            return
+        data = json.dumps(self.state, separators=(',', ':'))
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix=".gwstability")
+        with os.fdopen(fd, "w") as fp:
+            fp.write(data)
+        os.replace(tmp, self.path)
+
+    def is_enabled(self):
+        return self.margin > 0 or self.minDwell > 0
+
+    def observe(self, status, now):
+        for (segment, segmentstatus) in status.items():
+            previous = self.state.get(segment, {})
+            current = {}
+            for (gw, data) in segmentstatus.items():
+                if data["dnsactive"] != 1:
+                    current[gw] = None
+                elif gw not in previous:
+                    current[gw] = 0
+                elif previous[gw] is None:
+                    current[gw] = now
+                else:
+                    current[gw] = previous[gw]
+            self.state[segment] = current
+
+    def is_held(self, segment, gw, now):
+        since = self.state.get(segment, {}).get(gw)
+        return since is not None and now - since < self.minDwell
+
+    def plan(self, status, planner, now=None):
+        # planner(matrix) returns StatusMatrix.plan() like results
+        self.stats = {"flipsAvoided": 0, "held": 0}
+        matrix = StatusMatrix(status)
+        if not self.is_enabled():
+            return planner(matrix)
+        if now is None:
+            now = time.time()
+        self.observe(status, now)
+        plan = planner(matrix)
+        stable = planner(matrix.with_margin(self.margin)) if self.margin > 0 else plan
+        result = {}
+        for (segment, (best, add, remove)) in stable.items():
+            held = [gw for gw in remove if self.is_held(segment, gw, now)]
+            self.stats["held"] += len(held)
+            result[segment] = (best, add, [gw for gw in remove if gw not in held])
+            self.stats["flipsAvoided"] += (len(plan[segment][1]) + len(plan[segment][2])
+                                           - len(result[segment][1]) - len(result[segment][2]))
+        return result
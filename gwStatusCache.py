@@ -0,0 +1,91 @@
+'''
+Cache for gwstatus.json documents, shared by the load balancer and the exporter.
+
+Documents are kept per URL together with their ETag/Last-Modified header.
+Fetches are sent as conditional requests, so a 304 answer reuses the
+already parsed document. Documents older than maxAge (by their timestamp)
+are evicted, as they would be rejected anyway.
+'''
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+
+class GwStatusCache:
+    def __init__(self, path=None, maxAge=60 * 15):
+        self.path = path
+        self.maxAge = maxAge
+        self.entries = {}  # url -> {"doc": ..., "etag": ..., "lastModified": ..., "fetched": ...}
+        self.lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                self.entries = json.load(fp)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            logging.warning("Could not load status cache %s: %s" % (self.path, e))
+            self.entries = {}
+        self.evict()
+
+    def save(self):
+        if self.path is None:
+            return
+        self.evict()
+        with self.lock:
+            data = json.dumps(self.entries, separators=(',', ':'))
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix=".gwstatuscache")
+        with os.fdopen(fd, "w") as fp:
+            fp.write(data)
+        os.replace(tmp, self.path)
+
+    def is_expired(self, entry, now):
+        doc = entry["doc"]
+        timestamp = doc.get("timestamp", entry["fetched"]) if isinstance(doc, dict) else entry["fetched"]
+        return now - timestamp > self.maxAge
+
+    def evict(self):
+        now = time.time()
+        with self.lock:
+            for url in [url for (url, entry) in self.entries.items() if self.is_expired(entry, now)]:
+                del self.entries[url]
+
+    def get(self, session, url, timeout=None):
+        # returns (response, document), the document is None if the response carried none
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None and self.is_expired(entry, now):
+                del self.entries[url]
+                entry = None
+        headers = {}
+        if entry is not None:
+            if "etag" in entry:
+                headers["If-None-Match"] = entry["etag"]
+            if "lastModified" in entry:
+                headers["If-Modified-Since"] = entry["lastModified"]
+        r = session.get(url, headers=headers, timeout=timeout)
+        if r.status_code == 304 and entry is not None:
+            entry["fetched"] = now
+            return (r, entry["doc"])
+        if r.status_code != 200 or len(r.content) == 0:
+            return (r, None)
+        doc = json.loads(r.text)
+        entry = {"doc": doc, "fetched": now}
+        if "ETag" in r.headers:
+            entry["etag"] = r.headers["ETag"]
+        if "Last-Modified" in r.headers:
+            entry["lastModified"] = r.headers["Last-Modified"]
+        with self.lock:
+            if len(entry) > 2 and not self.is_expired(entry, now):
+                self.entries[url] = entry
+            else:
+                self.entries.pop(url, None)
+        return (r, doc)
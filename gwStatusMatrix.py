@@ -0,0 +1,198 @@
+'''
+Segment x gateway matrix of the collected gwstatus documents.
+
+The status dict of the load balancer (segment -> gw -> data) is copied into
+flat arrays (preference, dnsactive and a validity mask, row per segment,
+column per gateway). plan() then selects the best gateways and the DNS
+changes of all segments in one pass, without sorting every segment again
+for every question asked about it.
+
+plan_global() is the alternative strategy deciding all segments together:
+every gateway gets a capacity of segments following its mean preference and
+a gateway is only chosen beyond its capacity if no other gateway with a
+positive preference is left. Every DNS change costs changeCost preference
+points, a gateway in DNS is kept against a better one unless that one is
+better by more. A limit of segments per gateway is never exceeded, the
+segments it blocks are left short of gateways. A segment it leaves without
+any gateway takes one from a segment that has several.
+'''
+
+import heapq
+import math
+from array import array
+from itertools import compress
+
+# the arrays hold 32 bit integers, with room left for the margin added by with_margin()
+PREFERENCE_LIMIT = 2 ** 30
+
+
+def to_preference(value):
+    # a preference as stored in the matrix, rounded and clamped; None if value is not a number
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or math.isnan(value):
+        return None
+    return int(round(max(-PREFERENCE_LIMIT, min(PREFERENCE_LIMIT, value))))
+
+
+class StatusMatrix:
+    def __init__(self, status):
+        self.segments = list(status)
+        self.gws = sorted({gw for segmentstatus in status.values() for gw in segmentstatus})
+        column = {gw: i for (i, gw) in enumerate(self.gws)}
+        size = len(self.segments) * len(self.gws)
+        self.preference = array('i', [0]) * size
+        self.dnsactive = array('i', [0]) * size
+        self.valid = array('b', [0]) * size
+        for (row, segment) in enumerate(self.segments):
+            base = row * len(self.gws)
+            for (gw, data) in status[segment].items():
+                pos = base + column[gw]
+                self.preference[pos] = data["preference"]
+                self.dnsactive[pos] = data["dnsactive"]
+                self.valid[pos] = 1
+
+    def with_margin(self, margin):
+        # copy with the preference of the gateways in DNS raised by margin
+        matrix = StatusMatrix({})
+        matrix.segments = self.segments
+        matrix.gws = self.gws
+        matrix.dnsactive = self.dnsactive
+        matrix.valid = self.valid
+        matrix.preference = array('i', (p + margin if d == 1 else p for (p, d) in zip(self.preference, self.dnsactive)))
+        return matrix
+
+    def plan(self, desiredGwPerSegment):
+        # segment -> (best gws, gws to add to dns, gws to remove from dns), all sorted by name
+        # gws are sorted by name, so ties of the preference are broken like sorted(((preference, gw)), reverse=True)
+        result = {}
+        n = len(self.gws)
+        columns = range(n)
+        for (row, segment) in enumerate(self.segments):
+            base = row * n
+            preference = self.preference[base:base + n]
+            dnsactive = self.dnsactive[base:base + n]
+            validColumns = list(compress(columns, self.valid[base:base + n]))
+            # reversed, so nlargest keeps the later gateway of a tie
+            best = sorted(heapq.nlargest(desiredGwPerSegment, reversed(validColumns), key=preference.__getitem__))
+            bestSet = set(best)
+            add = [self.gws[i] for i in best if dnsactive[i] == 0]
+            remove = [self.gws[i] for i in validColumns if dnsactive[i] == 1 and i not in bestSet]
+            result[segment] = ([self.gws[i] for i in best], add, remove)
+        return result
+
+    def get_capacities(self, desiredGwPerSegment, maxSegmentsPerGw=None):
+        # share of all segment slots per gateway, proportional to its mean positive preference
+        n = len(self.gws)
+        total = [0] * n
+        count = [0] * n
+        for (pos, valid) in enumerate(self.valid):
+            if valid:
+                total[pos % n] += self.preference[pos]
+                count[pos % n] += 1
+        weight = [max(0, total[i] / count[i]) if count[i] > 0 else 0 for i in range(n)]
+        slots = 0
+        for row in range(len(self.segments)):
+            slots += min(desiredGwPerSegment, sum(self.valid[row * n:(row + 1) * n]))
+        if sum(weight) == 0:
+            capacities = [slots] * n
+        else:
+            capacities = [math.ceil(slots * w / sum(weight)) for w in weight]
+        if maxSegmentsPerGw is not None:
+            capacities = [min(c, maxSegmentsPerGw) for c in capacities]
+        return capacities
+
+    def plan_global(self, desiredGwPerSegment, maxSegmentsPerGw=None, changeCost=0):
+        # same result format as plan(); deterministic, the most constrained segments are decided first.
+        # changeCost: preference points a gateway in DNS is worth more than one that would have to be added
+        n = len(self.gws)
+        capacities = self.get_capacities(desiredGwPerSegment, maxSegmentsPerGw)
+        assigned = [0] * n
+        rows = []
+        for (row, segment) in enumerate(self.segments):
+            validColumns = list(compress(range(n), self.valid[row * n:(row + 1) * n]))
+            rows.append((len(validColumns), row, segment, validColumns))
+        rows.sort()
+
+        def key(base, i):
+            preference = self.preference[base + i]
+            dnsactive = self.dnsactive[base + i] == 1
+            # a gateway without a positive preference is overloaded in this segment
+            return (preference > 0, assigned[i] < capacities[i], preference + changeCost * dnsactive, dnsactive, i)
+
+        chosen = {}
+        for (candidates, row, segment, validColumns) in rows:
+            base = row * n
+            eligible = validColumns
+            if maxSegmentsPerGw is not None:
+                eligible = [i for i in validColumns if assigned[i] < maxSegmentsPerGw]
+            chosen[row] = heapq.nlargest(desiredGwPerSegment, eligible, key=lambda i: key(base, i))
+            for i in chosen[row]:
+                assigned[i] += 1
+        if maxSegmentsPerGw is not None:
+            self.repair_limited(rows, chosen, assigned, desiredGwPerSegment, maxSegmentsPerGw, key)
+
+        result = {}
+        for (candidates, row, segment, validColumns) in rows:
+            base = row * n
+            best = sorted(chosen[row])
+            bestSet = set(best)
+            add = [self.gws[i] for i in best if self.dnsactive[base + i] == 0]
+            remove = [self.gws[i] for i in validColumns if self.dnsactive[base + i] == 1 and i not in bestSet]
+            result[segment] = ([self.gws[i] for i in best], add, remove)
+        return {segment: result[segment] for segment in self.segments}
+
+    def repair_limited(self, rows, chosen, assigned, desiredGwPerSegment, maxSegmentsPerGw, key):
+        # the limit is never exceeded. A segment it left short takes a gateway that still has room, or one of
+        # another segment that can switch to such a gateway; a segment left without any takes one from a segment
+        # that has several
+        n = len(self.gws)
+        validOf = {row: set(validColumns) for (candidates, row, segment, validColumns) in rows}
+        holders = [set() for i in range(n)]
+        for (row, best) in chosen.items():
+            for i in best:
+                holders[i].add(row)
+        room = {i for i in range(n) if assigned[i] < maxSegmentsPerGw}
+
+        def move(i, source, target):
+            if source is not None:
+                chosen[source].remove(i)
+                holders[i].discard(source)
+                assigned[i] -= 1
+            chosen[target].append(i)
+            holders[i].add(target)
+            assigned[i] += 1
+            if assigned[i] >= maxSegmentsPerGw:
+                room.discard(i)
+
+        def best_with_room(row):
+            candidates = [i for i in room if i in validOf[row] and i not in chosen[row]]
+            return max(candidates, key=lambda i: key(row * n, i)) if candidates else None
+
+        def fill(row):
+            if len(room) == 0:
+                return False
+            i = best_with_room(row)
+            if i is not None:
+                move(i, None, row)
+                return True
+            missing = sorted((i for i in validOf[row] if i not in chosen[row]), key=lambda i: key(row * n, i),
+                             reverse=True)
+            for i in missing:
+                for other in sorted(holders[i]):
+                    k = best_with_room(other)
+                    if k is not None:
+                        move(i, other, row)
+                        move(k, None, other)
+                        return True
+            return False
+
+        for (candidates, row, segment, validColumns) in rows:
+            while len(chosen[row]) < min(desiredGwPerSegment, candidates) and fill(row):
+                pass
+        for (candidates, row, segment, validColumns) in rows:
+            if len(chosen[row]) > 0 or candidates == 0:
+                continue
+            for i in sorted(validColumns, key=lambda i: key(row * n, i), reverse=True):
+                donor = next((other for other in sorted(holders[i]) if len(chosen[other]) > 1), None)
+                if donor is not None:
+                    move(i, donor, row)
+                    break
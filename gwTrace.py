@@ -0,0 +1,89 @@
+'''
+Span tracer for profiling runs of the load balancer, genGwStatus and the exporter.
+
+A Tracer records a span for every phase and every per gateway or per segment
+call, the spans are written in the Chrome trace event format (open it in
+chrome://tracing or https://ui.perfetto.dev). Optionally the main thread is
+profiled with cProfile as well. Tracing is off by default: NULL_TRACER hands
+out one shared no-op context and calls functions directly.
+'''
+
+import os
+import json
+import time
+import cProfile
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+NULL_SPAN = nullcontext()
+
+
+class NullTracer:
+    enabled = False
+
+    def span(self, name, **args):
+        return NULL_SPAN
+
+    def call(self, name, func, *args):
+        return func(*args)
+
+    def start(self):
+        pass
+
+    def write(self):
+        pass
+
+
+class Tracer:
+    enabled = True
+
+    def __init__(self, path, profilePath=None, maxEvents=100000):
+        self.path = path
+        self.profilePath = profilePath
+        self.events = deque(maxlen=maxEvents)
+        self.pid = os.getpid()
+        self.profile = cProfile.Profile() if profilePath is not None else None
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {"name": name, "ph": "X", "ts": start * 1e6, "dur": (end - start) * 1e6,
+                     "pid": self.pid, "tid": threading.get_ident()}
+            if args:
+                event["args"] = args
+            self.events.append(event)
+
+    def call(self, name, func, *args):
+        with self.span(name):
+            return func(*args)
+
+    def start(self):
+        if self.profile is not None:
+            self.profile.enable()
+
+    def write(self):
+        # can be called repeatedly, e.g. after every cycle of a daemon
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(self.profilePath)
+            self.profile.enable()
+        threadNames = {thread.ident: thread.name for thread in threading.enumerate()}
+        events = list(self.events)
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                    for (tid, name) in threadNames.items()]
+        with open(self.path, "w") as fp:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, fp)
+
+
+NULL_TRACER = NullTracer()
+
+
+def get_tracer(path=None, profilePath=None):
+    if path is None:
+        return NULL_TRACER
+    return Tracer(path, profilePath)
@@ -0,0 +1,149 @@
+'''
+Interface traffic sampler for genGwStatus, replacing vnstat.
+
+The byte counters are read from /proc/net/dev and accumulated into five
+minute and hourly buckets of a ring buffer. The ring buffer lives in a
+memory mapped file, so the history survives restarts and cron runs. The
+peak is computed the same way getPeak_v2 does it from vnstat's data, over
+the buckets that were sampled; there is no peak before the series covers
+five minutes.
+'''
+
+import os
+import mmap
+import struct
+
+MAGIC = b'GWTR'
+VERSION = 2
+HEADER = struct.Struct('<4sIII')           # magic, version, series, reserved
+SERIES_HEADER = struct.Struct('<dQd')      # last timestamp, last counter, first timestamp
+SLOT = struct.Struct('<qQ')                # bucket index, bytes
+FIVEMIN = 300
+FIVEMIN_SLOTS = 288                        # 24 hours
+HOUR = 3600
+HOUR_SLOTS = 24
+SERIES_SIZE = SERIES_HEADER.size + (FIVEMIN_SLOTS + HOUR_SLOTS) * SLOT.size
+
+
+def readNetDev(path='/proc/net/dev'):
+    # one pass over all interfaces: {iface: (rx bytes, tx bytes)}
+    counters = {}
+    with open(path) as fp:
+        for line in fp:
+            if ':' not in line:
+                continue
+            (iface, data) = line.split(':', 1)
+            fields = data.split()
+            if len(fields) < 9:
+                continue
+            counters[iface.strip()] = (int(fields[0]), int(fields[8]))
+    return counters
+
+
+def countClients(iface, debugfs='/sys/kernel/debug/batman_adv'):
+    # clients in the local translation table, without the gateway's own (no purge) entries
+    path = os.path.join(debugfs, iface, 'transtable_local')
+    clients = 0
+    try:
+        with open(path) as fp:
+            for line in fp:
+                if line.startswith(' * ') and 'P' not in line[line.find('[') + 1:line.find(']')]:
+                    clients += 1
+    except OSError:
+        return None
+    return clients
+
+
+class TrafficRing:
+    def __init__(self, path, series=1):
+        self.path = path
+        self.series = series
+        size = HEADER.size + series * SERIES_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            valid = os.fstat(fd).st_size == size
+            if not valid:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        if not valid or HEADER.unpack_from(self.mm, 0) != (MAGIC, VERSION, series, 0):
+            self.mm[:] = bytes(size)
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, series, 0)
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+
+    def offset(self, series):
+        return HEADER.size + series * SERIES_SIZE
+
+    def add(self, series, first, slots, length, start, end, amount):
+        # spreads amount bytes evenly over the buckets between start and end
+        duration = end - start
+        base = self.offset(series) + SERIES_HEADER.size + first * SLOT.size
+        bucket = int(start // length)
+        while bucket * length < end:
+            overlap = min(end, (bucket + 1) * length) - max(start, bucket * length)
+            part = amount if duration <= 0 else int(round(amount * overlap / duration))
+            pos = base + (bucket % slots) * SLOT.size
+            (index, value) = SLOT.unpack_from(self.mm, pos)
+            if index != bucket:
+                value = 0
+            SLOT.pack_into(self.mm, pos, bucket, value + part)
+            bucket += 1
+
+    def sample(self, series, timestamp, counter):
+        pos = self.offset(series)
+        (lastTimestamp, lastCounter, firstTimestamp) = SERIES_HEADER.unpack_from(self.mm, pos)
+        SERIES_HEADER.pack_into(self.mm, pos, timestamp, counter, firstTimestamp or timestamp)
+        if lastTimestamp == 0 or timestamp <= lastTimestamp:
+            return
+        delta = counter - lastCounter
+        if delta < 0:
+            # counter reset, e.g. after a reboot
+            delta = counter
+        start = max(lastTimestamp, timestamp - HOUR_SLOTS * HOUR)
+        delta = int(delta * (timestamp - start) / (timestamp - lastTimestamp))
+        self.add(series, 0, FIVEMIN_SLOTS, FIVEMIN, start, timestamp, delta)
+        self.add(series, FIVEMIN_SLOTS, HOUR_SLOTS, HOUR, start, timestamp, delta)
+
+    def get_slot(self, series, first, slots, bucket):
+        # None for a bucket without samples
+        pos = self.offset(series) + SERIES_HEADER.size + (first + bucket % slots) * SLOT.size
+        (index, value) = SLOT.unpack_from(self.mm, pos)
+        return value if index == bucket else None
+
+    def getPeak(self, series, timestamp):
+        # peak in mbit/s: highest hour of the last day, five minutes of the last quarter or average of the last hour;
+        # None until the samples of the series span five minutes
+        (lastTimestamp, lastCounter, firstTimestamp) = SERIES_HEADER.unpack_from(self.mm, self.offset(series))
+        if firstTimestamp == 0 or lastTimestamp - firstTimestamp < FIVEMIN:
+            return None
+        peak = 0
+        currentHour = int(timestamp // HOUR)
+        for bucket in range(currentHour - HOUR_SLOTS, currentHour + 1):
+            peak = max(peak, self.get_slot(series, FIVEMIN_SLOTS, HOUR_SLOTS, bucket) or 0)
+
+        currentFivemin = int(timestamp // FIVEMIN)
+        traffic = 0
+        intervals = 0
+        for bucket in range(currentFivemin - HOUR // FIVEMIN, currentFivemin + 1):
+            if bucket * FIVEMIN < timestamp - HOUR:
+                continue
+            value = self.get_slot(series, 0, FIVEMIN_SLOTS, bucket)
+            if value is None:
+                # not sampled, e.g. before the first sample or while the sampler was stopped
+                continue
+            traffic += value
+            intervals += 1
+            if bucket * FIVEMIN >= timestamp - 900 and value * 12 > peak:
+                peak = value * 12
+
+        if intervals > 0:
+            traffic = int(traffic * 12 / intervals)
+            if traffic > peak:
+                peak = traffic
+
+        return peak * 8 / 60 / 60 / 1024 / 1024
@@ -0,0 +1,299 @@
+'''
+Indexed model of the gw.freifunk-stuttgart.de zone.
+
+The zone is parsed once into dictionaries, so that the lookups of the load
+balancer (records of a gateway, gateway of an IP, active gateways of a
+segment) do not need to scan the whole zone again.
+'''
+
+import re
+import os
+import json
+import time
+import socket
+import logging
+import tempfile
+
+import dns.exception
+import dns.message
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdataset
+import dns.rdatatype
+import dns.tsigkeyring
+import dns.update
+
+DEFAULT_ORIGIN = "gw.freifunk-stuttgart.de"
+DEFAULT_SERVER = "dns2.lihas.de"
+
+
+class GwZone:
+    hostPattern = re.compile('^gw0[0-9]n0[0-9]$')
+    clusterPattern = re.compile('^(gw0[0-9])s([0-9]{2})$')
+
+    def __init__(self, origin=DEFAULT_ORIGIN):
+        self.origin = origin
+        self.serial = None
+        self.records = []
+        self.hosts = {}  # gateway -> {rdtype: [value, ...]}
+        self.ipToHost = {}
+        self.segmentRecords = {}  # segment -> [(cluster, ip), ...]
+        self.activeGws = {}  # segment -> [gateway, ...]
+        self.unresolved = {}  # segment -> (cluster, ip) without gateway record
+        self.textCache = None  # (records, count, serial, text) of the last to_text()
+
+    @classmethod
+    def from_text(cls, text, origin=DEFAULT_ORIGIN):
+        # parses the output of "dig axfr", one "name ttl class type value" record per line
+        zone = cls(origin)
+        for line in text.split("\n"):
+            fields = line.split(None, 4)
+            if len(fields) < 5 or fields[2] != "IN":
+                continue
+            zone.add_record(fields[0], int(fields[1]), fields[3], fields[4].strip())
+        zone.build_index()
+        return zone
+
+    @classmethod
+    def transfer(cls, server=DEFAULT_SERVER, origin=DEFAULT_ORIGIN, port=53, timeout=10):
+        zone = cls(origin)
+        for message in dns.query.xfr(resolve_server(server, port), origin, port=port, lifetime=timeout,
+                                     relativize=False):
+            zone.add_rrsets(message.answer)
+        zone.build_index()
+        return zone
+
+    @classmethod
+    def sync(cls, server=DEFAULT_SERVER, origin=DEFAULT_ORIGIN, port=53, timeout=10, cacheFile=None, previous=None):
+        # reuses previous (or the cached zone) while the SOA serial is unchanged, then tries IXFR before AXFR
+        if previous is None and cacheFile is not None:
+            previous = cls.load(cacheFile, origin)
+        if previous is None or previous.serial is None:
+            zone = cls.transfer(server, origin, port, timeout)
+        else:
+            address = resolve_server(server, port)
+            serial = query_serial(address, origin, port, timeout)
+            if serial == previous.serial:
+                logging.info("Zone %s is unchanged at serial %i" % (origin, serial))
+                return previous
+            try:
+                zone = previous.incremental_transfer(address, port, timeout)
+            except Exception as e:
+                logging.warning("IXFR of %s from serial %i failed: %s" % (origin, previous.serial, e))
+                zone = cls.transfer(server, origin, port, timeout)
+        if cacheFile is not None:
+            zone.save(cacheFile)
+        return zone
+
+    def incremental_transfer(self, address, port=53, timeout=10):
+        records = []
+        for message in dns.query.xfr(address, self.origin, rdtype=dns.rdatatype.IXFR, serial=self.serial, port=port,
+                                     lifetime=timeout, relativize=False):
+            for rrset in message.answer:
+                records.extend((rrset.name.to_text(), rrset.ttl, dns.rdatatype.to_text(rrset.rdtype), rdata)
+                               for rdata in rrset)
+        if len(records) == 0:
+            raise LookupError("Empty IXFR response for %s" % (self.origin))
+        zone = GwZone(self.origin)
+        if len(records) < 2 or records[1][2] != "SOA":
+            # the server answered with the whole zone (or a single SOA, if the zone is unchanged)
+            if len(records) == 1:
+                zone.records = list(self.records)
+            for (name, ttl, rdtype, rdata) in records:
+                if rdtype == "SOA":
+                    zone.serial = rdata.serial
+                else:
+                    zone.add_record(name, ttl, rdtype, rdata.to_text())
+            zone.build_index()
+            logging.info("Transferred %s with serial %i" % (self.origin, zone.serial))
+            return zone
+        zone.records = list(self.records)
+        zone.serial = records[0][3].serial
+        adding = True
+        for (name, ttl, rdtype, rdata) in records[1:-1]:
+            if rdtype == "SOA":
+                # every difference sequence starts with the old SOA and switches to additions at the new SOA
+                adding = not adding
+                continue
+            if adding:
+                zone.add_record(name, ttl, rdtype, rdata.to_text())
+            else:
+                zone.remove_record(name, rdtype, rdata.to_text())
+        zone.build_index()
+        logging.info("Updated %s from serial %i to %i by IXFR" % (self.origin, self.serial, zone.serial))
+        return zone
+
+    @classmethod
+    def load(cls, path, origin=DEFAULT_ORIGIN):
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except Exception as e:
+            logging.info("Could not load zone cache %s: %s" % (path, e))
+            return None
+        if data.get("origin") != origin:
+            return None
+        zone = cls(origin)
+        zone.serial = data["serial"]
+        zone.records = [tuple(record) for record in data["records"]]
+        zone.build_index()
+        return zone
+
+    def save(self, path):
+        data = {"origin": self.origin, "serial": self.serial, "records": self.records}
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".zone")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(data, fp, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    def add_rrsets(self, rrsets):
+        for rrset in rrsets:
+            rdtype = dns.rdatatype.to_text(rrset.rdtype)
+            if rdtype == "SOA":
+                self.serial = rrset[0].serial
+                continue
+            name = rrset.name.to_text()
+            for rdata in rrset:
+                self.add_record(name, rrset.ttl, rdtype, rdata.to_text())
+
+    def to_text(self):
+        # rendered once per state of the zone; records are only appended or the list is replaced
+        cache = self.textCache
+        if cache is not None and cache[0] is self.records and cache[1] == len(self.records) and cache[2] == self.serial:
+            return cache[3]
+        text = "".join("%s.%s. %i IN %s\t%s\n" % (name, self.origin, ttl, rdtype, value)
+                       for (name, ttl, rdtype, value) in self.records)
+        self.textCache = (self.records, len(self.records), self.serial, text)
+        return text
+
+    def relative_name(self, name):
+        suffix = ".%s." % (self.origin)
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+        return None
+
+    def add_record(self, name, ttl, rdtype, value):
+        name = self.relative_name(name)
+        if name is not None:
+            self.records.append((name, ttl, rdtype, value))
+
+    def update(self, server, changes, port=53, timeout=10, retries=3, backoff=1.0, keyring=None, keyname=None,
+               keyalgorithm="hmac-sha256"):
+        # sends all (cmd, name, ttl, rdtype, value) changes as one UPDATE and returns the rcode
+        origin = dns.name.from_text(self.origin)
+        update = dns.update.UpdateMessage(origin, keyring=keyring, keyname=keyname, keyalgorithm=keyalgorithm)
+        rrsets = {}
+        for (name, ttl, rdtype, value) in self.records:
+            rrsets.setdefault((name, rdtype), []).append((ttl, value))
+        # every touched rrset has to be unchanged since this zone was transferred,
+        # otherwise a concurrent update of another coordinator would be overwritten
+        for (name, rdtype) in sorted(set((change[1], change[3]) for change in changes)):
+            current = rrsets.get((name, rdtype))
+            if current is None:
+                update.absent(dns.name.from_text(name, origin), rdtype)
+            else:
+                # prerequisites have to be sent with TTL 0 (RFC 2136 2.4), servers answer others with FORMERR
+                rdataset = dns.rdataset.from_text_list("IN", rdtype, 0, [value for (ttl, value) in current])
+                update.present(dns.name.from_text(name, origin), rdataset)
+        for (cmd, name, ttl, rdtype, value) in changes:
+            if cmd == "add":
+                update.add(dns.name.from_text(name, origin), ttl, rdtype, value)
+            else:
+                update.delete(dns.name.from_text(name, origin), rdtype, value)
+
+        address = resolve_server(server, port)
+        for attempt in range(retries + 1):
+            try:
+                response = dns.query.tcp(update, address, port=port, timeout=timeout)
+                rcode = response.rcode()
+                if rcode != dns.rcode.SERVFAIL:
+                    return rcode
+                logging.warning("DNS update of %s at %s failed with SERVFAIL" % (self.origin, server))
+            except (dns.exception.Timeout, OSError) as e:
+                logging.warning("DNS update of %s at %s failed: %s" % (self.origin, server, e))
+                rcode = dns.rcode.SERVFAIL
+            if attempt < retries:
+                time.sleep(backoff * 2 ** attempt)
+        return rcode
+
+    def remove_record(self, name, rdtype, value):
+        name = self.relative_name(name)
+        self.records = [r for r in self.records if not (r[0] == name and r[2] == rdtype and r[3] == value)]
+
+    def build_index(self):
+        self.hosts = {}
+        self.ipToHost = {}
+        self.segmentRecords = {}
+        for (name, ttl, rdtype, value) in self.records:
+            if self.hostPattern.match(name):
+                records = self.hosts.setdefault(name, {})
+                records.setdefault(rdtype, []).append(value)
+                if rdtype in ("A", "AAAA"):
+                    self.ipToHost[value] = name
+                continue
+            m = self.clusterPattern.match(name)
+            if m is not None and rdtype in ("A", "AAAA"):
+                segment = str(int(m.group(2)))
+                if segment != "99":
+                    self.segmentRecords.setdefault(segment, []).append((m.group(1), value))
+        self.activeGws = {}
+        self.unresolved = {}
+        for (segment, records) in self.segmentRecords.items():
+            gws = []
+            for (gwCluster, ip) in records:
+                gw = self.ipToHost.get(ip)
+                if gw is None:
+                    self.unresolved.setdefault(segment, (gwCluster, ip))
+                elif gw not in gws:
+                    gws.append(gw)
+            self.activeGws[segment] = gws
+
+    def get_gws(self):
+        return list(self.hosts.keys())
+
+    def get_record(self, gw, rdtype):
+        values = self.hosts.get(gw, {}).get(rdtype)
+        if values:
+            return values[0]
+        return None
+
+    def get_active_gws(self, segment):
+        if segment in self.unresolved:
+            (gwCluster, ip) = self.unresolved[segment]
+            logging.error("NO entry for GWCluster %s and IP %s" % (gwCluster, ip))
+            raise KeyError(ip)
+        return list(self.activeGws.get(segment, []))
+
+
+def query_serial(address, origin, port=53, timeout=10):
+    query = dns.message.make_query(origin, dns.rdatatype.SOA)
+    response = dns.query.udp(query, address, port=port, timeout=timeout)
+    for rrset in response.answer:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return rrset[0].serial
+    raise LookupError("No SOA record for %s at %s" % (origin, address))
+
+
+def read_tsig_key(path):
+    # reads a BIND style key file as used by "nsupdate -k"
+    with open(path) as fp:
+        text = fp.read()
+    m = re.search(r'key\s+"?([^"\s{]+)"?\s*\{(.*?)\}\s*;', text, re.S)
+    if m is None:
+        raise ValueError("No key found in %s" % (path))
+    algorithm = re.search(r'algorithm\s+"?([^";\s]+)"?\s*;', m.group(2))
+    secret = re.search(r'secret\s+"([^"]+)"\s*;', m.group(2))
+    if secret is None:
+        raise ValueError("No secret for key %s in %s" % (m.group(1), path))
+    keyalgorithm = algorithm.group(1) if algorithm is not None else "hmac-sha256"
+    return {
+        "keyring": dns.tsigkeyring.from_text({m.group(1): (keyalgorithm, secret.group(1))}),
+        "keyname": dns.name.from_text(m.group(1)),
+        "keyalgorithm": keyalgorithm,
+    }
+
+
+def resolve_server(server, port=53):
+    # dns.query needs an address, the configured server may be a hostname
+    return socket.getaddrinfo(server, port, proto=socket.IPPROTO_TCP)[0][4][0]
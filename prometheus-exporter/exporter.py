@@ -6,7 +6,20 @@ from urllib.parse import urlparse
 import logging
 import time
 import sys
+import os
 import json
+import threading
+import functools
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily, HistogramMetricFamily
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gwStatusCache import GwStatusCache
+from gwHealth import GwHealth
+from gwPool import run_parallel
+from gwLoadBalancer import GwLoadBalancer
+from gwTrace import NULL_TRACER, get_tracer
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
 def read_gwstatus_urls(gwstatus_url_file):
     urls = {}
@@ -18,64 +31,253 @@ def read_gwstatus_urls(gwstatus_url_file):
             urls[gw_name] = url
     return urls
 
-def download_gw_status(gwstatus_urls):
+def discover_gwstatus_urls(lb):
+    # the gateways the load balancer would ask, from batman on a gateway and from the zone elsewhere
+    lb.dns_zone_transfer()
+    lb.get_ip_to_gw_lookup()
+    lb.discover_gws()
+    return {gw_name: lb.get_gw_status_url(gw_name) for gw_name in sorted(lb.allGws)}
+
+def update_targets(gwstatus_urls, new_urls, collector, health, status_cache):
+    # only departed gateways are dropped, the metrics of all others stay as they are
+    added = sorted(set(new_urls) - set(gwstatus_urls))
+    removed = sorted(set(gwstatus_urls) - set(new_urls))
+    changed = sorted(gw_name for gw_name in set(new_urls) & set(gwstatus_urls) if new_urls[gw_name] != gwstatus_urls[gw_name])
+    if added or removed or changed:
+        logging.warning("Gateways added: %s, removed: %s, changed URL: %s", added, removed, changed)
+    for gw_name in removed + changed:
+        status_cache.entries.pop(gwstatus_urls[gw_name], None)
+        health.state.pop(gw_name, None)
+    collector.remove_gateways(removed)
+    return new_urls
+
+def fetch_gw_status(gw_name, url, status_cache, session, health, timeout):
+    # returns the status document, raises on any error
+    logging.debug("Fetching %s status data from '%s'", gw_name, url)
+    try:
+        resp, status_json = status_cache.get(session, url, timeout=timeout)
+        # a gateway answering 503 is reachable but does not count as healthy
+        resp.raise_for_status()
+        if status_json is None:
+            raise ValueError("empty document")
+    except (requests.RequestException, ValueError):
+        health.record_failure(gw_name)
+        raise
+    health.record_success(gw_name)
+    return status_json
+
+def download_gw_status(gwstatus_urls, status_cache=None, session=None, health=None, timeout=5, results=None,
+                       max_workers=16, deadline=None, tracer=NULL_TRACER):
+    # fetches all gateways in parallel, results is filled with gw_name -> {"duration": s, "error": text or None}
+    if status_cache is None:
+        status_cache = GwStatusCache()
+    if session is None:
+        session = requests.Session()
+    if health is None:
+        health = GwHealth()
+    if results is None:
+        results = {}
+    if deadline is None:
+        deadline = 2 * timeout
     status_dict = {}
+    due_probes = health.due_probes()
+    tasks = {}
+    probes = set()
     for gw_name, url in gwstatus_urls.items():
-        if gw_name in status_dict:
-            logging.warning("Duplicate gwname %s - ignoring!", gw_name)
-            continue
+        if health.is_open(gw_name):
+            if gw_name not in due_probes:
+                health.skip(gw_name)
+                continue
+            # half-open: the fetch in the pool is the probe, under the same deadline as all others
+            probes.add(gw_name)
+        tasks[gw_name] = url
+    if len(tasks) == 0:
+        return status_dict
 
-        logging.debug("Fetching %s status data from '%s'", gw_name, url)
+    def timed_fetch(gw_name, url):
+        start = time.monotonic()
+        if gw_name in probes:
+            health.start_probe(gw_name)
         try:
-            resp = requests.get(url)
-            resp.raise_for_status()
-            status_dict[gw_name] = resp.json()
-        except KeyboardInterrupt as e:
-            raise e
+            if tracer.enabled:
+                status_json = tracer.call("fetch %s" % gw_name, fetch_gw_status, gw_name, url, status_cache, session,
+                                          health, timeout)
+            else:
+                status_json = fetch_gw_status(gw_name, url, status_cache, session, health, timeout)
+            return status_json, None, time.monotonic() - start
         except Exception as e:
-            logging.error("Error fetching status data from %s: '%s'", url, e)
+            return None, e, time.monotonic() - start
+
+    calls = {gw_name: functools.partial(timed_fetch, gw_name, url) for gw_name, url in tasks.items()}
+    done, failed, not_done = run_parallel(calls, max_workers, deadline, "gwexport")
+    for gw_name in not_done:
+        logging.error("Fetching status data from %s did not finish within %is", tasks[gw_name], deadline)
+        health.record_failure(gw_name)
+        results[gw_name] = {"duration": deadline, "error": "deadline exceeded"}
+    for gw_name, (status_json, error, duration) in done.items():
+        if error is not None:
+            logging.error("Error fetching status data from %s: '%s'", tasks[gw_name], error)
+            results[gw_name] = {"duration": duration, "error": str(error)}
+        else:
+            status_dict[gw_name] = status_json
+            results[gw_name] = {"duration": duration, "error": None}
     return status_dict
 
+class GwStatusCollector:
+    """Keeps a snapshot of the last collection, a scrape only reads the snapshot and never waits for a gateway."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.status = {}            # gw_name -> last status document
+        self.circuit_open = {}      # gw_name -> 0/1
+        self.latency = {}           # gw_name -> ([count per bucket], count, sum)
+        self.last_success = {}      # gw_name -> timestamp
+        self.errors = {}            # gw_name -> count
+        self.probes = 0
+        self.skipped = 0
+
+    def remove_gateways(self, gw_names):
+        with self.lock:
+            for gw_name in gw_names:
+                for values in (self.status, self.circuit_open, self.latency, self.last_success, self.errors):
+                    values.pop(gw_name, None)
+
+    def update(self, gw_names, status_jsons, results, health):
+        now = time.time()
+        with self.lock:
+            for gw_name in gw_names:
+                self.circuit_open[gw_name] = 1 if health.is_open(gw_name) else 0
+            for gw_name, result in results.items():
+                counts, count, total = self.latency.get(gw_name, ([0] * len(self.buckets), 0, 0.0))
+                for i, bound in enumerate(self.buckets):
+                    if result["duration"] <= bound:
+                        counts[i] += 1
+                self.latency[gw_name] = (counts, count + 1, total + result["duration"])
+                if result["error"] is not None:
+                    self.errors[gw_name] = self.errors.get(gw_name, 0) + 1
+                else:
+                    self.errors.setdefault(gw_name, 0)
+                    self.last_success[gw_name] = now
+            self.status.update(status_jsons)
+            self.probes += health.stats["probed"]
+            self.skipped += health.stats["skipped"]
+
+    def collect(self):
+        now = time.time()
+        with self.lock:
+            preference = GaugeMetricFamily(
+                "gw_loadbalancing_pref",
+                "Current Preference. Range -inf to 100, where 100 is most willing to accept more nodes.",
+                labels=["gateway", "segment"])
+            age = GaugeMetricFamily("gw_loadbalancing_status_age_seconds",
+                                    "Age of the last status document, derived from its timestamp.", labels=["gateway"])
+            for gw_name, status_json in sorted(self.status.items()):
+                try:
+                    for segment_number, segment_status in status_json["segments"].items():
+                        preference.add_metric([gw_name, str(segment_number)], segment_status["preference"])
+                    age.add_metric([gw_name], now - status_json["timestamp"])
+                except Exception as e:
+                    logging.error("Error exporting preference for %s: %s", gw_name, e)
+            yield preference
+            yield age
+
+            circuit_open = GaugeMetricFamily(
+                "gw_loadbalancing_circuit_open",
+                "1 if the gateway is skipped because fetching its status failed repeatedly.", labels=["gateway"])
+            for gw_name, value in sorted(self.circuit_open.items()):
+                circuit_open.add_metric([gw_name], value)
+            yield circuit_open
+            yield CounterMetricFamily("gw_loadbalancing_circuit_probes",
+                                      "Probes of gateways with an open circuit.", value=self.probes)
+            yield CounterMetricFamily("gw_loadbalancing_circuit_skipped",
+                                      "Fetches skipped because of an open circuit.", value=self.skipped)
+
+            latency = HistogramMetricFamily("gw_loadbalancing_fetch_duration_seconds",
+                                            "Duration of fetching the status document.", labels=["gateway"])
+            for gw_name, (counts, count, total) in sorted(self.latency.items()):
+                buckets = [(str(bound), value) for bound, value in zip(self.buckets, counts)]
+                buckets.append(("+Inf", count))
+                latency.add_metric([gw_name], buckets, total)
+            yield latency
+
+            last_success = GaugeMetricFamily("gw_loadbalancing_last_success_timestamp_seconds",
+                                             "Time of the last successful fetch of the status document.",
+                                             labels=["gateway"])
+            for gw_name, timestamp in sorted(self.last_success.items()):
+                last_success.add_metric([gw_name], timestamp)
+            yield last_success
+
+            errors = CounterMetricFamily("gw_loadbalancing_fetch_errors",
+                                         "Failed fetches of the status document.", labels=["gateway"])
+            for gw_name, count in sorted(self.errors.items()):
+                errors.add_metric([gw_name], count)
+            yield errors
+
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
-    ap.add_argument("gwstatus_url_file", type=argparse.FileType("r"), help="File with one URL to gwstatus.json per line")
+    ap.add_argument("gwstatus_url_file", type=argparse.FileType("r"), nargs="?",
+                    help="File with one URL to gwstatus.json per line, without it the gateways are discovered like gwLoadBalancer.py does")
+    ap.add_argument("--discovery-interval", help="Discover the gateways every N seconds", default=3600, type=int)
+    ap.add_argument("--dns-server", help="DNS server to transfer the gateway zone from", default=None)
     ap.add_argument("--port", help="Listen Port", default=8000, type=int)
     ap.add_argument("--addr", help="Listen Address, default all", default="")
     ap.add_argument("--update-interval", help="Update data every N seconds", default=300, type=int)
+    ap.add_argument("--status-cache", help="File to keep the downloaded status documents in", default=None)
+    ap.add_argument("--timeout", help="Timeout for fetching a status document in seconds", default=5, type=float)
+    ap.add_argument("--deadline", help="Time after which a fetch is given up in seconds, default twice the timeout",
+                    default=None, type=float)
+    ap.add_argument("--parallel", help="Number of status documents fetched in parallel", default=16, type=int)
+    ap.add_argument("--profile", help="Write a trace of every update to this file (Chrome trace format)", default=None)
+    ap.add_argument("--profile-cprofile", help="With --profile, also write cProfile statistics to this file", default=None)
     ap.add_argument("--loglevel", help="Set the desired level of logging", default="warning", choices=["debug", "warning", "error"])
     args = ap.parse_args()
     
     if args.loglevel == "debug":
-        logging.basicConfig(level=logging.DEBUG)
+        logging.basicConfig(level=logging.DEBUG, force=True)
     elif args.loglevel == "warning":
-        logging.basicConfig(level=logging.WARNING)
+        logging.basicConfig(level=logging.WARNING, force=True)
     else:
-        logging.basicConfig(level=logging.ERROR)
+        logging.basicConfig(level=logging.ERROR, force=True)
 
-    gwstatus_urls = read_gwstatus_urls(args.gwstatus_url_file)
+    lb = None
+    if args.gwstatus_url_file is not None:
+        gwstatus_urls = read_gwstatus_urls(args.gwstatus_url_file)
+    else:
+        lb = GwLoadBalancer()
+        if args.dns_server is not None:
+            lb.dnsServer = args.dns_server
+        gwstatus_urls = {}
+    next_discovery = 0
+    tracer = get_tracer(args.profile, args.profile_cprofile)
+    tracer.start()
+    status_cache = GwStatusCache(args.status_cache)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.parallel)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    health = GwHealth()
 
     prometheus_registry = prometheus.CollectorRegistry()
-    preference_gauge = prometheus.Gauge(
-            "gw_loadbalancing_pref",
-            "Current Preference. Range -inf to 100, where 100 is most willing to accept more nodes.",
-            ['gateway', 'segment'],
-            registry=prometheus_registry
-    )
+    collector = GwStatusCollector()
+    prometheus_registry.register(collector)
     prometheus.start_http_server(args.port, args.addr, prometheus_registry)
 
     while True:
-        # first download status files to avoid blocking to long after clearing gauge
-        status_jsons = download_gw_status(gwstatus_urls)
-
-        #preference_gauge.clear()
-        for gw_name, status_json in status_jsons.items():
+        if lb is not None and time.time() >= next_discovery:
             try:
-                for segment_number, segment_status in status_json["segments"].items():
-                    preference_gauge.labels(gateway=gw_name, segment=segment_number).set(segment_status["preference"])
-            except KeyboardInterrupt as e:
-                raise e
+                with tracer.span("discovery"):
+                    new_urls = discover_gwstatus_urls(lb)
+                gwstatus_urls = update_targets(gwstatus_urls, new_urls, collector, health, status_cache)
             except Exception as e:
-                logging.error("Error exporting preference for %s: %s", gw_name, e)
+                logging.error("Error discovering the gateways, keeping the previous ones: %s", e)
+            next_discovery = time.time() + args.discovery_interval
+        health.reset_stats()
+        results = {}
+        with tracer.span("download"):
+            status_jsons = download_gw_status(gwstatus_urls, status_cache, session, health, args.timeout, results,
+                                              args.parallel, args.deadline, tracer)
+        status_cache.save()
+        collector.update(gwstatus_urls, status_jsons, results, health)
+        tracer.write()
         time.sleep(args.update_interval)
-
-
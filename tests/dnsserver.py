@@ -0,0 +1,186 @@
+'''
+Local stand-in for the authoritative DNS server of the gateway zone.
+
+Answers SOA queries over UDP and AXFR/IXFR queries over TCP on 127.0.0.1
+from a list of (name, ttl, rdtype, value) records with names relative to
+the zone origin. Older versions of the zone are kept to answer IXFR. UPDATE messages are
+applied after checking their prerequisites and, if a keyring is given,
+their TSIG signature.
+'''
+
+import socketserver
+import struct
+import threading
+
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+
+class DnsHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            header = self.recv_exactly(2)
+            if header is None:
+                return
+            wire = self.recv_exactly(struct.unpack("!H", header)[0])
+            if wire is None:
+                return
+            for response in self.server.dns_stub.handle(wire):
+                data = response.to_wire()
+                self.request.sendall(struct.pack("!H", len(data)) + data)
+
+    def recv_exactly(self, count):
+        data = b""
+        while len(data) < count:
+            chunk = self.request.recv(count - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+class UdpHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        (wire, sock) = self.request
+        for response in self.server.dns_stub.handle(wire):
+            sock.sendto(response.to_wire(), self.client_address)
+
+
+class TcpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UdpServer(socketserver.ThreadingUDPServer):
+    daemon_threads = True
+
+
+class DnsServer:
+    def __init__(self, origin="gw.freifunk-stuttgart.de", records=None, serial=1, keyring=None):
+        self.origin = dns.name.from_text(origin)
+        self.records = list(records) if records is not None else []
+        self.serial = serial
+        self.history = {serial: list(self.records)}
+        self.ixfr = True
+        self.keyring = keyring
+        self.updates = []
+        self.fail_updates = 0  # answer that many updates with SERVFAIL
+        self.queries = []
+        self.tcp = TcpServer(("127.0.0.1", 0), DnsHandler)
+        self.tcp.dns_stub = self
+        self.port = self.tcp.server_address[1]
+        self.udp = UdpServer(("127.0.0.1", self.port), UdpHandler)
+        self.udp.dns_stub = self
+
+    def __enter__(self):
+        for server in (self.tcp, self.udp):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        for server in (self.tcp, self.udp):
+            server.shutdown()
+            server.server_close()
+
+    def set_records(self, records, serial):
+        self.records = list(records)
+        self.serial = serial
+        self.history[serial] = list(self.records)
+
+    def soa_rrset(self, serial=None):
+        if serial is None:
+            serial = self.serial
+        return dns.rrset.from_text(self.origin, 3600, "IN", "SOA",
+                                   "ns1.%s hostmaster.%s %i 3600 600 86400 300" % (self.origin, self.origin, serial))
+
+    def rrset(self, name, ttl, rdtype, value):
+        return dns.rrset.from_text(dns.name.from_text(name, self.origin), ttl, "IN", rdtype, value)
+
+    def handle(self, wire):
+        query = dns.message.from_wire(wire, keyring=self.keyring)
+        if query.opcode() == dns.opcode.UPDATE:
+            return [self.handle_update(query)]
+        question = query.question[0]
+        self.queries.append(dns.rdatatype.to_text(question.rdtype))
+        response = dns.message.make_response(query)
+        if question.name != self.origin:
+            response.set_rcode(dns.rcode.REFUSED)
+            return [response]
+        if question.rdtype == dns.rdatatype.SOA:
+            response.answer.append(self.soa_rrset())
+            return [response]
+        if question.rdtype == dns.rdatatype.IXFR and self.ixfr:
+            serial = query.authority[0][0].serial
+            if serial == self.serial:
+                response.answer.append(self.soa_rrset())
+                return [response]
+            if serial in self.history:
+                old = self.history[serial]
+                response.answer.append(self.soa_rrset())
+                response.answer.append(self.soa_rrset(serial))
+                for record in old:
+                    if record not in self.records:
+                        response.answer.append(self.rrset(*record))
+                response.answer.append(self.soa_rrset())
+                for record in self.records:
+                    if record not in old:
+                        response.answer.append(self.rrset(*record))
+                response.answer.append(self.soa_rrset())
+                return [response]
+        if question.rdtype in (dns.rdatatype.AXFR, dns.rdatatype.IXFR):
+            response.answer.append(self.soa_rrset())
+            for record in self.records:
+                response.answer.append(self.rrset(*record))
+            response.answer.append(self.soa_rrset())
+            return [response]
+        response.set_rcode(dns.rcode.NOTIMP)
+        return [response]
+
+    def handle_update(self, query):
+        response = dns.message.make_response(query)
+        self.updates.append(query)
+        if self.keyring is not None and not query.had_tsig:
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+        if self.fail_updates > 0:
+            self.fail_updates -= 1
+            response.set_rcode(dns.rcode.SERVFAIL)
+            return response
+        rcode = self.check_prerequisites(query.prerequisite)
+        if rcode != dns.rcode.NOERROR:
+            response.set_rcode(rcode)
+            return response
+        records = list(self.records)
+        for rrset in query.update:
+            name = rrset.name.relativize(self.origin).to_text()
+            rdtype = dns.rdatatype.to_text(rrset.rdtype)
+            for rdata in rrset:
+                record = (name, rrset.ttl, rdtype, rdata.to_text())
+                if rrset.deleting is None:
+                    if record not in records:
+                        records.append(record)
+                else:
+                    records = [r for r in records if r[0] != name or r[2] != rdtype or r[3] != record[3]]
+        self.set_records(records, self.serial + 1)
+        return response
+
+    def check_prerequisites(self, prerequisites):
+        for rrset in prerequisites:
+            if rrset.ttl != 0:
+                # like BIND: "prerequisite TTL is not zero"
+                return dns.rcode.FORMERR
+            name = rrset.name.relativize(self.origin).to_text()
+            rdtype = dns.rdatatype.to_text(rrset.rdtype)
+            current = sorted(r[3] for r in self.records if r[0] == name and r[2] == rdtype)
+            if rrset.deleting == dns.rdataclass.NONE and len(current) > 0:
+                return dns.rcode.YXRRSET
+            if rrset.deleting == dns.rdataclass.ANY and len(current) == 0:
+                return dns.rcode.NXRRSET
+            if rrset.deleting is None and current != sorted(rdata.to_text() for rdata in rrset):
+                return dns.rcode.NXRRSET
+        return dns.rcode.NOERROR
@@ -0,0 +1,94 @@
+import unittest
+import importlib.util
+import os
+import time
+import prometheus_client as prometheus
+from gwHealth import GwHealth
+from gwStatusCache import GwStatusCache
+from gwLoadBalancer import GwLoadBalancer
+from dnsserver import DnsServer
+from gwstatusserver import GwStatusServer, gen_gwstatus
+
+BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+spec = importlib.util.spec_from_file_location("exporter", os.path.join(BASE, "prometheus-exporter", "exporter.py"))
+exporter = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(exporter)
+
+
+class ExporterTestCase(unittest.TestCase):
+    def test_collection(self):
+        gateways = {"gw01n03": {"doc": gen_gwstatus(preference=70)},
+                    "gw04n03": {"doc": gen_gwstatus(), "delay": 2},
+                    "gw05n03": {"code": 503}}
+        gateways["gw01n03"]["doc"]["timestamp"] -= 30
+        with GwStatusServer(gateways) as server:
+            urls = {gw: server.url(gw) for gw in gateways}
+            health = GwHealth()
+            results = {}
+            start = time.time()
+            status = exporter.download_gw_status(urls, health=health, timeout=5, results=results, deadline=0.5)
+            # the hung gateway does not hold up the others
+            self.assertLess(time.time() - start, 1.5)
+            self.assertEqual(["gw01n03"], list(status))
+            self.assertIsNone(results["gw01n03"]["error"])
+            self.assertEqual("deadline exceeded", results["gw04n03"]["error"])
+            self.assertIsNotNone(results["gw05n03"]["error"])
+            # 503 is a failure for the circuit breaker
+            self.assertEqual(1, health.state["gw05n03"]["failures"])
+
+            # the probe of an open circuit runs in the pool, a hung gateway does not hold up the others
+            probing = GwHealth(failureThreshold=1, retryInterval=0)
+            probing.record_failure("gw04n03")
+            start = time.time()
+            status = exporter.download_gw_status(urls, health=probing, timeout=5, deadline=0.5)
+            self.assertLess(time.time() - start, 1.5)
+            self.assertEqual(["gw01n03"], list(status))
+            self.assertEqual(1, probing.stats["probed"])
+            self.assertEqual(["gw04n03", "gw05n03"], probing.get_open())
+
+            collector = exporter.GwStatusCollector()
+            collector.update(urls, status, results, health)
+            registry = prometheus.CollectorRegistry()
+            registry.register(collector)
+            self.assertEqual(70, registry.get_sample_value("gw_loadbalancing_pref",
+                                                           {"gateway": "gw01n03", "segment": "1"}))
+            self.assertAlmostEqual(30, registry.get_sample_value("gw_loadbalancing_status_age_seconds",
+                                                                 {"gateway": "gw01n03"}), delta=2)
+            self.assertEqual(1, registry.get_sample_value("gw_loadbalancing_fetch_errors_total",
+                                                          {"gateway": "gw04n03"}))
+            self.assertEqual(0, registry.get_sample_value("gw_loadbalancing_fetch_errors_total",
+                                                          {"gateway": "gw01n03"}))
+            self.assertEqual(1, registry.get_sample_value("gw_loadbalancing_fetch_duration_seconds_count",
+                                                          {"gateway": "gw05n03"}))
+            self.assertEqual(1, registry.get_sample_value("gw_loadbalancing_fetch_duration_seconds_bucket",
+                                                          {"gateway": "gw01n03", "le": "0.5"}))
+            self.assertIsNotNone(registry.get_sample_value("gw_loadbalancing_last_success_timestamp_seconds",
+                                                           {"gateway": "gw01n03"}))
+            self.assertIsNone(registry.get_sample_value("gw_loadbalancing_last_success_timestamp_seconds",
+                                                        {"gateway": "gw05n03"}))
+            self.assertEqual(0, registry.get_sample_value("gw_loadbalancing_circuit_open", {"gateway": "gw05n03"}))
+            self.assertIn(b"gw_loadbalancing_circuit_probes_total 0.0", prometheus.generate_latest(registry))
+
+    def test_discovery(self):
+        records = [("gw01n03", 300, "A", "10.0.0.1"), ("gw05n03", 300, "A", "10.0.0.5"), ("gw05s01", 300, "A", "10.0.0.5")]
+        with DnsServer(records=records, serial=1) as server:
+            lb = GwLoadBalancer()
+            lb.localhost = "monitor"
+            lb.dnsServer = "127.0.0.1"
+            lb.dnsPort = server.port
+            urls = exporter.discover_gwstatus_urls(lb)
+            self.assertEqual({"gw01n03": "http://gw01n03.gw.freifunk-stuttgart.de/data/gwstatus.json",
+                              "gw05n03": "http://gw05n03.gw.freifunk-stuttgart.de/data/gwstatus.json"}, urls)
+
+            collector = exporter.GwStatusCollector()
+            health = GwHealth()
+            cache = GwStatusCache()
+            collector.update(urls, {gw: gen_gwstatus() for gw in urls},
+                             {gw: {"duration": 0.1, "error": None} for gw in urls}, health)
+            server.set_records([("gw05n03", 300, "A", "10.0.0.5"), ("gw07n01", 300, "A", "10.0.0.7")], 2)
+            urls = exporter.update_targets(urls, exporter.discover_gwstatus_urls(lb), collector, health, cache)
+        self.assertEqual(["gw05n03", "gw07n01"], sorted(urls))
+        registry = prometheus.CollectorRegistry()
+        registry.register(collector)
+        self.assertIsNone(registry.get_sample_value("gw_loadbalancing_pref", {"gateway": "gw01n03", "segment": "1"}))
+        self.assertEqual(50, registry.get_sample_value("gw_loadbalancing_pref", {"gateway": "gw05n03", "segment": "1"}))
@@ -0,0 +1,194 @@
+import unittest
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from gwPreferenceTable import PreferenceTable
+
+BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+spec = importlib.util.spec_from_file_location("fastdverify", os.path.join(BASE, "fastd-verify.py"))
+fastdverify = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fastdverify)
+
+KEY1 = "a1" * 32
+KEY2 = "b2" * 32
+
+
+class FastdVerifyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.keyfolder = os.path.join(self.tmpdir.name, "peers")
+        os.mkdir(self.keyfolder)
+        self.write_key("node1", KEY1)
+        self.gwstatus = os.path.join(self.tmpdir.name, "gwstatus.json")
+        with open(self.gwstatus, "w") as fp:
+            json.dump({"version": "1", "timestamp": int(time.time()),
+                       "segments": {"1": {"preference": 80}, "2": {"preference": 20}}}, fp)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_key(self, name, key):
+        with open(os.path.join(self.keyfolder, name), "w") as fp:
+            fp.write('# node %s\nkey "%s";\n' % (name, key))
+
+    def start_server(self):
+        socketPath = os.path.join(self.tmpdir.name, "verify.sock")
+        threading.Thread(target=fastdverify.Serve, args=(socketPath, self.keyfolder, self.gwstatus),
+                         daemon=True).start()
+        for i in range(100):
+            if os.path.exists(socketPath):
+                break
+            time.sleep(0.01)
+        return socketPath
+
+    def run_client(self, socketPath, interface, key):
+        env = dict(os.environ, INTERFACE=interface, PEER_KEY=key)
+        return subprocess.call([sys.executable, os.path.join(BASE, "fastd-verify-client.py"), socketPath,
+                                "-k", self.keyfolder, "-g", self.gwstatus], env=env)
+
+    def test_get_delay(self):
+        self.assertEqual(fastdverify.OVERLOAD_DELAY, fastdverify.GetDelay(0))
+        self.assertEqual(fastdverify.MAX_DELAY, fastdverify.GetDelay(10))
+        self.assertAlmostEqual(2.0, fastdverify.GetDelay(30))
+        self.assertEqual(0.0, fastdverify.GetDelay(50))
+        self.assertEqual(0.0, fastdverify.GetDelay(100))
+
+    def test_admission_controller(self):
+        admission = fastdverify.AdmissionController(Burst=2.0)
+        # preference above 50 is not limited
+        for i in range(10):
+            self.assertEqual(fastdverify.ADMIT, admission.Admit(1, 80, Now=0.0))
+        # preference 30 allows one peer every 2 seconds after the burst
+        self.assertEqual(fastdverify.ADMIT, admission.Admit(2, 30, Now=0.0))
+        self.assertEqual(fastdverify.ADMIT, admission.Admit(2, 30, Now=0.0))
+        self.assertEqual(fastdverify.DEFER, admission.Admit(2, 30, Now=1.0))
+        self.assertEqual(fastdverify.ADMIT, admission.Admit(2, 30, Now=2.0))
+        self.assertEqual(fastdverify.DEFER, admission.Admit(2, 30, Now=2.5))
+        self.assertEqual({'admitted': {1: 10, 2: 3}, 'deferred': {2: 2}}, admission.GetStats())
+        self.assertIsNone(fastdverify.GetAdmissionRate(60))
+        self.assertAlmostEqual(1.0 / fastdverify.OVERLOAD_DELAY, fastdverify.GetAdmissionRate(0))
+
+    def test_verifier(self):
+        verifier = fastdverify.FastdVerifier(self.keyfolder, self.gwstatus)
+        self.assertEqual(fastdverify.ADMIT, verifier.Verify("vpn01", KEY1))
+        self.assertEqual(fastdverify.ADMIT, verifier.Verify("vpn02", KEY1))
+        self.assertEqual(fastdverify.ADMIT, verifier.Verify("vpn02", KEY1))
+        self.assertEqual(fastdverify.DEFER, verifier.Verify("vpn02", KEY1))
+        self.assertEqual(fastdverify.REJECT, verifier.Verify("vpn01", KEY2))
+        self.write_key("node2", KEY2)
+        self.assertEqual(fastdverify.ADMIT, verifier.Verify("vpn01", KEY2))
+        self.assertEqual({'admitted': {1: 2, 2: 2}, 'deferred': {2: 1}, 'rejected': 1}, verifier.GetStats())
+
+    def test_verifier_lock(self):
+        verifier = fastdverify.FastdVerifier(self.keyfolder, self.gwstatus)
+        verifier.Refresh()
+        verdicts = []
+        # nothing changed, requests do not wait for a refresh holding the lock
+        with verifier.Lock:
+            thread = threading.Thread(target=lambda: verdicts.append(verifier.Verify("vpn01", KEY1)))
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual([fastdverify.ADMIT], verdicts)
+
+        # a changed folder is picked up by the first request taking the lock
+        self.write_key("node2", KEY2)
+        self.assertTrue(verifier.IsRefreshDue())
+        threads = [threading.Thread(target=lambda: [verifier.Verify("vpn01", "c3" * 32) for i in range(50)])
+                   for j in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse(verifier.IsRefreshDue())
+        self.assertIn(KEY2, verifier.KeyIndex)
+        self.assertEqual(400, verifier.GetStats()['rejected'])
+
+    def test_one_shot(self):
+        stateFile = os.path.join(self.tmpdir.name, "admission.state")
+        self.assertEqual(fastdverify.ADMIT, fastdverify.OneShotAdmit(stateFile, 2, 30, Now=100.0))
+        self.assertEqual(fastdverify.ADMIT, fastdverify.OneShotAdmit(stateFile, 2, 30, Now=100.0))
+        self.assertEqual(fastdverify.DEFER, fastdverify.OneShotAdmit(stateFile, 2, 30, Now=101.0))
+        self.assertEqual(fastdverify.ADMIT, fastdverify.OneShotAdmit(stateFile, 2, 30, Now=102.0))
+        self.assertEqual(fastdverify.ADMIT, fastdverify.OneShotAdmit(stateFile, 1, 80, Now=102.0))
+
+        # the hook answers right away, a deferred peer is refused instead of being delayed
+        env = dict(os.environ, INTERFACE="vpn02", PEER_KEY=KEY1)
+        command = [sys.executable, os.path.join(BASE, "fastd-verify.py"), "-k", self.keyfolder, "-g", self.gwstatus,
+                   "-a", os.path.join(self.tmpdir.name, "hook.state")]
+        start = time.monotonic()
+        self.assertEqual([0, 0, 1], [subprocess.call(command, env=env) for i in range(3)])
+        self.assertLess(time.monotonic() - start, fastdverify.GetDelay(20))
+
+    def test_key_index(self):
+        index = fastdverify.FastdKeyIndex(self.keyfolder)
+        self.assertIn(KEY1, index)
+        self.assertIn(KEY1.upper(), index)
+        self.assertNotIn(KEY1[:32], index)
+        self.assertNotIn(KEY2, index)
+        self.assertEqual(1, len(index))
+
+        with open(os.path.join(self.keyfolder, "node2"), "w") as fp:
+            fp.write('# key "%s";\n' % (KEY2))
+        self.write_key("node3", KEY1)
+        index.Refresh()
+        self.assertNotIn(KEY2, index)
+
+        os.remove(os.path.join(self.keyfolder, "node1"))
+        index.Refresh()
+        self.assertIn(KEY1, index)
+        os.remove(os.path.join(self.keyfolder, "node3"))
+        index.Refresh()
+        self.assertNotIn(KEY1, index)
+
+        # files edited in place are picked up by the periodic rescan
+        with open(os.path.join(self.keyfolder, "node2"), "w") as fp:
+            fp.write('key "%s";\n' % (KEY2))
+        index.LastScan = 0
+        index.Refresh()
+        self.assertIn(KEY2, index)
+
+    def test_client(self):
+        socketPath = self.start_server()
+        self.assertEqual(0, self.run_client(socketPath, "vpn01", KEY1))
+        self.assertEqual(1, self.run_client(socketPath, "vpn01", KEY2))
+        self.assertEqual(0, self.run_client(socketPath, "vpn02", KEY1))
+        self.assertEqual(0, self.run_client(socketPath, "vpn02", KEY1))
+        self.assertEqual(1, self.run_client(socketPath, "vpn02", KEY1))
+
+    def test_client_fallback(self):
+        socketPath = os.path.join(self.tmpdir.name, "missing.sock")
+        self.assertEqual(0, self.run_client(socketPath, "vpn01", KEY1))
+        self.assertEqual(1, self.run_client(socketPath, "vpn01", KEY2))
+
+    def test_preference_table(self):
+        tableFile = os.path.join(self.tmpdir.name, "preference.table")
+        table = PreferenceTable(tableFile, segments=2)
+        table.update({1: 30}, time.time())
+        table.update({2: 90}, time.time() - 2 * fastdverify.TABLE_MAX_AGE)
+
+        # segment 1 from the table, segment 2 is stale there and taken from gwstatus.json
+        self.assertEqual(30, fastdverify.GetGwPreference(self.gwstatus, 1, tableFile))
+        self.assertEqual(20, fastdverify.GetGwPreference(self.gwstatus, 2, tableFile))
+        self.assertEqual(80, fastdverify.GetGwPreference(self.gwstatus, 1, tableFile + ".missing"))
+
+        verifier = fastdverify.FastdVerifier(self.keyfolder, self.gwstatus, tableFile)
+        verifier.Refresh()
+        self.assertEqual(30, verifier.GetGwPreference(1))
+        table.set(1, 45, time.time())
+        self.assertEqual(45, verifier.GetGwPreference(1))
+        self.assertEqual(20, verifier.GetGwPreference(2))
+        table.close()
+
+        # a recreated table is reopened
+        os.remove(tableFile)
+        table = PreferenceTable(tableFile, segments=4)
+        table.set(3, 60, time.time())
+        table.close()
+        verifier.Refresh()
+        self.assertEqual(60, verifier.GetGwPreference(3))
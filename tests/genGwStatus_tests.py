@@ -0,0 +1,43 @@
+import unittest
+import os
+import gzip
+import json
+import tempfile
+import genGwStatus
+from gwPreferenceTable import PreferenceTable
+
+
+class GenGwStatusTestCase(unittest.TestCase):
+    def test_gen_json(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output = os.path.join(folder, "gwstatus.json")
+            data = genGwStatus.genData(2, segmentPreferences={1: 80, 2: 60})
+            genGwStatus.genJson(data, output)
+            with open(output, "rb") as fp:
+                content = fp.read()
+            self.assertNotIn(b" ", content)
+            self.assertEqual({"1": {"preference": 80}, "2": {"preference": 60}}, json.loads(content)["segments"])
+            with gzip.open(output + ".gz", "rb") as fp:
+                self.assertEqual(content, fp.read())
+            self.assertEqual(0o644, os.stat(output).st_mode & 0o777)
+            self.assertEqual(["gwstatus.json", "gwstatus.json.gz"], sorted(os.listdir(folder)))
+
+    def test_smoother(self):
+        smoother = genGwStatus.PreferenceSmoother(alpha=0.5, hysteresis=2)
+        self.assertEqual({1: 80, 2: 50}, smoother.update({1: 80, 2: 50}))
+        # 80 -> 79 and 50 -> 52.5 after smoothing: only segment 2 moved far enough
+        self.assertEqual({1: 80, 2: 52}, smoother.update({1: 78, 2: 55}))
+        self.assertEqual({1: 77, 2: 52}, smoother.update({1: 75, 2: 52}))
+
+        smoother = genGwStatus.PreferenceSmoother(alpha=1, hysteresis=0)
+        self.assertEqual({1: 10}, smoother.update({1: 10}))
+        self.assertEqual({1: 11}, smoother.update({1: 11}))
+
+    def test_publish_table(self):
+        with tempfile.TemporaryDirectory() as folder:
+            output = os.path.join(folder, "gwstatus.json")
+            table = PreferenceTable(os.path.join(folder, "preference.table"), segments=2)
+            data = genGwStatus.genData(2, segmentPreferences={1: 80, 2: 60})
+            genGwStatus.publish(data, output, table)
+            self.assertEqual((60, data["timestamp"]), table.get(2))
+            table.close()
@@ -1,7 +1,19 @@
 import unittest
 import time
 import tempfile
+import random
+import threading
+import dns.name
+import dns.query
+import dns.rdataset
+import dns.update
 from gwLoadBalancer import *
+from gwStatusMatrix import StatusMatrix
+from gwStability import GwStability
+from gwMetrics import GwRunStatsCollector, prometheus_client
+from gwTrace import get_tracer
+from dnsserver import DnsServer
+from gwstatusserver import GwStatusServer, gen_gwstatus
 
 
 class GwLoadBalancerTestCase(unittest.TestCase):
@@ -71,6 +83,112 @@ gw09s02.gw.freifunk-stuttgart.de. 300 IN AAAA	2001:8d8:1801:35f::92
         lb.dns_zone_transfer()
         self.assertIsNot("", lb.zoneData)
 
+    def get_zone_records(self):
+        records = []
+        for line in self.zoneData.strip().split("\n"):
+            fields = line.split()
+            if len(fields) == 5:
+                records.append((fields[0].split(".")[0], int(fields[1]), fields[3], fields[4]))
+        return records
+
+    def test_dns_zone_transfer_local(self):
+        with DnsServer(records=self.get_zone_records(), serial=42) as server:
+            lb = GwLoadBalancer()
+            lb.dnsServer = "127.0.0.1"
+            lb.dnsPort = server.port
+            lb.dns_zone_transfer()
+        self.assertEqual(42, lb.zone.serial)
+        self.assertEqual(["gw01n03", "gw04n03", "gw05n03", "gw07n01", "gw09n02"], lb.zone.get_gws())
+        self.assertEqual("2a01:4f8:172:10ce::43", lb.get_record_for_gw("gw04n03", "AAAA"))
+        lb.get_ip_to_gw_lookup()
+        self.assertEqual(['gw01n03', 'gw05n03', 'gw07n01'], lb.get_active_gw_per_segment_from_dns(segment="1"))
+        self.assertEqual(GwZone.from_text(self.zoneData).records, GwZone.from_text(lb.zoneData).records)
+
+    def test_dns_zone_transfer_cache(self):
+        records = self.get_zone_records()
+        with DnsServer(records=records, serial=1) as server, tempfile.TemporaryDirectory() as tmpdir:
+            cache = os.path.join(tmpdir, "zone.json")
+            lb = GwLoadBalancer()
+            lb.dnsServer = "127.0.0.1"
+            lb.dnsPort = server.port
+            lb.zoneCache = cache
+            lb.dns_zone_transfer()
+            self.assertEqual(["AXFR"], server.queries)
+            self.assertTrue(os.path.isfile(cache))
+
+            # a new run with an unchanged serial only asks for the SOA record
+            lb = GwLoadBalancer()
+            lb.dnsServer = "127.0.0.1"
+            lb.dnsPort = server.port
+            lb.zoneCache = cache
+            lb.dns_zone_transfer()
+            self.assertEqual(["AXFR", "SOA"], server.queries)
+            self.assertEqual(records, [r for r in lb.zone.records])
+
+            # changes are fetched by IXFR
+            changed = [r for r in records if r[0] != "gw07s02"] + [("gw01s02", 300, "A", "88.198.230.6")]
+            server.set_records(changed, 2)
+            lb.dns_zone_transfer()
+            self.assertEqual(["AXFR", "SOA", "SOA", "IXFR"], server.queries)
+            self.assertEqual(2, lb.zone.serial)
+            self.assertEqual(sorted(changed), sorted(lb.zone.records))
+            self.assertEqual(["gw04n03", "gw05n03", "gw09n02", "gw01n03"], lb.get_active_gw_per_segment_from_dns("2"))
+            self.assertEqual(2, GwZone.load(cache).serial)
+
+            # without IXFR support the server answers with the full zone
+            server.ixfr = False
+            server.set_records(records, 3)
+            lb.dns_zone_transfer()
+            self.assertEqual(3, lb.zone.serial)
+            self.assertEqual(records, lb.zone.records)
+
+    def test_send_update(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".key") as keyfile:
+            keyfile.write('key "lb-test" {\n\talgorithm hmac-sha256;\n\tsecret "c2VjcmV0c2VjcmV0c2VjcmV0";\n};\n')
+            keyfile.flush()
+            tsigKey = read_tsig_key(keyfile.name)
+        with DnsServer(records=self.get_zone_records(), serial=1, keyring=tsigKey["keyring"]) as server:
+            lb = GwLoadBalancer()
+            lb.dnsServer = "127.0.0.1"
+            lb.dnsPort = server.port
+            lb.tsigKey = tsigKey
+            lb.updateBackoff = 0.01
+            lb.dns_zone_transfer()
+            lb.status = self.status
+            lb.target = "gw05n03"
+            lb.get_result()
+            self.assertEqual(dns.rcode.NOERROR, lb.send_update())
+            self.assertEqual(1, len(server.updates))
+            self.assertTrue(server.updates[0].had_tsig)
+            self.assertEqual([0, 0], [rrset.ttl for rrset in server.updates[0].prerequisite])
+            self.assertNotIn(("gw05s02", 300, "A", "93.186.197.153"), server.records)
+            self.assertNotIn(("gw05s02", 300, "AAAA", "2001:4ba0:ffff:150::1"), server.records)
+            self.assertIn(("gw04s02", 300, "A", "138.201.55.210"), server.records)
+
+            # the zone changed since the transfer, the prerequisites reject the update
+            lb.target = "gw04n03"
+            lb.get_result()
+            server.set_records([r for r in server.records if r[0] != "gw04s02"], 3)
+            self.assertEqual(dns.rcode.NXRRSET, lb.send_update())
+
+            # SERVFAIL is retried
+            lb.dns_zone_transfer()
+            lb.target = "gw09n02"
+            lb.get_result()
+            server.fail_updates = 2
+            self.assertEqual(dns.rcode.NOERROR, lb.send_update())
+            self.assertIn(("gw09s01", 300, "A", "212.227.213.45"), server.records)
+            self.assertEqual(5, len(server.updates))
+
+            # a prerequisite with a TTL is a format error
+            update = dns.update.UpdateMessage(dns.name.from_text(lb.dnsZone), keyring=tsigKey["keyring"],
+                                              keyname=tsigKey["keyname"])
+            update.present("gw09s01", dns.rdataset.from_text("IN", "A", 300, "212.227.213.45"))
+            update.delete("gw09s01", "A", "212.227.213.45")
+            response = dns.query.tcp(update, "127.0.0.1", port=server.port, timeout=5)
+            self.assertEqual(dns.rcode.FORMERR, response.rcode())
+            self.assertIn(("gw09s01", 300, "A", "212.227.213.45"), server.records)
+
     def test_get_available_gw_from_dns(self):
         lb = GwLoadBalancer()
         lb.zoneData = """gw01n03.gw.freifunk-stuttgart.de. 300 IN A	88.198.230.6
@@ -129,6 +247,24 @@ gw01n03.gw.freifunk-stuttgart.de. 300 IN AAAA	2a01:4f8:190:5205:260:2fff:fe08:13
         expextedGws = ["gw07n01", "gw04n01", "gw05n03", "gw04n03", "gw09n02"]
         self.assertEqual(expextedGws, list(lb.allGws.keys()))
 
+    def test_get_available_gw_from_batctl_debugfs(self):
+        lb = GwLoadBalancer()
+        lb.localhost = "gw05n03"
+        lb.segments = 3
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lb.batmanDebugfs = tmpdir
+            for (seg, lines) in ((1, ["  02:00:38:01:07:01 (255) 02:00:35:01:07:01 [      bb01]: 64.0/64.0 MBit",
+                                      "=> 02:00:35:01:04:01 (255) 02:00:35:01:04:01 [      bb01]: 64.0/64.0 MBit"]),
+                                 (2, []),
+                                 (3, ["=> 02:00:38:03:09:02 (255) 02:00:35:03:09:02 [      bb03]: 64.0/64.0 MBit"])):
+                os.mkdir(os.path.join(tmpdir, "bat%02i" % (seg)))
+                with open(os.path.join(tmpdir, "bat%02i" % (seg), "gateways"), "w") as fp:
+                    fp.write("[B.A.T.M.A.N. adv 2019.0, MainIF/MAC: bb%02i/02:00:35:%02i:05:03 (bat%02i/02:00:39:%02i:05:03 BATMAN_IV)]\n" % (seg, seg, seg, seg))
+                    fp.write("      Router            ( TQ) Next Hop          [outgoingIf]  Bandwidth\n")
+                    fp.write("".join(line + "\n" for line in lines))
+            lb.get_available_gw_from_batctl()
+        self.assertEqual(["gw07n01", "gw04n01", "gw09n02", "gw05n03"], list(lb.allGws.keys()))
+
     def test_add_self_to_gws(self):
         lb = GwLoadBalancer()
         lb.localhost = "gw01n03"
@@ -186,6 +322,244 @@ gw01n03.gw.freifunk-stuttgart.de. 300 IN AAAA	2a01:4f8:190:5205:260:2fff:fe08:13
         self.assertIn("1", lb.allGws[gw]["segments"])
         self.assertIn("2", lb.allGws[gw]["segments"])
 
+    def test_get_all_status_local(self):
+        gateways = {
+            "gw01n03": {"doc": gen_gwstatus()},
+            "gw04n03": {"doc": gen_gwstatus(), "delay": 0.2},
+            "gw05n03": {"code": 503},
+            "gw09n02": {"doc": gen_gwstatus(), "delay": 3},
+            "gw01n01": {"body": b"{no json"},
+            "gw01n02": {"body": b"[1, 2]"},
+        }
+        with GwStatusServer(gateways) as server:
+            lb = GwLoadBalancer()
+            lb.get_gw_status_url = server.url
+            lb.fetchDeadline = 0.5
+            lb.allGws = {gw: {} for gw in list(gateways) + ["gw07n01"]}
+            start = time.time()
+            lb.get_all_status()
+            self.assertLess(time.time() - start, 1.5)
+            # the fetch of gw09n02 is abandoned, it does not hold up the exit of a one-shot run
+            self.assertTrue(all(t.daemon for t in threading.enumerate() if t.name.startswith("gwfetch")))
+        self.assertEqual(["gw01n03", "gw04n03", "gw05n03", "gw09n02", "gw01n01", "gw01n02", "gw07n01"],
+                         list(lb.allGws.keys()))
+        # malformed documents only fail their gateway
+        self.assertEqual({}, lb.allGws["gw01n01"])
+        self.assertEqual({}, lb.allGws["gw01n02"])
+        self.assertEqual(1, lb.health.state["gw01n01"]["failures"])
+        self.assertIn("1", lb.allGws["gw01n03"]["segments"])
+        self.assertIn("1", lb.allGws["gw04n03"]["segments"])
+        self.assertEqual({}, lb.allGws["gw05n03"])
+        self.assertEqual({}, lb.allGws["gw09n02"])
+        self.assertEqual({}, lb.allGws["gw07n01"])
+
+    def test_run_cycle(self):
+        gateways = {}
+        for (segment, gws) in self.status.items():
+            for (gw, data) in gws.items():
+                gateways.setdefault(gw, {"doc": {"version": "1", "timestamp": int(time.time()), "segments": {}}})
+                gateways[gw]["doc"]["segments"][segment] = data
+        with DnsServer(records=self.get_zone_records()) as dnsServer, GwStatusServer(gateways) as server:
+            lb = GwLoadBalancer()
+            lb.localhost = "lb01"
+            lb.target = "gw09n02"
+            lb.dnsServer = "127.0.0.1"
+            lb.dnsPort = dnsServer.port
+            lb.get_gw_status_url = server.url
+            self.assertTrue(lb.run_cycle())
+            self.assertEqual(["AXFR"], dnsServer.queries)
+            self.assertEqual(5, server.requests)
+            self.assertIn("update add gw09s01.gw.freifunk-stuttgart.de. 300 A 212.227.213.45", lb.commands_local)
+
+            # the second cycle reuses zone and gateway list
+            lastDiscovery = lb.lastDiscovery
+            del gateways["gw04n03"]
+            self.assertTrue(lb.run_cycle())
+            self.assertEqual(["AXFR", "SOA"], dnsServer.queries)
+            self.assertEqual(lastDiscovery, lb.lastDiscovery)
+            self.assertEqual(10, server.requests)
+            self.assertEqual(["gw01n03", "gw04n03", "gw05n03", "gw07n01", "gw09n02"], list(lb.allGws.keys()))
+            self.assertNotIn("gw04n03", lb.status["1"])
+            self.assertIn("update add gw09s01.gw.freifunk-stuttgart.de. 300 A 212.227.213.45", lb.commands_local)
+
+    def test_run_metrics(self):
+        gateways = {}
+        for (segment, gws) in self.status.items():
+            for (gw, data) in gws.items():
+                gateways.setdefault(gw, {"doc": {"version": "1", "timestamp": int(time.time()), "segments": {}}})
+                gateways[gw]["doc"]["segments"][segment] = data
+        gateways["gw07n01"]["doc"]["timestamp"] -= 3600
+        gateways["gw04n03"] = {"code": 503}
+        with DnsServer(records=self.get_zone_records()) as dnsServer, GwStatusServer(gateways) as server, \
+                tempfile.TemporaryDirectory() as folder:
+            lb = GwLoadBalancer()
+            lb.localhost = "lb01"
+            lb.target = "gw09n02"
+            lb.dnsServer = "127.0.0.1"
+            lb.dnsPort = dnsServer.port
+            lb.get_gw_status_url = server.url
+            lb.textfile = os.path.join(folder, "gwloadbalancer.prom")
+            self.assertEqual(0, lb.run(os.path.join(folder, "nsupdate.txt")))
+            self.assertEqual({"1": ["gw09n02"]}, lb.result.added)
+            self.assertEqual("GWs that have to be added in Segement 1 to dns: gw09n02\n", lb.result.report())
+
+            last = lb.runStats.last
+            self.assertEqual("ok", last["result"])
+            self.assertEqual(["discovery", "fetch", "plan", "publish", "validate", "zone"], sorted(last["phases"]))
+            self.assertEqual({("1", "add"): 2}, last["records"])
+            self.assertEqual({"stale": 1}, last["rejected"])
+            self.assertEqual({"fetched": 4, "failed": 1}, last["gateways"])
+            self.assertEqual({"skipped": 0, "probed": 0, "recovered": 0, "opened": 0}, last["breaker"])
+            with open(lb.textfile) as fp:
+                textfile = fp.read()
+            self.assertIn('gw_loadbalancer_segment_records_changed{action="add",segment="1"} 2.0\n', textfile)
+            self.assertIn('gw_loadbalancer_gateways_rejected{reason="stale"} 1.0\n', textfile)
+            self.assertIn("gw_loadbalancer_last_run_success 1.0\n", textfile)
+            self.assertIn('gw_loadbalancer_circuit_breaker_gateways{event="skipped"} 0.0\n', textfile)
+            self.assertNotIn("gw_loadbalancer_cycles", textfile)
+
+            registry = prometheus_client.CollectorRegistry()
+            registry.register(GwRunStatsCollector(lb.runStats))
+            self.assertEqual(1, registry.get_sample_value("gw_loadbalancer_cycles_total", {"result": "ok"}))
+            self.assertEqual(2, registry.get_sample_value("gw_loadbalancer_records_changed_total", {"action": "add"}))
+            self.assertIsNotNone(registry.get_sample_value("gw_loadbalancer_phase_duration_seconds", {"phase": "fetch"}))
+
+    def test_profile(self):
+        gateways = {gw: {"doc": gen_gwstatus()} for gw in ("gw01n03", "gw05n03")}
+        with DnsServer(records=self.get_zone_records()) as dnsServer, GwStatusServer(gateways) as server, \
+                tempfile.TemporaryDirectory() as folder:
+            lb = GwLoadBalancer()
+            self.assertFalse(lb.tracer.enabled)
+            lb.localhost = "lb01"
+            lb.dnsServer = "127.0.0.1"
+            lb.dnsPort = dnsServer.port
+            lb.get_gw_status_url = server.url
+            # the documents are rejected as stale, only the spans matter here
+            lb.maxAgeInSeconds = 0
+            lb.set_tracer(get_tracer(os.path.join(folder, "trace.json"), os.path.join(folder, "profile.pstats")))
+            lb.tracer.start()
+            lb.run()
+            with open(os.path.join(folder, "trace.json")) as fp:
+                trace = json.load(fp)
+            self.assertTrue(os.path.getsize(os.path.join(folder, "profile.pstats")) > 0)
+        spans = [event["name"] for event in trace["traceEvents"] if event["ph"] == "X"]
+        for name in ("zone", "discovery", "fetch", "validate", "fetch gw01n03", "fetch gw09n02"):
+            self.assertIn(name, spans)
+        fetch = [event for event in trace["traceEvents"] if event["name"] == "fetch"][0]
+        gw = [event for event in trace["traceEvents"] if event["name"] == "fetch gw01n03"][0]
+        self.assertTrue(fetch["ts"] <= gw["ts"] and gw["ts"] + gw["dur"] <= fetch["ts"] + fetch["dur"])
+
+    def test_cluster_status(self):
+        lb = GwLoadBalancer()
+        lb.zoneData = self.zoneData
+        lb.status = self.status
+        lb.clusterKey = b"secret"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "clusterstatus.json")
+            lb.publish_cluster_status(output)
+            with open(output) as fp:
+                doc = json.load(fp)
+        self.assertEqual(self.status, doc["status"])
+        self.assertTrue(lb.validate_cluster_status(doc))
+
+        gateways = {"cluster": {"doc": doc}, "gw01n03": {"doc": self.gwstatus}}
+        with GwStatusServer(gateways) as server:
+            consumer = GwLoadBalancer()
+            consumer.zoneData = self.zoneData
+            consumer.clusterKey = b"secret"
+            consumer.clusterStatusUrl = server.url("cluster")
+            self.assertTrue(consumer.get_cluster_status())
+            self.assertEqual(self.status, consumer.status)
+            self.assertTrue(consumer.get_cluster_status())
+            self.assertEqual(2, server.requests)
+            self.assertEqual(1, server.notModified)
+
+            # wrong signature
+            consumer.clusterKey = b"other"
+            consumer.status = {}
+            self.assertFalse(consumer.get_cluster_status())
+            self.assertEqual({}, consumer.status)
+
+            # unsigned documents are not trusted
+            consumer.clusterKey = None
+            self.assertFalse(consumer.get_cluster_status())
+            self.assertEqual({}, consumer.status)
+
+            # stale document
+            consumer.clusterKey = b"secret"
+            consumer.clusterStatusMaxAge = -1
+            self.assertFalse(consumer.get_cluster_status())
+
+            # the consumer falls back to polling the gateways
+            consumer.allGws = {"gw01n03": {}}
+            consumer.lastDiscovery = time.time()
+            consumer.get_gw_status_url = server.url
+            consumer.dns_zone_transfer = lambda: None
+            self.assertTrue(consumer.run_cycle())
+            self.assertEqual(["1", "2"], sorted(consumer.status.keys()))
+            self.assertEqual(["gw01n03"], list(consumer.status["1"].keys()))
+
+    def test_circuit_breaker(self):
+        gateways = {"gw01n03": {"doc": gen_gwstatus()}, "gw09n02": {"doc": gen_gwstatus()}}
+        with GwStatusServer(gateways) as server, tempfile.TemporaryDirectory() as tmpdir:
+            down = socket.socket()
+            down.bind(("127.0.0.1", 0))
+            downUrl = "http://127.0.0.1:%i/data/gwstatus.json" % (down.getsockname()[1])
+            up = {"gw09n02": False}
+
+            def url(gw):
+                if gw == "gw09n02" and not up[gw]:
+                    return downUrl
+                return server.url(gw)
+
+            state = os.path.join(tmpdir, "health.json")
+            for run in range(3):
+                lb = GwLoadBalancer()
+                lb.health = GwHealth(state, failureThreshold=2)
+                lb.get_gw_status_url = url
+                lb.allGws = {"gw01n03": {}, "gw09n02": {}}
+                lb.get_all_status()
+                self.assertEqual({}, lb.allGws["gw09n02"])
+                self.assertIn("segments", lb.allGws["gw01n03"])
+            self.assertEqual(["gw09n02"], lb.health.get_open())
+            self.assertEqual(1, lb.health.stats["skipped"])
+            lb.runStats.count_gateways(lb.allGws, lb.health.stats)
+            lb.runStats.finish_cycle("ok")
+            self.assertIn('gw_loadbalancer_circuit_breaker_gateways{event="skipped"} 1.0\n',
+                          lb.runStats.format_textfile())
+
+            # the gateway is back, the probe closes the circuit and it is fetched again
+            up["gw09n02"] = True
+            requests = server.requests
+            lb = GwLoadBalancer()
+            lb.health = GwHealth(state, retryInterval=0)
+            lb.get_gw_status_url = url
+            lb.allGws = {"gw01n03": {}, "gw09n02": {}}
+            lb.get_all_status()
+            self.assertEqual(1, lb.health.stats["probed"])
+            self.assertEqual(1, lb.health.stats["recovered"])
+            self.assertIn("segments", lb.allGws["gw09n02"])
+            self.assertEqual([], GwHealth(state).get_open())
+            self.assertEqual(requests + 2, server.requests)
+            down.close()
+
+            # a gateway answering 503 is reachable, but neither a fetch nor a probe counts it as healthy
+            gateways["gw09n02"] = {"code": 503}
+            lb = GwLoadBalancer()
+            lb.health = GwHealth(failureThreshold=1)
+            lb.get_gw_status_url = server.url
+            lb.allGws = {"gw09n02": {}}
+            lb.get_all_status()
+            self.assertEqual(["gw09n02"], lb.health.get_open())
+            self.assertFalse(lb.health.probe("gw09n02", server.url("gw09n02")))
+            lb.health.retryInterval = 0
+            lb.get_all_status()
+            self.assertEqual(1, lb.health.stats["probed"])
+            self.assertEqual(["gw09n02"], lb.health.get_open())
+            gateways["gw09n02"] = {"doc": gen_gwstatus()}
+            self.assertTrue(lb.health.probe("gw09n02", server.url("gw09n02")))
+            self.assertEqual([], lb.health.get_open())
+
     def test_get_status(self):
         lb = GwLoadBalancer()
         gw = "gw01n03"
@@ -195,6 +569,32 @@ gw01n03.gw.freifunk-stuttgart.de. 300 IN AAAA	2a01:4f8:190:5205:260:2fff:fe08:13
         lb.get_status()
         self.assertIn(gw, lb.status["1"])
 
+    def test_get_status_coerces_preference(self):
+        # float and out of range preferences must not fail the int arrays of StatusMatrix
+        lb = GwLoadBalancer()
+        lb.zoneData = self.zoneData
+        lb.get_ip_to_gw_lookup()
+        lb.runStats.start_cycle()
+        now = int(time.time())
+        lb.allGws = {
+            "gw01n03": {"timestamp": now, "segments": {"1": {"preference": 50.5, "dnsactive": 1},
+                                                       "2": {"preference": -3e9, "dnsactive": 0}}},
+            "gw09n02": {"timestamp": now, "segments": {"1": {"preference": 3 * 2 ** 31, "dnsactive": 0},
+                                                       "2": {"preference": 60, "dnsactive": 1}}},
+            "gw04n03": {"timestamp": now, "segments": {"2": {"preference": "80", "dnsactive": 1}}},
+            "gw05n03": {"timestamp": now, "segments": {"1": {"preference": float("nan"), "dnsactive": 1}}},
+        }
+        lb.get_status()
+        self.assertEqual({"gw01n03": {"preference": 50, "dnsactive": 1},
+                          "gw09n02": {"preference": 2 ** 30, "dnsactive": 0}}, lb.status["1"])
+        self.assertEqual(-2 ** 30, lb.status["2"]["gw01n03"]["preference"])
+        self.assertEqual(50.5, lb.allGws["gw01n03"]["segments"]["1"]["preference"])
+        self.assertEqual({"malformed": 2}, lb.runStats.current["rejected"])
+        for strategy in ("segment", "global"):
+            lb.strategy = strategy
+            lb.stability = GwStability(margin=5)
+            self.assertIn("GWs that have to be added in Segement 1 to dns: gw09n02\n", lb.get_result())
+
     def test_get_all_gws_in_segment(self):
         lb = GwLoadBalancer()
         lb.status = self.status
@@ -281,6 +681,143 @@ GWs that have to be removed in Segement 2 from dns: gw04n03 gw05n03
         for cmd in expected:
             self.assertIn(cmd, lb.commands_local)
 
+    def test_status_matrix_plan(self):
+        # the plan of all segments equals the per segment methods, including ties and missing gateways
+        rnd = random.Random(1)
+        status = {}
+        for segment in range(1, 50):
+            status[str(segment)] = {}
+            for gw in rnd.sample(["gw%02in%02i" % (i, j) for i in range(1, 10) for j in range(1, 4)], rnd.randrange(1, 12)):
+                status[str(segment)][gw] = {"preference": rnd.choice([0, 10, 50, 50, 80, 100]),
+                                            "dnsactive": rnd.choice([0, 1])}
+        status["1"] = self.status["1"]
+        lb = GwLoadBalancer()
+        for desired in (1, 2, 3):
+            lb.desiredGwPerSegment = desired
+            for statusUnderTest in (status, self.status):
+                lb.status = statusUnderTest
+                plan = StatusMatrix(statusUnderTest).plan(desired)
+                self.assertEqual(list(statusUnderTest), list(plan))
+                for segment in statusUnderTest:
+                    self.assertEqual((lb.get_best_gw_for_segment(segment),
+                                      lb.get_gws_that_have_to_be_added_to_dns(segment),
+                                      lb.get_gws_that_have_to_removed_from_dns(segment)), plan[segment])
+
+    def test_status_matrix_plan_global(self):
+        # gw01n01 is the best gateway everywhere, the global strategy spreads the segments by capacity
+        status = {}
+        for segment in range(1, 7):
+            status[str(segment)] = {"gw01n01": {"preference": 90, "dnsactive": 1},
+                                    "gw02n01": {"preference": 80, "dnsactive": 1},
+                                    "gw03n01": {"preference": 70, "dnsactive": 0},
+                                    "gw04n01": {"preference": 60, "dnsactive": 0}}
+        matrix = StatusMatrix(status)
+        self.assertEqual([4, 4, 3, 3], matrix.get_capacities(2))
+        plan = matrix.plan_global(2)
+        self.assertEqual(list(status), list(plan))
+        self.assertEqual((["gw01n01", "gw02n01"], [], []), plan["1"])
+        self.assertEqual((["gw03n01", "gw04n01"], ["gw03n01", "gw04n01"], ["gw01n01", "gw02n01"]), plan["6"])
+        self.assertEqual(plan, StatusMatrix(status).plan_global(2))
+
+        # the gateways with capacity left are chosen, a gateway without a positive preference only if nothing is left
+        for (gw, dnsactive) in (("gw01n01", 0), ("gw02n01", 0), ("gw03n01", 1), ("gw04n01", 1)):
+            status["6"][gw]["dnsactive"] = dnsactive
+        status["5"]["gw03n01"] = {"preference": 0, "dnsactive": 1}
+        plan = StatusMatrix(status).plan_global(2)
+        self.assertEqual((["gw03n01", "gw04n01"], [], []), plan["6"])
+        self.assertEqual((["gw01n01", "gw04n01"], ["gw04n01"], ["gw02n01", "gw03n01"]), plan["5"])
+
+        # being in DNS only breaks ties of the preference
+        preferences = {"1": {"gw01n01": {"preference": 1, "dnsactive": 1},
+                             "gw02n01": {"preference": 100, "dnsactive": 0},
+                             "gw03n01": {"preference": 50, "dnsactive": 1}}}
+        self.assertEqual((["gw02n01", "gw03n01"], ["gw02n01"], ["gw01n01"]),
+                         StatusMatrix(preferences).plan_global(2)["1"])
+        preferences["1"]["gw01n01"]["preference"] = 100
+        preferences["1"]["gw03n01"]["preference"] = 100
+        self.assertEqual((["gw01n01", "gw03n01"], [], []), StatusMatrix(preferences).plan_global(2)["1"])
+
+        # a DNS change has to gain more than the change cost
+        preferences["1"]["gw02n01"] = {"preference": 104, "dnsactive": 0}
+        self.assertEqual((["gw01n01", "gw03n01"], [], []), StatusMatrix(preferences).plan_global(2, changeCost=5)["1"])
+        preferences["1"]["gw02n01"]["preference"] = 106
+        self.assertEqual((["gw02n01", "gw03n01"], ["gw02n01"], ["gw01n01"]),
+                         StatusMatrix(preferences).plan_global(2, changeCost=5)["1"])
+
+        # hard limit per gateway: never exceeded, the segments it blocks are short but not empty
+        limited = {}
+        for segment in range(1, 9):
+            limited[str(segment)] = {"gw01n01": {"preference": 90, "dnsactive": 1},
+                                     "gw02n01": {"preference": 80, "dnsactive": 1},
+                                     "gw03n01": {"preference": 70, "dnsactive": 0}}
+        for maxSegmentsPerGw in (1, 2, 3, 5):
+            plan = StatusMatrix(limited).plan_global(2, maxSegmentsPerGw=maxSegmentsPerGw)
+            for gw in ("gw01n01", "gw02n01", "gw03n01"):
+                self.assertTrue(len([best for (best, add, remove) in plan.values() if gw in best]) <= maxSegmentsPerGw)
+            sizes = sorted(len(best) for (best, add, remove) in plan.values())
+            self.assertEqual(min(16, 3 * maxSegmentsPerGw), sum(sizes))
+            if 3 * maxSegmentsPerGw >= 8:
+                self.assertTrue(sizes[0] > 0)
+        # the segments short of a gateway with room left switch to it: 15 of the 16 slots are used
+        self.assertEqual((["gw02n01", "gw03n01"], ["gw03n01"], ["gw01n01"]), plan["1"])
+        self.assertEqual((["gw03n01"], ["gw03n01"], ["gw01n01", "gw02n01"]), plan["8"])
+        plan = StatusMatrix(limited).plan_global(2, maxSegmentsPerGw=3)
+        self.assertEqual([1, 1, 2, 1, 1, 1, 1, 1], [len(plan[str(segment)][0]) for segment in range(1, 9)])
+
+        lb = GwLoadBalancer()
+        lb.status = status
+        lb.zoneData = self.zoneData
+        lb.strategy = "global"
+        lb.target = "gw01n01"
+        self.assertIn("GWs that have to be added in Segement 5 to dns: gw04n01\n", lb.get_result())
+        # the segments left short by the limit are counted
+        lb.status = limited
+        lb.maxSegmentsPerGw = 3
+        lb.get_result()
+        self.assertEqual(7, lb.runStats.current["short"])
+        lb.runStats.finish_cycle("ok")
+        self.assertIn("gw_loadbalancer_segments_short 7.0\n", lb.runStats.format_textfile())
+
+    def test_stability(self):
+        status = {"1": {"gw01n03": {"preference": 50, "dnsactive": 1},
+                        "gw04n03": {"preference": 48, "dnsactive": 1},
+                        "gw05n03": {"preference": 52, "dnsactive": 0}}}
+        lb = GwLoadBalancer()
+        lb.status = status
+        lb.zoneData = self.zoneData
+        lb.target = "gw05n03"
+        self.assertEqual("GWs that have to be added in Segement 1 to dns: gw05n03\n", lb.get_result())
+        self.assertEqual({}, lb.stability.state)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "stability.json")
+            # within the margin, the gateways in DNS stay
+            lb.stability = GwStability(path, margin=5)
+            self.assertEqual("All is fine!", lb.get_result())
+            self.assertEqual({"flipsAvoided": 2, "held": 0}, lb.stability.stats)
+            lb.runStats.finish_cycle("ok")
+            textfile = lb.runStats.format_textfile()
+            self.assertIn("gw_loadbalancer_dns_changes_avoided 2.0\n", textfile)
+            self.assertIn("gw_loadbalancer_dns_removals_held 0.0\n", textfile)
+            status["1"]["gw05n03"]["preference"] = 60
+            self.assertEqual("GWs that have to be added in Segement 1 to dns: gw05n03\n", lb.get_result())
+            self.assertEqual({"flipsAvoided": 0, "held": 0}, lb.stability.stats)
+
+            # gw05n03 entered DNS and is held back for the minimum dwell time
+            stability = GwStability(path, minDwell=600)
+            self.assertEqual({"gw01n03": 0, "gw04n03": 0, "gw05n03": None}, stability.state["1"])
+            status["1"]["gw05n03"] = {"preference": 30, "dnsactive": 1}
+            status["1"]["gw04n03"]["dnsactive"] = 0
+            plan = stability.plan(status, lambda matrix: matrix.plan(2), now=1000)
+            self.assertEqual((["gw01n03", "gw04n03"], ["gw04n03"], []), plan["1"])
+            self.assertEqual(1000, stability.state["1"]["gw05n03"])
+            status["1"]["gw04n03"]["dnsactive"] = 1
+            plan = stability.plan(status, lambda matrix: matrix.plan(2), now=1500)
+            self.assertEqual((["gw01n03", "gw04n03"], [], []), plan["1"])
+            self.assertEqual({"flipsAvoided": 1, "held": 1}, stability.stats)
+            plan = stability.plan(status, lambda matrix: matrix.plan(2), now=1600)
+            self.assertEqual((["gw01n03", "gw04n03"], [], ["gw05n03"]), plan["1"])
+
     def test_get_ip_to_gw_lookup(self):
         lb = GwLoadBalancer()
         lb.zoneData = self.zoneData
@@ -306,6 +843,31 @@ GWs that have to be removed in Segement 2 from dns: gw04n03 gw05n03
         active = lb.get_active_gw_per_segment_from_dns(segment="2")
         self.assertEqual(['gw04n03', 'gw05n03', 'gw07n01', 'gw09n02'], active)
 
+    def test_get_active_gw_per_segment_from_dns_unresolved(self):
+        lb = GwLoadBalancer()
+        lb.zoneData = self.zoneData + "gw08s03.gw.freifunk-stuttgart.de. 300 IN A\t10.0.0.8\n"
+        self.assertEqual(['gw04n03', 'gw05n03', 'gw07n01', 'gw09n02'], lb.get_active_gw_per_segment_from_dns("2"))
+        with self.assertRaises(KeyError):
+            lb.get_active_gw_per_segment_from_dns("3")
+
+    def test_zone_text(self):
+        lb = GwLoadBalancer()
+        lb.zoneData = self.zoneData
+        text = lb.zoneData
+        self.assertIs(text, lb.zoneData)
+        lb.zone.add_record("gw01s02.gw.freifunk-stuttgart.de.", 300, "A", "88.198.230.6")
+        self.assertIn("gw01s02.gw.freifunk-stuttgart.de. 300 IN A\t88.198.230.6\n", lb.zoneData)
+        lb.zone.remove_record("gw01s02.gw.freifunk-stuttgart.de.", "A", "88.198.230.6")
+        self.assertEqual(text, lb.zoneData)
+
+    def test_zone_index(self):
+        zone = GwZone.from_text(self.zoneData)
+        self.assertEqual(["gw01n03", "gw04n03", "gw05n03", "gw07n01", "gw09n02"], zone.get_gws())
+        self.assertEqual("163.172.12.135", zone.get_record("gw07n01", "A"))
+        self.assertIsNone(zone.get_record("gw07n01", "AAAA"))
+        self.assertEqual("gw09n02", zone.ipToHost["2001:8d8:1801:35f::92"])
+        self.assertEqual([], zone.get_active_gws("5"))
+
     def test_validate_status(self):
         lb = GwLoadBalancer()
         lb.zoneData = self.zoneData
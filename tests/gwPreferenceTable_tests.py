@@ -0,0 +1,63 @@
+import unittest
+import os
+import tempfile
+import threading
+from gwPreferenceTable import PreferenceTable, HEADER, ENTRY
+
+
+class PreferenceTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "preference.table")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_write(self):
+        writer = PreferenceTable(self.path, segments=32)
+        self.assertEqual(HEADER.size + 33 * ENTRY.size, os.path.getsize(self.path))
+        writer.update({1: 80, 32: -5, 40: 10}, 1651320000.0)
+        reader = PreferenceTable(self.path)
+        self.assertEqual((80, 1651320000.0), reader.get(1))
+        self.assertEqual((-5, 1651320000.0), reader.get(32))
+        self.assertIsNone(reader.get(2))
+        self.assertIsNone(reader.get(40))
+        self.assertFalse(reader.is_replaced())
+
+        # growing the table keeps the entries, readers notice it
+        writer.close()
+        writer = PreferenceTable(self.path, segments=64)
+        self.assertTrue(reader.is_replaced())
+        self.assertEqual((80, 1651320000.0), PreferenceTable(self.path).get(1))
+        writer.close()
+        reader.close()
+
+        with open(self.path, "wb") as fp:
+            fp.write(b"{}" + bytes(64))
+        with self.assertRaises(ValueError):
+            PreferenceTable(self.path)
+
+    def test_concurrent_reads(self):
+        # a reader never sees a preference together with the timestamp of another write
+        writer = PreferenceTable(self.path, segments=1)
+        reader = PreferenceTable(self.path)
+        stop = threading.Event()
+
+        def write():
+            i = 0
+            while not stop.is_set():
+                writer.set(1, i, float(i) + 1)
+                i += 1
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        try:
+            for i in range(20000):
+                entry = reader.get(1)
+                if entry is not None:
+                    self.assertEqual(entry[0] + 1, entry[1])
+        finally:
+            stop.set()
+            thread.join()
+        writer.close()
+        reader.close()
@@ -0,0 +1,108 @@
+import unittest
+import os
+import time
+import tempfile
+from gwLoadBalancer import GwLoadBalancer
+from gwZone import GwZone
+from gwRecorder import GwRecorder, read_records
+from gwReplay import simulate, gen_synthetic
+from dnsserver import DnsServer
+from gwstatusserver import GwStatusServer
+
+
+class GwReplayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.records = [
+            ("gw01n03", 300, "A", "88.198.230.6"),
+            ("gw05n03", 300, "A", "93.186.197.153"),
+            ("gw09n02", 600, "A", "212.227.213.45"),
+            ("gw01s01", 300, "A", "88.198.230.6"),
+            ("gw05s01", 300, "A", "93.186.197.153"),
+        ]
+        self.status = {"gw01n03": {"1": {"preference": 19, "dnsactive": 1}},
+                       "gw05n03": {"1": {"preference": 40, "dnsactive": 1}},
+                       "gw09n02": {"1": {"preference": 80, "dnsactive": 0}}}
+
+    def get_gateways(self):
+        return {gw: {"doc": {"version": "1", "timestamp": int(time.time()), "segments": segments}}
+                for (gw, segments) in self.status.items()}
+
+    def test_recorder(self):
+        zone = GwZone()
+        zone.serial = 7
+        zone.records = self.records
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "record.gz")
+            recorder = GwRecorder(path)
+            recorder.record(zone, {"gw01n03": {"segments": {}}, "gw05n03": {}}, timestamp=100)
+            recorder.record(zone, {"gw01n03": {}, "gw05n03": {}}, timestamp=130)
+            # a second recorder appends to the same file
+            GwRecorder(path).record(zone, {"gw01n03": {}}, timestamp=160)
+            records = list(read_records(path))
+        self.assertEqual(3, len(records))
+        self.assertEqual({"timestamp": 100, "gws": ["gw01n03", "gw05n03"], "docs": {"gw01n03": {"segments": {}}},
+                          "zone": {"origin": "gw.freifunk-stuttgart.de", "serial": 7,
+                                   "records": [list(r) for r in self.records]}}, records[0])
+        self.assertNotIn("zone", records[1])
+        self.assertEqual({}, records[1]["docs"])
+        self.assertIn("zone", records[2])
+
+    def test_record_and_replay(self):
+        with DnsServer(records=self.records) as dnsServer, GwStatusServer(self.get_gateways()) as server, \
+                tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "record.gz")
+            lb = GwLoadBalancer()
+            lb.localhost = "lb01"
+            lb.dnsServer = "127.0.0.1"
+            lb.dnsPort = dnsServer.port
+            lb.get_gw_status_url = server.url
+            lb.recorder = GwRecorder(path)
+            self.assertTrue(lb.run_cycle())
+            self.assertTrue(lb.run_cycle())
+            self.assertEqual({"1": ["gw09n02"]}, lb.result.added)
+            records = list(read_records(path))
+
+        self.assertEqual(2, len(records))
+        self.assertIn("zone", records[0])
+        self.assertNotIn("zone", records[1])
+        self.assertEqual(["gw01n03", "gw05n03", "gw09n02"], records[0]["gws"])
+        self.assertEqual(80, records[1]["docs"]["gw09n02"]["segments"]["1"]["preference"])
+
+        # replayed long after the recording, the documents are judged at their own time
+        result = simulate(records)
+        self.assertEqual(2, result["cycles"])
+        self.assertEqual(0, result["inconsistent"])
+        # gw09n02 is added in the first cycle, gw01n03 is removed in the second one
+        self.assertEqual(2, result["changes"])
+        # one segment per gateway after the first cycle, 0/1/1 after the second one
+        self.assertAlmostEqual((0.0 + (2 ** 0.5 / 3) / (2 / 3)) / 2, result["imbalance"])
+        self.assertTrue(0 < result["latency"]["mean"] <= result["latency"]["max"])
+
+    def test_simulate_synthetic(self):
+        records = list(gen_synthetic(200, gateways=6, segments=10, seed=3))
+        self.assertEqual(1, len([record for record in records if "zone" in record]))
+        self.assertEqual(records, list(gen_synthetic(200, gateways=6, segments=10, seed=3)))
+        preferences = [data["preference"] for record in records for doc in record["docs"].values()
+                       for data in doc["segments"].values()]
+        self.assertTrue(max(preferences) <= 100)
+        result = simulate(records)
+        self.assertEqual(200, result["cycles"])
+        self.assertEqual(0, result["inconsistent"])
+        self.assertEqual(0, result["shortSegments"])
+        stable = simulate(records, margin=10)
+        self.assertTrue(stable["changes"] < result["changes"])
+        self.assertTrue(stable["flipsAvoided"] > 0)
+        balanced = simulate(records, strategy="global")
+        self.assertEqual(0, balanced["inconsistent"])
+        self.assertTrue(balanced["imbalance"] <= result["imbalance"])
+        # 12 slots of 6 gateways for 10 segments: the limit leaves segments short, but none of them empty
+        limited = simulate(records, strategy="global", maxSegmentsPerGw=2)
+        self.assertEqual(0, limited["emptySegments"])
+        self.assertTrue(limited["shortSegments"] > 0)
+        self.assertEqual(0, simulate(records, strategy="global", maxSegmentsPerGw=4)["shortSegments"])
+        with self.assertRaises(ValueError):
+            list(gen_synthetic(1, gateways=100))
+
+
+if __name__ == '__main__':
+    unittest.main()
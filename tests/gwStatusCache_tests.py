@@ -0,0 +1,55 @@
+import unittest
+import os
+import time
+import tempfile
+import requests
+from gwStatusCache import GwStatusCache
+from gwstatusserver import GwStatusServer, gen_gwstatus
+
+
+class GwStatusCacheTestCase(unittest.TestCase):
+    def test_conditional_get(self):
+        gateways = {"gw01n03": {"doc": gen_gwstatus()}, "gw05n03": {"code": 503}}
+        with GwStatusServer(gateways) as server:
+            cache = GwStatusCache()
+            session = requests.Session()
+            (r, doc) = cache.get(session, server.url("gw01n03"))
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(gateways["gw01n03"]["doc"], doc)
+            (r, cached) = cache.get(session, server.url("gw01n03"))
+            self.assertEqual(304, r.status_code)
+            self.assertIs(doc, cached)
+            self.assertEqual(1, server.notModified)
+
+            gateways["gw01n03"]["doc"] = gen_gwstatus(preference=10)
+            (r, doc) = cache.get(session, server.url("gw01n03"))
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(10, doc["segments"]["1"]["preference"])
+
+            (r, doc) = cache.get(session, server.url("gw05n03"))
+            self.assertEqual(503, r.status_code)
+            self.assertIsNone(doc)
+
+    def test_eviction(self):
+        gateways = {"gw01n03": {"doc": gen_gwstatus()}}
+        gateways["gw01n03"]["doc"]["timestamp"] = int(time.time()) - 120
+        with GwStatusServer(gateways) as server:
+            cache = GwStatusCache(maxAge=60)
+            session = requests.Session()
+            cache.get(session, server.url("gw01n03"))
+            self.assertEqual({}, cache.entries)
+            (r, doc) = cache.get(session, server.url("gw01n03"))
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(0, server.notModified)
+
+    def test_save_and_load(self):
+        gateways = {"gw01n03": {"doc": gen_gwstatus()}}
+        with GwStatusServer(gateways) as server, tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cache.json")
+            cache = GwStatusCache(path)
+            cache.get(requests.Session(), server.url("gw01n03"))
+            cache.save()
+            cache = GwStatusCache(path)
+            (r, doc) = cache.get(requests.Session(), server.url("gw01n03"))
+            self.assertEqual(304, r.status_code)
+            self.assertEqual(gateways["gw01n03"]["doc"], doc)
@@ -0,0 +1,157 @@
+import unittest
+import os
+import time
+import calendar
+import tempfile
+import genGwStatus
+from gwTraffic import readNetDev, countClients, TrafficRing, FIVEMIN, HOUR
+
+NETDEV = """Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:  123456     100    0    0    0     0          0         0   123456     100    0    0    0     0       0          0
+  eth0: 9876543210 7654321    0    0    0     0          0         0 1234567890 4321    0    0    0     0       0          0
+"""
+
+TRANSTABLE = """[B.A.T.M.A.N. adv 2019.2, MainIF/MAC: vpn03bat/02:00:38:03:01:01 (bat03/02:00:39:03:01:01 BATMAN_IV)]
+Locally retrieved addresses (from bat03) announced via TT (TTVN: 12 CRC: 0x1234):
+       Client         VID Flags    Last seen (CRC       )
+ * 02:00:39:03:01:01   -1 [.P....]   0.000   (0x1b3c4d5e)
+ * 1a:2b:3c:4d:5e:6f   -1 [......]   1.020   (0x2c4d5e6f)
+ * 1a:2b:3c:4d:5e:70   -1 [....W.]   3.100   (0x3d5e6f70)
+"""
+
+
+def gen_net_dev(path, counters):
+    with open(path, "w") as fp:
+        fp.write(NETDEV.split("\n", 2)[0] + "\n" + NETDEV.split("\n", 2)[1] + "\n")
+        for (iface, tx) in counters.items():
+            fp.write("%6s: 0 0 0 0 0 0 0 0 %i 0 0 0 0 0 0 0\n" % (iface, tx))
+
+
+def vnstat_entry(t, tx):
+    t = time.gmtime(t)
+    return {"date": {"year": t.tm_year, "month": t.tm_mon, "day": t.tm_mday},
+            "time": {"hour": t.tm_hour, "minute": t.tm_min}, "tx": tx}
+
+
+class GwTrafficTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ringFile = os.path.join(self.tmp.name, "traffic.ring")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_net_dev(self):
+        path = os.path.join(self.tmp.name, "dev")
+        with open(path, "w") as fp:
+            fp.write(NETDEV)
+        self.assertEqual({"lo": (123456, 123456), "eth0": (9876543210, 1234567890)}, readNetDev(path))
+
+    def test_peak_matches_vnstat(self):
+        # one sample per five minutes over two days with varying traffic
+        start = calendar.timegm((2022, 4, 30, 0, 0, 0))
+        rates = [(i * 7919) % 5000 * 1000 for i in range(2 * 24 * 12)]
+        ring = TrafficRing(self.ringFile)
+        counter = 0
+        ring.sample(0, start, counter)
+        hours = {}
+        fivemin = []
+        for (i, rate) in enumerate(rates):
+            counter += rate
+            t = start + (i + 1) * FIVEMIN
+            ring.sample(0, t, counter)
+            hours[(t - FIVEMIN) // HOUR] = hours.get((t - FIVEMIN) // HOUR, 0) + rate
+            fivemin.append(vnstat_entry(t - FIVEMIN, rate))
+        now = start + len(rates) * FIVEMIN
+        vnstat = {"interfaces": [{"updated": vnstat_entry(now, 0), "traffic": {
+            "hour": [vnstat_entry(h * HOUR, tx) for (h, tx) in hours.items()],
+            "fiveminute": fivemin[-FIVEMIN * 288 // FIVEMIN:]}}]}
+        self.assertAlmostEqual(genGwStatus.getPeak_v2(vnstat), ring.getPeak(0, now))
+        ring.close()
+
+    def test_persistence_and_reset(self):
+        now = calendar.timegm((2022, 4, 30, 12, 0, 0))
+        ring = TrafficRing(self.ringFile)
+        ring.sample(0, now, 1000)
+        ring.sample(0, now + FIVEMIN, 1000 + 3600 * 1024 * 1024 // 8 // 12)
+        ring.close()
+
+        ring = TrafficRing(self.ringFile)
+        self.assertAlmostEqual(1.0, ring.getPeak(0, now + FIVEMIN))
+        # counter reset after a reboot: the new counter value is taken as traffic
+        ring.sample(0, now + 2 * FIVEMIN, 0)
+        self.assertAlmostEqual(1.0, ring.getPeak(0, now + 2 * FIVEMIN))
+        ring.close()
+
+        # a ring with another layout is reinitialised
+        ring = TrafficRing(self.ringFile, series=2)
+        self.assertIsNone(ring.getPeak(0, now + 2 * FIVEMIN))
+        ring.close()
+
+    def test_segment_load(self):
+        # uplink at 80 of 100 mbit/s, segment 1 carries most of the traffic and the clients of four segments
+        peaks = {0: 80.0, 1: 56.0, 2: 8.0, 3: 8.0, 4: 8.0}
+        clients = {1: 120, 2: 20, 3: 20, 4: 40}
+        preferences = genGwStatus.getSegmentPreferences(100, peaks, 4, clients)
+        self.assertEqual({1: -108, 2: 20, 3: 20, 4: 20}, preferences)
+        # by traffic alone segment 1 is 2.8 times the average: 80% + 1.8 * 80% of the uplink
+        self.assertEqual(-124, genGwStatus.getSegmentPreferences(100, peaks, 4)[1])
+        # a segment with the same traffic but few clients is penalised less
+        peaks = {0: 80.0, 1: 8.0, 2: 8.0, 3: 8.0, 4: 56.0}
+        self.assertEqual(-44, genGwStatus.getSegmentPreferences(100, peaks, 4, clients)[4])
+
+    def test_partial_ring(self):
+        now = calendar.timegm((2022, 4, 30, 12, 0, 0))
+        mbit = 1024 * 1024 // 8 * FIVEMIN
+        netdev = os.path.join(self.tmp.name, "dev")
+        ring = TrafficRing(self.ringFile, series=2)
+        # no peak before the samples span five minutes
+        gen_net_dev(netdev, {"eth0": 0, "bat01": 0})
+        self.assertEqual({}, genGwStatus.sampleTraffic(ring, now, "eth0", 1, "bat%02i", netdev))
+        gen_net_dev(netdev, {"eth0": mbit, "bat01": 0})
+        self.assertEqual({}, genGwStatus.sampleTraffic(ring, now + 10, "eth0", 1, "bat%02i", netdev))
+        self.assertIsNone(ring.getPeak(0, now + 10))
+
+        # 20 mbit/s for 15 minutes, then 10 mbit/s: the hour is averaged over the six sampled buckets only
+        counter = 0
+        ring.sample(1, now, counter)
+        for (i, rate) in enumerate([20, 20, 20, 10, 10, 10]):
+            counter += rate * mbit
+            ring.sample(1, now + (i + 1) * FIVEMIN, counter)
+        self.assertAlmostEqual(15.0, ring.getPeak(1, now + 6 * FIVEMIN))
+        ring.close()
+
+    def test_count_clients(self):
+        os.makedirs(os.path.join(self.tmp.name, "bat03"))
+        with open(os.path.join(self.tmp.name, "bat03", "transtable_local"), "w") as fp:
+            fp.write(TRANSTABLE)
+        self.assertEqual(2, countClients("bat03", self.tmp.name))
+        self.assertIsNone(countClients("bat04", self.tmp.name))
+
+    def test_segment_preferences(self):
+        # 100 mbit/s on the uplink, segment 1 carries 70 of them, segment 2 10, segment 3 is not present
+        netdev = os.path.join(self.tmp.name, "dev")
+        now = calendar.timegm((2022, 4, 30, 12, 0, 0))
+        mbit = 1024 * 1024 // 8 * FIVEMIN
+        ring = TrafficRing(self.ringFile, series=4)
+        gen_net_dev(netdev, {"eth0": 0, "bat01": 0, "bat02": 0})
+        genGwStatus.sampleTraffic(ring, now, "eth0", 3, "bat%02i", netdev)
+        gen_net_dev(netdev, {"eth0": 100 * mbit, "bat01": 70 * mbit, "bat02": 10 * mbit})
+        peaks = genGwStatus.sampleTraffic(ring, now + FIVEMIN, "eth0", 3, "bat%02i", netdev)
+        ring.close()
+        self.assertEqual([0, 1, 2], sorted(peaks))
+        self.assertAlmostEqual(100, peaks[0])
+        self.assertAlmostEqual(70, peaks[1])
+
+        # segment 1 carries 7/8 of the segment traffic, as if both segments did: 10% + 7.5% of the uplink
+        preferences = genGwStatus.getSegmentPreferences(1000, peaks, 3)
+        self.assertEqual({1: 82, 2: 90, 3: 90}, preferences)
+        data = genGwStatus.genData(3, segmentPreferences=preferences, load={1: {"tx": 70.0}})
+        self.assertEqual({"preference": 82, "load": {"tx": 70.0}}, data["segments"][1])
+        self.assertEqual({"preference": 90}, data["segments"][3])
+
+        ring = TrafficRing(self.ringFile, series=4)
+        with self.assertRaises(genGwStatus.CLIError):
+            genGwStatus.sampleTraffic(ring, now, "eth1", 3, "bat%02i", netdev)
+        ring.close()
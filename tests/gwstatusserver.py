@@ -0,0 +1,82 @@
+'''
+Local stand-in for the gwstatus.json web servers of a set of gateways.
+
+Every gateway is served below its own path prefix, i.e.
+http://127.0.0.1:<port>/<gw>/data/gwstatus.json
+'''
+
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def gen_gwstatus(segments=2, preference=50, dnsactive=0):
+    return {
+        "version": "1",
+        "timestamp": int(time.time()),
+        "segments": {str(s): {"preference": preference, "dnsactive": dnsactive} for s in range(1, segments + 1)}
+    }
+
+
+class GwStatusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        gw = self.path.strip("/").split("/")[0]
+        gateway = self.server.gateways.get(gw)
+        self.server.requests += 1
+        if gateway is None:
+            self.reply(404, b"")
+            return
+        if gateway.get("delay", 0) > 0:
+            time.sleep(gateway["delay"])
+        code = gateway.get("code", 200)
+        if code != 200:
+            self.reply(code, b"")
+            return
+        if "body" in gateway:
+            self.reply(200, gateway["body"])
+            return
+        body = json.dumps(gateway["doc"]).encode("utf-8")
+        etag = '"%s"' % (hashlib.md5(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.server.notModified += 1
+            self.reply(304, b"", etag)
+            return
+        self.reply(200, body, etag)
+
+    def reply(self, code, body, etag=None):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GwStatusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, gateways=None):
+        super().__init__(("127.0.0.1", 0), GwStatusHandler)
+        self.gateways = gateways if gateways is not None else {}
+        self.requests = 0
+        self.notModified = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    def url(self, gw):
+        return "http://127.0.0.1:%i/%s/data/gwstatus.json" % (self.server_address[1], gw)